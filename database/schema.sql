@@ -38,13 +38,14 @@ CREATE TABLE table_routage (
 );
 
 -- Table des logs
+-- routeur_id est l'ID attribué par le master (table routers, créée par storage.py) :
+-- pas de clé étrangère vers routeurs, un évènement refusé ferait perdre tout son lot
 CREATE TABLE logs (
     id INT AUTO_INCREMENT PRIMARY KEY,
     routeur_id INT,
     type_evenement ENUM('connexion', 'deconnexion', 'message_recu', 'message_envoye', 'erreur') NOT NULL,
     message TEXT,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (routeur_id) REFERENCES routeurs(id) ON DELETE SET NULL
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Table de topologie
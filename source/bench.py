@@ -0,0 +1,298 @@
+"""Banc d'essai de bout en bout : master + N routeurs + M clients sur localhost
+
+    python bench.py --routers 3 --clients 4 --messages 50 --layers 3
+    python bench.py --rate 20 --size 256 --json resultats.json
+
+Le master (avec le stockage en mémoire à la place de MariaDB) et chaque routeur
+tournent dans leur propre processus ; les clients, sans interface, tournent
+dans le processus du banc. Chaque client envoie --messages messages à ses
+voisins (à --rate messages/s, 0 = au plus vite) puis le banc attend leur
+arrivée et affiche débit, latences p50/p99 et temps CPU par composant.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BASE_PORT = 15500  # Master ; routeurs BASE_PORT+1.. ; clients BASE_PORT+100..
+READY_TIMEOUT = 30.0  # Démarrage d'un composant (inscription comprise)
+DRAIN_TIMEOUT = 10.0  # Attente des messages encore en route après les envois
+
+
+# ---------- COMPOSANTS (processus fils) ----------
+def serve_until_stopped(out):
+    """Signaler READY puis attendre STOP sur stdin ; renvoie le CPU consommé depuis READY"""
+    ready_cpu = time.process_time()
+    out.write("READY\n")
+    out.flush()
+    sys.stdin.readline()
+    out.write(json.dumps({"cpu": time.process_time() - ready_cpu}) + "\n")
+    out.flush()
+
+
+def run_master(port):
+    import master
+    from storage import MemoryStorage
+    server = master.MasterServer(host="127.0.0.1", port=port, log_level="WARNING", storage=MemoryStorage())
+    server.chosen_port = port
+    if not server.start():
+        sys.exit(1)
+    return server
+
+
+def run_router(port, master_port):
+    import router
+    host = router.RouterHost("127.0.0.1", master_port)
+    host.add("127.0.0.1", port)
+    if not host.start():
+        sys.exit(1)
+    threading.Thread(target=host.serve_forever, daemon=True).start()
+
+
+def run_component(role, port, master_port):
+    # Les affichages des composants ne doivent pas se mêler au protocole READY/STOP
+    out = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    if role == "master":
+        run_master(port)
+    else:
+        run_router(port, master_port)
+    serve_until_stopped(out)
+
+
+# ---------- ORCHESTRATION ----------
+def wait_for_port(port, timeout=READY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+class Component:
+    """Processus fils (master ou routeur) piloté par stdin/stdout"""
+
+    def __init__(self, name, role, port, master_port):
+        self.name = name
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--role", role,
+             "--port", str(port), "--master-port", str(master_port)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+        )
+        self.cpu = None
+
+    def wait_ready(self):
+        line = self.process.stdout.readline().strip()
+        if line != "READY":
+            raise RuntimeError(f"{self.name} failed to start")
+
+    def stop(self):
+        try:
+            self.process.stdin.write("STOP\n")
+            self.process.stdin.flush()
+            result = json.loads(self.process.stdout.readline())
+            self.cpu = result["cpu"]
+        except (OSError, ValueError):
+            pass
+        self.process.kill()
+        self.process.wait()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Traffic:
+    """Envoi des messages et mesure de leur latence de bout en bout"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent_at = {}  # id du message -> instant d'envoi
+        self.latencies = []
+        self.sent = 0
+        self.failed = 0
+        self.delivered = threading.Semaphore(0)
+
+    def on_message(self, sender, message, time_str):
+        msg_id = message.split("|", 1)[0]
+        now = time.perf_counter()
+        with self.lock:
+            started = self.sent_at.pop(msg_id, None)
+            if started is None:
+                return
+            self.latencies.append(now - started)
+        self.delivered.release()
+
+    def run_sender(self, client, targets, count, rate, layers, padding, ids):
+        start = time.perf_counter()
+        for k in range(count):
+            if rate > 0:
+                delay = start + k / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            msg_id = str(next(ids))
+            target = targets[k % len(targets)]
+            with self.lock:
+                self.sent_at[msg_id] = time.perf_counter()
+            ok, _ = client.send_message(target, f"{msg_id}|{padding}", layers)
+            with self.lock:
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                    self.sent_at.pop(msg_id, None)
+
+
+def run_bench(args):
+    import client as client_module
+    from client import ChatClient
+
+    # Files d'accusés de réception jetables : rien ne reste d'un lancement à l'autre
+    client_module.HISTORY_DIR = tempfile.mkdtemp(prefix="onion_bench_")
+
+    if args.clients < 2:
+        raise SystemExit("X At least 2 clients are needed")
+    master_port = args.base_port
+    print(f"Starting master on {master_port} and {args.routers} routers...")
+    master = Component("master", "master", master_port, master_port)
+    components = [master]
+    clients = []
+    try:
+        master.wait_ready()
+        for i in range(args.routers):
+            components.append(Component(f"router {i + 1}", "router", master_port + 1 + i, master_port))
+        for component in components[1:]:
+            component.wait_ready()
+
+        traffic = Traffic()
+        print(f"Registering {args.clients} clients...")
+        for i in range(args.clients):
+            client = ChatClient()
+            client.gui_mode = True  # Pas de saisie ni d'affichage
+            ok, status = client.register(f"bench{i}", "127.0.0.1", master_port + 100 + i,
+                                         "127.0.0.1", master_port)
+            if not ok:
+                raise RuntimeError(f"Client bench{i}: {status}")
+            client.start(traffic.on_message, lambda: None)
+            clients.append(client)
+        for i in range(args.clients):
+            wait_for_port(master_port + 100 + i)
+
+        padding = "x" * max(0, args.size)
+        ids = itertools.count()
+        total = args.clients * args.messages
+        print(f"Sending {total} messages ({args.layers} layers, {args.size} bytes, "
+              f"rate {args.rate or 'max'}/s per client)...")
+        cpu_start = time.process_time()
+        started = time.perf_counter()
+        senders = []
+        for i, client in enumerate(clients):
+            targets = [c.username for c in clients if c is not client]
+            thread = threading.Thread(
+                target=traffic.run_sender,
+                args=(client, targets, args.messages, args.rate, args.layers, padding, ids),
+                daemon=True,
+            )
+            thread.start()
+            senders.append(thread)
+        for thread in senders:
+            thread.join()
+        send_elapsed = time.perf_counter() - started
+
+        deadline = time.monotonic() + args.drain
+        received = 0
+        while received < traffic.sent and traffic.delivered.acquire(timeout=max(0, deadline - time.monotonic())):
+            received += 1
+        elapsed = time.perf_counter() - started
+        clients_cpu = time.process_time() - cpu_start
+    finally:
+        for client in clients:
+            client.stop()
+        for component in components:
+            component.stop()
+        shutil.rmtree(client_module.HISTORY_DIR, ignore_errors=True)
+
+    latencies = traffic.latencies
+    results = {
+        "routers": args.routers,
+        "clients": args.clients,
+        "layers": args.layers,
+        "size": args.size,
+        "rate": args.rate,
+        "sent": traffic.sent,
+        "failed": traffic.failed,
+        "delivered": len(latencies),
+        "elapsed": elapsed,
+        "send_elapsed": send_elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies, default=0.0),
+        "cpu": {component.name: component.cpu for component in components},
+    }
+    results["cpu"]["clients"] = clients_cpu
+    return results
+
+
+def print_results(results):
+    print(f"\n{'='*60}")
+    print("BENCHMARK RESULTS")
+    print(f"{'='*60}")
+    print(f"Messages: {results['sent']} sent, {results['delivered']} delivered, "
+          f"{results['failed']} failed, {results['sent'] - results['delivered']} lost")
+    print(f"Throughput: {results['throughput']:.1f} msg/s ({results['elapsed']:.2f} s)")
+    print(f"Latency: p50 {results['latency_p50'] * 1000:.1f} ms, "
+          f"p99 {results['latency_p99'] * 1000:.1f} ms, max {results['latency_max'] * 1000:.1f} ms")
+    print("CPU time:")
+    for name, cpu in results["cpu"].items():
+        if cpu is None:
+            print(f"   {name:<12} n/a")
+        else:
+            print(f"   {name:<12} {cpu:7.2f} s  ({cpu / results['elapsed'] * 100:5.1f} % of one core)")
+    print(f"{'='*60}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the onion chat")
+    parser.add_argument("--routers", type=int, default=3, help="number of routers (default: 3)")
+    parser.add_argument("--clients", type=int, default=4, help="number of clients (default: 4)")
+    parser.add_argument("--messages", type=int, default=50, help="messages sent by each client")
+    parser.add_argument("--rate", type=float, default=0, help="messages/s per client (0 = max)")
+    parser.add_argument("--layers", type=int, default=3, help="router layers per message")
+    parser.add_argument("--size", type=int, default=64, help="message size in characters")
+    parser.add_argument("--base-port", type=int, default=BASE_PORT, help="master port, routers and clients follow")
+    parser.add_argument("--drain", type=float, default=DRAIN_TIMEOUT, help="seconds to wait for late messages")
+    parser.add_argument("--json", help="also write the results to this file")
+    # Lancement interne des processus master / routeur
+    parser.add_argument("--role", choices=("master", "router"), help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--master-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role:
+        run_component(args.role, args.port, args.master_port)
+        return
+
+    results = run_bench(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,338 @@
+import argparse
+import base64
 import sys
 import socket
 import threading
 import time
+import itertools
+import os
+import selectors
+import sqlite3
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime
+import metrics
+import tracing
+from config import add_config_argument, port_type, resolve
+from onion import KEY_SIZE, format_header, pack_layer
+from protocol import (
+    FRAME_BATCH, FRAME_MESSAGE, FRAME_TRACED, MAX_FRAME, MAX_REPLY_LINE, ConnectionPool, LineReader, format_line,
+    is_readable, pack_batch, pack_traced, parse_line, recv_frame, unpack_traced
+)
+from delivery import DELIVERY_KINDS, MESSAGE_ID_SIZE, DeliveryManager, pack_text
+from transfer import CONTROL_PREFIX, TransferManager, format_rate, format_size
 
 # Configuration par défaut
 MASTER_IP = "127.0.0.1"
 MASTER_PORT = 6000  # Port par défaut
+REQUEST_TIMEOUT = 10.0  # Délai max d'une requête au Master
+PATHS_BATCH = 100  # Destinataires max par requête PATHS (réponse bornée, requêtes en parallèle)
+RECEIVE_WORKERS = 8  # Threads de réception des messages entrants
+RECEIVE_BACKLOG = 64  # Connexions acceptées en attente d'un thread libre
+RECEIVE_TIMEOUT = 10.0  # Délai max sans données sur une connexion entrante
+RECEIVE_POLL = 1.0  # Réveil de l'écoute pour fermer les connexions inactives et voir l'arrêt (s)
+SEND_WORKERS = 8  # Threads de construction/envoi pour send_many
+SEND_LINGER = 0.005  # Attente max pour regrouper les envois vers un même routeur (s)
+SEND_MAX_BATCH = 64  # Nombre max d'oignons par envoi groupé
+SEND_MAX_BATCH_BYTES = 1024 * 1024  # Taille max d'un envoi groupé
+SEND_TIMEOUT = 15.0  # Délai max d'un envoi (attente + connexion + écriture)
+HISTORY_MAX_ROWS = 500  # Messages gardés en mémoire par la vue de conversation
+HISTORY_EVICT_CHUNK = 50  # Messages retirés d'un coup quand la limite est atteinte
+HISTORY_PAGE = 100  # Messages chargés à l'ouverture d'une conversation / par défilement
+HISTORY_DIR = os.path.join(os.path.expanduser("~"), ".onion_chat")  # Historique local
+
+# Métriques
+MASTER_REQUEST_SECONDS = metrics.histogram("onion_client_master_request_seconds", "Requête au Master (aller-retour)", ("command",))
+ONION_BUILD_SECONDS = metrics.histogram("onion_client_onion_build_seconds", "Construction d'un oignon", ("layers",))
+SEND_SECONDS = metrics.histogram("onion_client_send_seconds", "Remise d'un oignon au premier routeur")
+MESSAGES_SENT = metrics.counter("onion_client_messages_sent_total", "Messages envoyés", ("result",))
+MESSAGES_RECEIVED = metrics.counter("onion_client_messages_received_total", "Messages reçus")
+BYTES_OUT = metrics.counter("onion_client_bytes_out_total", "Octets envoyés aux routeurs")
+BYTES_IN = metrics.counter("onion_client_bytes_in_total", "Octets reçus des routeurs")
+CONNECTIONS_ACTIVE = metrics.gauge("onion_client_active_connections", "Connexions entrantes ouvertes")
+
+
+class MasterChannel:
+    """Canal de contrôle multiplexé vers le Master
+    
+    Chaque requête reçoit un ID ; un unique thread lecteur distribue les
+    réponses aux Future correspondants, ce qui permet d'avoir plusieurs
+    requêtes en vol (keep-alive, LIST, GET, PATH...) sur la même socket.
+    """
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+    
+    def submit(self, command):
+        """Envoyer une commande sans attendre ; retourne un Future"""
+        future = Future()
+        with self._lock:
+            if self.closed:
+                future.set_exception(ConnectionError("Master channel closed"))
+                return future
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        try:
+            with self._send_lock:
+                self.sock.sendall(format_line(command, request_id))
+        except OSError as e:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            future.set_exception(e)
+        return future
+    
+    def request(self, command, timeout=REQUEST_TIMEOUT):
+        """Envoyer une commande et attendre la réponse"""
+        with MASTER_REQUEST_SECONDS.time(command=command.split(":", 1)[0]):
+            return self.submit(command).result(timeout)
+    
+    def _read_loop(self):
+        """Thread lecteur : associe chaque réponse à sa requête"""
+        reader = LineReader(self.sock, MAX_REPLY_LINE)
+        try:
+            while True:
+                line = reader.readline()
+                if line is None:
+                    break
+                request_id, payload = parse_line(line)
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future:
+                    future.set_result(payload)
+        except OSError:
+            pass
+        except ValueError as e:
+            print(f"\nX Master channel closed: {e}")
+        finally:
+            self._fail_pending()
+    
+    def _fail_pending(self):
+        """Échouer toutes les requêtes en attente (connexion perdue)"""
+        with self._lock:
+            self.closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.set_exception(ConnectionError("Lost connection to master"))
+    
+    def close(self):
+        """Envoyer QUIT et fermer la socket"""
+        try:
+            with self._send_lock:
+                self.sock.sendall(format_line("QUIT"))
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self._fail_pending()
+
+
+class SendQueue:
+    """File d'envoi regroupant les oignons destinés au même premier routeur
+    
+    Les oignons soumis pendant la fenêtre d'attente (linger) vers une même
+    adresse partent ensemble dans une trame FRAME_BATCH : une seule écriture
+    et une seule connexion au lieu d'une par message. Un seul lot à la fois
+    est en cours d'écriture par adresse : les messages d'une conversation
+    arrivent au premier routeur dans l'ordre où ils ont été soumis.
+    """
+    
+    def __init__(self, pool, linger=SEND_LINGER, max_batch=SEND_MAX_BATCH,
+                 max_batch_bytes=SEND_MAX_BATCH_BYTES):
+        self.pool = pool
+        self.linger = linger
+        self.max_batch = max_batch
+        self.max_batch_bytes = max_batch_bytes
+        self._pending = {}  # (ip, port) -> [(type de trame, oignon, Future), ...]
+        self._sizes = {}  # (ip, port) -> octets en attente
+        self._deadlines = {}  # (ip, port) -> instant d'envoi
+        self._flushing = set()  # (ip, port) dont un lot est en cours d'écriture
+        self._cond = threading.Condition()
+        self._senders = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="flush")
+        self._thread = None
+        self.running = True
+    
+    def submit(self, addr, payload, kind=FRAME_MESSAGE):
+        """Mettre un oignon en file ; retourne un Future (True une fois écrit)"""
+        future = Future()
+        with self._cond:
+            if not self.running:
+                future.set_exception(ConnectionError("Send queue closed"))
+                return future
+            batch = self._pending.setdefault(addr, [])
+            batch.append((kind, payload, future))
+            self._sizes[addr] = self._sizes.get(addr, 0) + len(payload)
+            if len(batch) == 1:
+                self._deadlines[addr] = time.monotonic() + self.linger
+            if len(batch) >= self.max_batch or self._sizes[addr] >= self.max_batch_bytes:
+                self._deadlines[addr] = 0
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+    
+    def _run(self):
+        """Envoyer les lots dont la fenêtre d'attente est écoulée (tout, à l'arrêt)"""
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    # Adresse dont un lot est en cours : le suivant attend (et grossit)
+                    ready = {addr: t for addr, t in self._deadlines.items() if addr not in self._flushing}
+                    due = [addr for addr, t in ready.items() if t <= now or not self.running]
+                    if due or (not self.running and not self._pending):
+                        break
+                    self._cond.wait(min(ready.values()) - now if ready else None)
+                if not due:
+                    return  # Arrêt : tout est parti
+                batches = [(addr, self._take(addr)) for addr in due]
+                self._flushing.update(due)
+            for addr, batch in batches:
+                self._senders.submit(self._flush, addr, batch)
+    
+    def _take(self, addr):
+        """Prochain lot pour addr, dans les limites d'un envoi (appelé avec self._cond)"""
+        pending = self._pending[addr]
+        count, size = 0, 0
+        while count < len(pending) and count < self.max_batch:
+            item_size = len(pending[count][1])
+            if count and size + item_size > self.max_batch_bytes:
+                break
+            count += 1
+            size += item_size
+        batch = pending[:count]
+        if count < len(pending):
+            # Reste en file : part dès que ce lot est écrit
+            self._pending[addr] = pending[count:]
+            self._sizes[addr] -= size
+            self._deadlines[addr] = 0
+        else:
+            del self._pending[addr], self._sizes[addr], self._deadlines[addr]
+        return batch
+    
+    def _flush(self, addr, batch):
+        """Écrire un lot en une seule trame, puis laisser partir le lot suivant de addr"""
+        try:
+            if len(batch) == 1:
+                kind, payload, _ = batch[0]
+                self.pool.send(addr, payload, kind)
+            else:
+                self.pool.send(addr, pack_batch([(kind, payload) for kind, payload, _ in batch]), FRAME_BATCH)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+        else:
+            for _, _, future in batch:
+                future.set_result(True)
+        finally:
+            with self._cond:
+                self._flushing.discard(addr)
+                self._cond.notify()
+    
+    def close(self):
+        """Envoyer ce qui reste en file puis arrêter"""
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(SEND_TIMEOUT)
+        self._senders.shutdown(wait=True)
+
+
+def safe_user_name(username):
+    """Nom d'utilisateur utilisable dans un nom de fichier"""
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in username)
+
+
+class MessageStore:
+    """Historique local des conversations (SQLite, indexé par interlocuteur et date)"""
+    
+    def __init__(self, path):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self._lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    peer TEXT NOT NULL,
+                    sender TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    sent INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self.db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_messages_peer_time
+                ON messages(peer, created_at, id)
+            """)
+            self.db.commit()
+    
+    @classmethod
+    def for_user(cls, username):
+        """Historique de l'utilisateur dans HISTORY_DIR"""
+        return cls(os.path.join(HISTORY_DIR, f"history_{safe_user_name(username)}.db"))
+    
+    def add(self, peer, sender, body, sent, created_at=None):
+        """Enregistrer un message ; retourne l'enregistrement"""
+        created_at = created_at if created_at is not None else time.time()
+        with self._lock:
+            cur = self.db.execute(
+                "INSERT INTO messages (peer, sender, body, sent, created_at) VALUES (?, ?, ?, ?, ?)",
+                (peer, sender, body, int(sent), created_at)
+            )
+            self.db.commit()
+        return {"id": cur.lastrowid, "peer": peer, "sender": sender, "body": body,
+                "sent": bool(sent), "created_at": created_at}
+    
+    def _select(self, query, params):
+        with self._lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [dict(row, sent=bool(row["sent"])) for row in rows]
+    
+    def recent(self, peer, limit=HISTORY_PAGE):
+        """Les limit derniers messages d'une conversation (du plus ancien au plus récent)"""
+        rows = self._select(
+            "SELECT * FROM messages WHERE peer = ? ORDER BY created_at DESC, id DESC LIMIT ?",
+            (peer, limit)
+        )
+        return rows[::-1]
+    
+    def before(self, peer, record, limit=HISTORY_PAGE):
+        """Messages précédant record (du plus ancien au plus récent)"""
+        rows = self._select(
+            "SELECT * FROM messages WHERE peer = ? AND (created_at, id) < (?, ?) "
+            "ORDER BY created_at DESC, id DESC LIMIT ?",
+            (peer, record["created_at"], record["id"], limit)
+        )
+        return rows[::-1]
+    
+    def after(self, peer, record, limit=HISTORY_PAGE):
+        """Messages suivant record (du plus ancien au plus récent)"""
+        return self._select(
+            "SELECT * FROM messages WHERE peer = ? AND (created_at, id) > (?, ?) "
+            "ORDER BY created_at, id LIMIT ?",
+            (peer, record["created_at"], record["id"], limit)
+        )
+    
+    def close(self):
+        with self._lock:
+            self.db.close()
 
 
 class ChatClient:
@@ -18,6 +344,15 @@ class ChatClient:
         self.port = None
         self.public_key = None
         self.master_socket = None
+        self.channel = None  # Canal multiplexé, créé après l'inscription
+        self.pool = ConnectionPool(bytes_out=BYTES_OUT)  # Connexions vers les routeurs d'entrée
+        self.outbox = SendQueue(self.pool)  # Regroupement des envois par routeur
+        self.transfers = TransferManager(self)  # Envois et réceptions de fichiers
+        self.delivery = DeliveryManager(self)  # Accusés de réception et renvois des messages
+        self.trace_sink = None  # Fichier de trace (ONION_TRACE_DIR), None si désactivé
+        self.trace_dir = None  # Dossier de trace imposé au lancement (sinon ONION_TRACE_DIR)
+        self.metrics_port = None  # Port /metrics imposé au lancement (sinon ONION_METRICS_PORT)
+        self.default_layers = None  # Couches utilisées en CLI sans les demander
         self.running = False
         self.gui_mode = False
         self.master_ip = MASTER_IP  # IP du Master
@@ -26,57 +361,57 @@ class ChatClient:
     def register(self, username=None, ip=None, port=None, master_ip=None, master_port=None):
         """Inscription avec le Master"""
         if not username or not ip or not port:
-            # Mode CLI - Demander les infos
+            # Mode CLI - Demander les infos qui n'ont pas été fournies
             print("\n", "="*60)
             print("CLIENT REGISTRATION")
             print("="*60)
             
-            self.username = input("Enter your username: ")
+            self.username = username or input("Enter your username: ")
             
             # Demander l'IP du client
-            while True:
+            self.ip = ip
+            while not self.ip:
                 ip_input = input("Enter your IP address (default: 127.0.0.1): ").strip()
                 if ip_input == "":
                     self.ip = "127.0.0.1"
-                    break
                 elif self.validate_ip(ip_input):
                     self.ip = ip_input
-                    break
                 else:
                     print("X Invalid IP address format. Please use IPv4 format (e.g., 127.0.0.1)")
             
             # Demander le port
-            while True:
+            self.port = port
+            while not self.port:
                 try:
                     port_input = input("Enter your listening port (7001, 7002, ...): ")
-                    self.port = int(port_input)
+                    port_num = int(port_input)
                     
                     # Vérifier si le port est disponible
                     try:
                         test_sock = socket.socket()
-                        test_sock.bind((self.ip, self.port))
+                        test_sock.bind((self.ip, port_num))
                         test_sock.close()
-                        break
+                        self.port = port_num
                     except OSError:
-                        print(f"X Port {self.port} is already in use on {self.ip}. Please choose another.")
+                        print(f"X Port {port_num} is already in use on {self.ip}. Please choose another.")
                         
                 except ValueError:
                     print("X Please enter a valid number.")
             
             # Demander l'IP du Master
-            while True:
+            self.master_ip = master_ip
+            while not self.master_ip:
                 master_ip_input = input(f"Enter Master server IP (default: {MASTER_IP}): ").strip()
                 if master_ip_input == "":
                     self.master_ip = MASTER_IP
-                    break
                 elif self.validate_ip(master_ip_input):
                     self.master_ip = master_ip_input
-                    break
                 else:
                     print("X Invalid IP address format. Please use IPv4 format (e.g., 127.0.0.1)")
             
             # Demander le PORT du Master
-            while True:
+            self.master_port = master_port
+            while not self.master_port:
                 master_port_input = input(f"Enter Master server port (default: {MASTER_PORT}): ").strip()
                 if master_port_input == "":
                     self.master_port = MASTER_PORT
@@ -85,13 +420,12 @@ class ChatClient:
                     port_num = int(master_port_input)
                     if 1 <= port_num <= 65535:
                         self.master_port = port_num
-                        break
                     else:
                         print("X Port must be between 1 and 65535")
                 except ValueError:
                     print("X Please enter a valid number")
         else:
-            # Mode GUI - Utiliser les paramètres fournis
+            # Paramètres fournis (GUI ou options de lancement) : pas de saisie
             self.username = username
             self.ip = ip
             self.port = port
@@ -124,6 +458,10 @@ class ChatClient:
                 _, e_str, n_str = response.split(":")
                 self.public_key = (int(e_str), int(n_str))
                 self.master_socket.settimeout(None)
+                self.channel = MasterChannel(self.master_socket)
+                self.trace_sink = tracing.sink_from_env(f"client-{self.username}", self.trace_dir)
+                self.transfers.directory = os.path.join(HISTORY_DIR, "files", safe_user_name(self.username))
+                self.delivery.open(os.path.join(HISTORY_DIR, f"outbox_{safe_user_name(self.username)}.db"))
                 
                 if not self.gui_mode:
                     print(f"\nSuccessfully registered as '{self.username}'")
@@ -166,8 +504,7 @@ class ChatClient:
     def get_online_users(self):
         """Liste des utilisateurs en ligne"""
         try:
-            self.master_socket.send(b"LIST")
-            response = self.master_socket.recv(1024).decode()
+            response = self.channel.request("LIST")
             
             if response.startswith("ONLINE:"):
                 users = response[7:].split(",")
@@ -180,8 +517,7 @@ class ChatClient:
     def get_user_info(self, username):
         """Récupère les informations d'un utilisateur"""
         try:
-            self.master_socket.send(f"GET:{username}".encode())
-            response = self.master_socket.recv(1024).decode()
+            response = self.channel.request(f"GET:{username}")
             
             if response.startswith("USER:"):
                 parts = response[5:].split(":")
@@ -195,13 +531,28 @@ class ChatClient:
         except:
             return None
     
+    def deposit_mail(self, target_user, body):
+        """Confier au master un message pour un utilisateur hors ligne ; "OK" ou "ERROR:..."
+
+        Le message part en clair par le canal de contrôle, hors du circuit : le
+        master voit l'expéditeur, le destinataire et le contenu (voir Mailbox).
+        """
+        try:
+            return self.channel.request(f"MAIL:{target_user}:{base64.b64encode(body).decode()}")
+        except Exception as e:
+            return f"ERROR:{type(e).__name__}"
+    
+    def mail_offline(self, target_user, message):
+        """Déposer un message texte pour un utilisateur hors ligne ; (True, statut) ou None"""
+        if self.deposit_mail(target_user, pack_text(os.urandom(MESSAGE_ID_SIZE), message)) != "OK":
+            return None
+        return True, f"'{target_user}' hors ligne : message déposé en clair dans sa boîte aux lettres sur le master"
+    
     def request_path(self, target_user, nb_layers):
         """Demande d'un chemin de routage"""
         try:
             request = f"PATH:{self.username}:{nb_layers}:{target_user}"
-            self.master_socket.send(request.encode())
-            
-            response = self.master_socket.recv(4096).decode()
+            response = self.channel.request(request)
             
             if response.startswith("ERROR"):
                 if not self.gui_mode:
@@ -213,28 +564,58 @@ class ChatClient:
                     print("   X Invalid response format")
                 return None, None
             
-            path_part, target_part = response.split("||", 1)
-            
-            routers = []
-            for hop in path_part.split("|"):
-                if hop:
-                    ip, port, e, n = hop.split(";")
-                    routers.append({
-                        "ip": ip,
-                        "port": int(port),
-                        "pub_key": (int(e), int(n))
-                    })
-            
-            target_ip, target_port = target_part.split(";")
-            target_info = {"ip": target_ip, "port": int(target_port)}
-            
-            return routers, target_info
+            return self.parse_path(response)
             
         except Exception as e:
             if not self.gui_mode:
                 print(f"   X Path request error: {e}")
             return None, None
     
+    def request_paths(self, target_users, nb_layers):
+        """Demande des chemins vers plusieurs destinataires en une seule requête
+        
+        Retourne {destinataire: (routers, target_info)} ou {destinataire: message d'erreur}
+        Au-delà de PATHS_BATCH destinataires, la demande est découpée en plusieurs
+        requêtes envoyées ensemble sur le canal (réponses de taille bornée).
+        """
+        with MASTER_REQUEST_SECONDS.time(command="PATHS"):
+            futures = [
+                self.channel.submit(f"PATHS:{self.username}:{nb_layers}:{','.join(target_users[i:i + PATHS_BATCH])}")
+                for i in range(0, len(target_users), PATHS_BATCH)
+            ]
+            responses = [future.result(REQUEST_TIMEOUT) for future in futures]
+        
+        paths = {}
+        for response in responses:
+            for entry in response.split("\t"):
+                target, sep, path = entry.partition("=")
+                if not sep:
+                    continue
+                if path.startswith("ERROR") or "||" not in path:
+                    paths[target] = path or "ERROR:INVALID_RESPONSE"
+                else:
+                    paths[target] = self.parse_path(path)
+        return paths
+    
+    def parse_path(self, response):
+        """Décoder une réponse PATH : 'ip;port;e;n|...||ip;port'"""
+        path_part, target_part = response.split("||", 1)
+        
+        routers = []
+        for hop in path_part.split("|"):
+            if hop:
+                ip, port, e, n = hop.split(";")
+                routers.append({
+                    "ip": ip,
+                    "port": int(port),
+                    "pub_key": (int(e), int(n))
+                })
+        
+        target_ip, target_port = target_part.split(";")
+        target_info = {"ip": target_ip, "port": int(target_port)}
+        
+        return routers, target_info
+    
     def encrypt_message(self, message, pub_key):
         """Chiffrement RSA"""
         e, n = pub_key
@@ -248,20 +629,30 @@ class ChatClient:
     
     def build_onion(self, message, routers, target_info):
         """Construction du chiffrement oignon"""
-        current = message
+        with ONION_BUILD_SECONDS.time(layers=len(routers)):
+            return self._build_onion(message, routers, target_info)
+    
+    def _build_onion(self, message, routers, target_info):
+        """Oignon en octets : une couche par routeur, de la dernière à la première
+        
+        Chaque couche n'a que son en-tête (saut suivant + clé) chiffré en RSA ;
+        le contenu est chiffré avec la clé de la couche (voir onion.py).
+        message peut être du texte ou des octets (morceaux de fichier).
+        """
+        current = message.encode() if isinstance(message, str) else message
         
         for i in range(len(routers)-1, -1, -1):
             router = routers[i]
             
             if i == len(routers)-1:
-                next_hop = f"{target_info['ip']};{target_info['port']}"
+                next_hop = target_info
             else:
-                next_router = routers[i+1]
-                next_hop = f"{next_router['ip']};{next_router['port']}"
+                next_hop = routers[i+1]
             
-            layer = f"{next_hop}|{current}"
-            encrypted = self.encrypt_message(layer, router['pub_key'])
-            current = ",".join(str(x) for x in encrypted)
+            key = os.urandom(KEY_SIZE)
+            header = format_header(next_hop['ip'], next_hop['port'], key)
+            encrypted = self.encrypt_message(header, router['pub_key'])
+            current = pack_layer(encrypted, key, current)
         
         return current
     
@@ -274,13 +665,21 @@ class ChatClient:
         user_info = self.get_user_info(target_user)
         
         if not user_info:
+            # Hors ligne : le master garde le message jusqu'à sa prochaine inscription
+            result = self.mail_offline(target_user, message)
+            if result:
+                if not self.gui_mode:
+                    print(f"   {result[1]}")
+                return result
             error_msg = f"Utilisateur '{target_user}' introuvable"
             if not self.gui_mode:
                 print(f"   X {error_msg}")
             return False, error_msg
         
-        # En mode CLI, demander le nombre de couches
-        if not self.gui_mode:
+        # En mode CLI, demander le nombre de couches (sauf s'il est configuré)
+        if not self.gui_mode and self.default_layers:
+            nb_layers = self.default_layers
+        elif not self.gui_mode:
             while True:
                 try:
                     nb_layers_input = input(f"   Number of router layers: ")
@@ -294,6 +693,8 @@ class ChatClient:
         if not self.gui_mode:
             print(f"   Requesting path from master...")
         
+        trace_id = tracing.new_trace_id() if self.trace_sink else None
+        started = time.time()
         routers, target_info = self.request_path(target_user, nb_layers)
         
         if not routers:
@@ -306,20 +707,30 @@ class ChatClient:
             print(f"   Path obtained: {len(routers)} routers")
             print(f"   Building onion encryption...")
         
-        complete_message = f"{self.username}:{message}"
+        message_id = os.urandom(MESSAGE_ID_SIZE)
+        complete_message = f"{self.username}:".encode() + pack_text(message_id, message)
+        if len(complete_message) > MAX_FRAME:
+            error_msg = f"Message trop long ({format_size(len(complete_message))}, {format_size(MAX_FRAME)} au plus)"
+            if not self.gui_mode:
+                print(f"   X {error_msg}")
+            return False, error_msg
         onion = self.build_onion(complete_message, routers, target_info)
+        built = time.time()
         
         first_router = routers[0]
         
         if not self.gui_mode:
             print(f"   Sending to first router: {first_router['ip']}:{first_router['port']}")
         
+        # En file avant l'envoi : l'accusé de réception peut arriver très vite
+        self.delivery.track(message_id, target_user, message, nb_layers)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5.0)
-            sock.connect((first_router["ip"], first_router["port"]))
-            sock.send(onion.encode())
-            sock.close()
+            self.send_onion((first_router["ip"], first_router["port"]), onion, trace_id)
+            MESSAGES_SENT.inc(result="ok")
+            self.delivery.sent(message_id, routers)
+            if trace_id:
+                self.trace_sink.record(trace_id, f"client {self.username}", to=target_user,
+                                       started=started, built=built, sent=time.time())
             
             success_msg = f"Message sent successfully via {len(routers)} routers!"
             if not self.gui_mode:
@@ -328,81 +739,299 @@ class ChatClient:
             return True, success_msg
             
         except ConnectionRefusedError:
+            MESSAGES_SENT.inc(result="refused")
             error_msg = f"Router {first_router['ip']}:{first_router['port']} not available"
             if not self.gui_mode:
                 print(f"   X {error_msg}")
-            return False, error_msg
+            return self.retry_later(message_id, routers, error_msg)
         except socket.timeout:
+            MESSAGES_SENT.inc(result="timeout")
             error_msg = "Router connection timeout"
             if not self.gui_mode:
                 print(f"   X {error_msg}")
-            return False, error_msg
+            return self.retry_later(message_id, routers, error_msg)
         except Exception as e:
+            MESSAGES_SENT.inc(result="error")
             error_msg = f"Erreur d'envoi: {e}"
             if not self.gui_mode:
                 print(f"   X {error_msg}")
+            return self.retry_later(message_id, routers, error_msg)
+    
+    def retry_later(self, message_id, routers, error_msg):
+        """Premier routeur injoignable : le message reste en file et repartira par un autre chemin"""
+        if self.delivery.outbox is None:
             return False, error_msg
+        self.delivery.sent(message_id, routers[:1], failed=True)
+        return True, f"{error_msg} (nouvel essai automatique)"
+    
+    def send_onion(self, addr, onion, trace_id=None):
+        """Remettre un oignon au premier routeur (marqué du trace_id éventuel)"""
+        payload, kind = onion, FRAME_MESSAGE
+        if trace_id:
+            payload, kind = pack_traced(trace_id, payload), FRAME_TRACED
+        with SEND_SECONDS.time():
+            self.outbox.submit(addr, payload, kind).result(SEND_TIMEOUT)
+    
+    def send_payload(self, routers, target_info, body):
+        """Envoyer des octets bruts (messages de contrôle des transferts) sur un chemin déjà obtenu"""
+        onion = self.build_onion(f"{self.username}:".encode() + body, routers, target_info)
+        self.send_onion((routers[0]["ip"], routers[0]["port"]), onion)
+    
+    def send_file(self, target_user, path, nb_layers=1, progress=None):
+        """Envoi d'un fichier par morceaux (voir transfer.py) ; retourne (succès, statut)"""
+        if not self.gui_mode:
+            print(f"\nSending file '{os.path.basename(path)}' to '{target_user}'...")
+            if progress is None:
+                def progress(done, size, rate):
+                    sys.stdout.write(f"\r   {format_size(done)} / {format_size(size)} ({format_rate(rate)})   ")
+                    sys.stdout.flush()
+        
+        success, status = self.transfers.send_file(target_user, path, nb_layers, progress)
+        if not self.gui_mode:
+            print(f"\n   {'' if success else 'X '}{status}")
+        return success, status
+    
+    def send_many(self, targets, message, nb_layers=1):
+        """Envoi d'un même message à plusieurs destinataires
+        
+        Les chemins sont obtenus en une seule requête au Master, puis les
+        oignons sont construits et envoyés en parallèle sur des connexions
+        réutilisées. Retourne {destinataire: (succès, statut)}.
+        """
+        targets = list(dict.fromkeys(t for t in targets if t and t != self.username))
+        if not targets:
+            return {}
+        
+        started = time.time()
+        try:
+            paths = self.request_paths(targets, nb_layers)
+        except Exception as e:
+            error_msg = f"Impossible d'obtenir les chemins: {e}"
+            return {target: (False, error_msg) for target in targets}
+        
+        results = {}
+        
+        def deliver(target, routers, target_info):
+            trace_id = tracing.new_trace_id() if self.trace_sink else None
+            message_id = os.urandom(MESSAGE_ID_SIZE)
+            complete_message = f"{self.username}:".encode() + pack_text(message_id, message)
+            if len(complete_message) > MAX_FRAME:
+                return False, f"Message trop long ({format_size(len(complete_message))}, {format_size(MAX_FRAME)} au plus)"
+            onion = self.build_onion(complete_message, routers, target_info)
+            built = time.time()
+            first_router = routers[0]
+            self.delivery.track(message_id, target, message, nb_layers)
+            try:
+                self.send_onion((first_router["ip"], first_router["port"]), onion, trace_id)
+                MESSAGES_SENT.inc(result="ok")
+                self.delivery.sent(message_id, routers)
+                if trace_id:
+                    self.trace_sink.record(trace_id, f"client {self.username}", to=target,
+                                           started=started, built=built, sent=time.time())
+                return True, f"Message sent successfully via {len(routers)} routers!"
+            except ConnectionRefusedError:
+                MESSAGES_SENT.inc(result="refused")
+                return self.retry_later(message_id, routers, f"Router {first_router['ip']}:{first_router['port']} not available")
+            except socket.timeout:
+                MESSAGES_SENT.inc(result="timeout")
+                return self.retry_later(message_id, routers, "Router connection timeout")
+            except Exception as e:
+                MESSAGES_SENT.inc(result="error")
+                return self.retry_later(message_id, routers, f"Erreur d'envoi: {e}")
+        
+        with ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="sender") as pool:
+            futures = {}
+            for target in targets:
+                path = paths.get(target, "ERROR:TARGET_NOT_FOUND")
+                if path == "ERROR:TARGET_NOT_FOUND":
+                    # Hors ligne : le master garde le message jusqu'à sa prochaine inscription
+                    results[target] = self.mail_offline(target, message) or (False, f"Utilisateur '{target}' introuvable")
+                elif isinstance(path, str):
+                    results[target] = (False, f"Impossible d'obtenir un chemin ({path})")
+                else:
+                    futures[pool.submit(deliver, target, *path)] = target
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        
+        if not self.gui_mode:
+            sent = sum(1 for ok, _ in results.values() if ok)
+            print(f"   Sent to {sent}/{len(targets)} recipients")
+        return results
     
     def listen_for_messages(self, callback=None):
-        """Écoute des messages entrants"""
+        """Écoute des messages entrants
+        
+        Le thread d'écoute accepte les connexions et surveille celles que les
+        routeurs gardent ouvertes pour les réutiliser : une connexion n'est
+        confiée au pool borné de threads que lorsqu'une trame arrive, puis
+        revient à l'écoute. Une connexion inactive n'occupe donc aucun thread
+        et est fermée sans bruit après RECEIVE_TIMEOUT. Quand tous les
+        emplacements du pool sont occupés, l'écoute se met en pause
+        (contre-pression vers les routeurs).
+        """
+        slots = threading.BoundedSemaphore(RECEIVE_WORKERS + RECEIVE_BACKLOG)
+        pool = ThreadPoolExecutor(max_workers=RECEIVE_WORKERS, thread_name_prefix="receiver")
+        selector = selectors.DefaultSelector()
+        returned = deque()  # Connexions lues par le pool, à surveiller de nouveau
+        wakeup, wakeup_signal = socket.socketpair()
+        wakeup.setblocking(False)
+        wakeup_signal.setblocking(False)
+        idle = {}  # connexion surveillée -> dernière activité
+        
+        def worker(conn):
+            try:
+                keep = self.receive_connection(conn, callback)
+            finally:
+                slots.release()
+            if keep and self.running:
+                returned.append(conn)
+                try:
+                    wakeup_signal.send(b"\0")
+                except OSError:
+                    pass  # Réveil déjà en attente
+            else:
+                self.close_connection(conn)
+        
         try:
             server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             server.bind((self.ip, self.port))
-            server.listen(5)
+            server.listen(RECEIVE_BACKLOG)
+            server.setblocking(False)
+            selector.register(server, selectors.EVENT_READ)
+            selector.register(wakeup, selectors.EVENT_READ)
             
             if not self.gui_mode:
                 print(f"\nMessage listener started on {self.ip}:{self.port}")
             
             while self.running:
-                try:
-                    conn, addr = server.accept()
-                    data = conn.recv(8192).decode()
-                    conn.close()
-                    
-                    if data:
-                        if ":" in data:
-                            sender, message = data.split(":", 1)
-                            
-                            if callback and self.gui_mode:
-                                # Mode GUI - utiliser le callback
-                                current_time = datetime.now().strftime("%H:%M")
-                                callback(sender, message, current_time)
-                            elif not self.gui_mode:
-                                # Mode CLI - afficher directement
-                                print(f"\n", "="*50)
-                                print(f"NEW MESSAGE FROM {sender}")
-                                print(f"{'='*50}")
-                                print(f"{message}")
-                                print(f"{'='*50}")
-                                
-                                # Réafficher le prompt
-                                sys.stdout.write("\n>> ")
-                                sys.stdout.flush()
-                        else:
-                            if not self.gui_mode:
-                                print(f"\nReceived: {data}")
-                        
-                except:
-                    if not self.running:
-                        break
-                    pass
+                for key, _ in selector.select(timeout=RECEIVE_POLL):
+                    if key.fileobj is server:
+                        try:
+                            conn, addr = server.accept()
+                        except OSError:
+                            continue
+                        conn.setblocking(True)
+                        conn.settimeout(RECEIVE_TIMEOUT)
+                        CONNECTIONS_ACTIVE.inc()
+                        idle[conn] = time.monotonic()
+                        selector.register(conn, selectors.EVENT_READ)
+                    elif key.fileobj is wakeup:
+                        try:
+                            while wakeup.recv(4096):
+                                pass
+                        except OSError:
+                            pass
+                    else:
+                        # Trame arrivée : lue par le pool, la connexion quitte la surveillance
+                        conn = key.fileobj
+                        selector.unregister(conn)
+                        del idle[conn]
+                        slots.acquire()
+                        pool.submit(worker, conn)
+                now = time.monotonic()
+                while returned:
+                    conn = returned.popleft()
+                    idle[conn] = now
+                    selector.register(conn, selectors.EVENT_READ)
+                for conn, last_used in list(idle.items()):
+                    if now - last_used > RECEIVE_TIMEOUT:
+                        # Connexion réutilisable restée inactive : fermeture normale
+                        selector.unregister(conn)
+                        del idle[conn]
+                        self.close_connection(conn)
                 
         except Exception as e:
             if not self.gui_mode:
                 print(f"\nX Listener error: {e}")
         finally:
+            for conn in idle:
+                self.close_connection(conn)
+            selector.close()
+            wakeup.close()
+            wakeup_signal.close()
             if 'server' in locals():
                 server.close()
+            pool.shutdown(wait=False)
+    
+    def close_connection(self, conn):
+        """Fermer une connexion entrante"""
+        CONNECTIONS_ACTIVE.dec()
+        try:
+            conn.close()
+        except OSError:
+            pass
+    
+    def receive_connection(self, conn, callback=None):
+        """Lire les trames arrivées sur une connexion entrante
+        
+        Retourne True quand plus rien n'attend (connexion à surveiller de
+        nouveau), False quand elle est fermée ou en erreur.
+        """
+        try:
+            while True:
+                frame = recv_frame(conn)
+                if frame is None:
+                    return False
+                kind, data = frame
+                BYTES_IN.inc(len(data))
+                MESSAGES_RECEIVED.inc()
+                if kind == FRAME_TRACED:
+                    trace_id, data = unpack_traced(data)
+                    if self.trace_sink:
+                        self.trace_sink.record(trace_id, f"client {self.username}", received=time.time())
+                sender, sep, body = data.partition(b":")
+                if sep and body[:1] == CONTROL_PREFIX:
+                    # Message avec accusé de réception ou transfert de fichier
+                    sender = sender.decode(errors="replace")
+                    if body[1:2] and body[1] in DELIVERY_KINDS:
+                        notice = self.delivery.handle(sender, body)
+                    else:
+                        notice = self.transfers.handle(sender, body)
+                    if notice is not None:
+                        self.handle_incoming(f"{sender}:{notice}", callback)
+                else:
+                    self.handle_incoming(data.decode(errors="replace"), callback)
+                if not is_readable(conn):
+                    return True
+        except Exception as e:
+            if not self.gui_mode:
+                print(f"\nX Receive error: {type(e).__name__}: {e}")
+            return False
+    
+    def handle_incoming(self, data, callback=None):
+        """Traiter un message reçu (texte déchiffré 'expéditeur:message')"""
+        if not data:
+            return
+        if ":" in data:
+            sender, message = data.split(":", 1)
+            
+            if callback and self.gui_mode:
+                # Mode GUI - utiliser le callback
+                current_time = datetime.now().strftime("%H:%M")
+                callback(sender, message, current_time)
+            elif not self.gui_mode:
+                # Mode CLI - afficher directement
+                print(f"\n", "="*50)
+                print(f"NEW MESSAGE FROM {sender}")
+                print(f"{'='*50}")
+                print(f"{message}")
+                print(f"{'='*50}")
+                
+                # Réafficher le prompt
+                sys.stdout.write("\n>> ")
+                sys.stdout.flush()
+        else:
+            if not self.gui_mode:
+                print(f"\nReceived: {data}")
     
     def keep_alive(self, callback=None):
         """Maintien de la connexion"""
         while self.running:
             try:
-                if self.master_socket:
-                    self.master_socket.send(b"PING")
-                    response = self.master_socket.recv(1024)
-                    if response != b"PONG":
+                if self.channel:
+                    response = self.channel.request("PING")
+                    if response != "PONG":
                         self.running = False
                         if callback and self.gui_mode:
                             callback()
@@ -420,6 +1049,7 @@ class ChatClient:
     def start(self, message_callback=None, disconnect_callback=None):
         """Démarrer les threads"""
         self.running = True
+        metrics.serve_from_env("CLIENT", port=self.metrics_port)
         
         # Thread d'écoute
         listener_args = () if not self.gui_mode else (message_callback,)
@@ -440,22 +1070,44 @@ class ChatClient:
     def stop(self):
         """Arrêter proprement"""
         self.running = False
-        if self.master_socket:
+        self.delivery.close()
+        self.transfers.close()
+        self.outbox.close()
+        self.pool.close()
+        if self.trace_sink:
+            self.trace_sink.close()
+        if self.channel:
+            self.channel.close()
+        elif self.master_socket:
             try:
-                self.master_socket.send(b"QUIT")
                 self.master_socket.close()
             except:
                 pass
 
 
-def run_cli():
+def configure_client(client, args):
+    """Appliquer les options de lancement qui ne passent pas par register()"""
+    if args is not None:
+        client.default_layers = args.layers
+        client.metrics_port = args.metrics_port
+        client.trace_dir = args.trace_dir
+    return client
+
+
+def run_cli(args=None):
     """Interface en ligne de commande"""
     print("\n" + "="*60)
     print("ONION CHAT CLIENT - MODE LIGNE DE COMMANDE")
     print("="*60)
     
-    client = ChatClient()
-    success, _ = client.register()
+    client = configure_client(ChatClient(), args)
+    if args is not None and args.username and args.port:
+        # Lancement configuré : IP par défaut, sans saisie
+        args.ip = args.ip or "127.0.0.1"
+    if args is not None:
+        success, _ = client.register(args.username, args.ip, args.port, args.master_ip, args.master_port)
+    else:
+        success, _ = client.register()
     
     if not success:
         print("\nX Registration failed. Exiting.")
@@ -473,6 +1125,8 @@ def run_cli():
     print("Available commands:")
     print("  /list          - Show online users")
     print("  /msg <user>    - Send message to user")
+    print("  /group <u1,u2> - Send message to several users")
+    print("  /send <user> <file> - Send a file to user")
     print("  /quit          - Exit the chat")
     print("="*60)
     print("\nType your commands below:\n")
@@ -515,9 +1169,39 @@ def run_cli():
                 else:
                     print("\n/!\\ Usage: /msg <username> <message>")
                     
+            elif cmd.startswith("/group "):
+                parts = cmd.split(" ", 2)
+                if len(parts) == 3 and parts[2].strip():
+                    try:
+                        nb_layers = client.default_layers or int(input("   Number of router layers: "))
+                    except ValueError:
+                        nb_layers = 1
+                    results = client.send_many(parts[1].split(","), parts[2], max(nb_layers, 1))
+                    for target, (ok, status) in results.items():
+                        print(f"   {'OK' if ok else 'X'} {target}: {status}")
+                else:
+                    print("\n/!\\ Usage: /group <user1,user2,...> <message>")
+                    
+            elif cmd.startswith("/send "):
+                parts = cmd.split(" ", 2)
+                if len(parts) == 3 and parts[2].strip():
+                    path = os.path.expanduser(parts[2].strip().strip('"'))
+                    if parts[1] == client.username:
+                        print("\n/!\\ You can't send a file to yourself!")
+                    elif not os.path.isfile(path):
+                        print(f"\n/!\\ File not found: {path}")
+                    else:
+                        try:
+                            nb_layers = client.default_layers or int(input("   Number of router layers: "))
+                        except ValueError:
+                            nb_layers = 1
+                        client.send_file(parts[1], path, max(nb_layers, 1))
+                else:
+                    print("\n/!\\ Usage: /send <username> <path>")
+                    
             elif cmd:
                 print(f"\n/!\\ Unknown command: {cmd}")
-                print("   Available: /list, /msg, /quit")
+                print("   Available: /list, /msg, /group, /send, /quit")
                 
         except KeyboardInterrupt:
             print("\n\n/!\\ Interrupted. Type /quit to exit properly.")
@@ -531,14 +1215,16 @@ def run_cli():
 # PARTIE INTERFACE GRAPHIQUE (PyQt6)
 # ============================================================================
 
-def run_gui():
+def run_gui(args=None):
     """Lancer l'interface graphique"""
     try:
         from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                                    QHBoxLayout, QLabel, QLineEdit, QPushButton, 
-                                   QTextEdit, QComboBox, QMessageBox, QDialog)
-        from PyQt6.QtCore import Qt, pyqtSignal, QObject
-        from PyQt6.QtGui import QFont, QTextCursor
+                                   QComboBox, QMessageBox, QDialog, QListView,
+                                   QStyledItemDelegate, QAbstractItemView, QFileDialog)
+        from PyQt6.QtCore import (Qt, pyqtSignal, QObject, QRunnable, QThreadPool,
+                                  QAbstractListModel, QModelIndex, QRect, QSize)
+        from PyQt6.QtGui import QFont, QFontMetrics, QColor
         
         # Import supplémentaire pour la vérification du port
         import socket
@@ -553,10 +1239,234 @@ def run_gui():
             connection_lost = pyqtSignal()
             error_occurred = pyqtSignal(str)
         
+        class SendSignals(QObject):
+            """Signaux de fin d'envoi (émis depuis le pool de threads)"""
+            finished = pyqtSignal(object, bool, str)  # tâche, succès, statut
+            progress = pyqtSignal(object, str)  # tâche, avancement d'un envoi de fichier
+        
+        class SendTask(QRunnable):
+            """Envoi d'un message hors du thread de l'interface"""
+            
+            def __init__(self, client, recipient, message, nb_layers, time):
+                super().__init__()
+                self.client = client
+                self.recipient = recipient
+                self.message = message
+                self.nb_layers = nb_layers
+                self.time = time
+                self.signals = SendSignals()
+                self.setAutoDelete(False)  # La fenêtre garde la tâche jusqu'au signal de fin
+                
+            def run(self):
+                try:
+                    success, status = self.client.send_message(self.recipient, self.message, self.nb_layers)
+                except Exception as e:
+                    success, status = False, f"Erreur d'envoi: {e}"
+                self.signals.finished.emit(self, success, status)
+        
+        class FileTask(SendTask):
+            """Envoi d'un fichier hors du thread de l'interface"""
+            
+            def __init__(self, client, recipient, path, nb_layers, time):
+                size = os.path.getsize(path)
+                super().__init__(client, recipient, f"[Fichier] {os.path.basename(path)} ({format_size(size)})",
+                                 nb_layers, time)
+                self.path = path
+                
+            def on_progress(self, done, size, rate):
+                percent = done * 100 // size if size else 100
+                self.signals.progress.emit(self, f"{os.path.basename(self.path)} : {percent}% ({format_rate(rate)})")
+                
+            def run(self):
+                try:
+                    success, status = self.client.send_file(self.recipient, self.path, self.nb_layers, self.on_progress)
+                except Exception as e:
+                    success, status = False, f"Erreur d'envoi: {e}"
+                self.signals.finished.emit(self, success, status)
+        
+        class ChatModel(QAbstractListModel):
+            """Fenêtre glissante sur l'historique de la conversation affichée
+            
+            Ajout en O(1) en fin de liste. Au plus max_rows messages sont gardés
+            en mémoire : au-delà, les messages du côté opposé au chargement sont
+            retirés par paquets (ils restent dans le MessageStore) et has_older /
+            has_newer indiquent qu'il faut les relire en défilant.
+            """
+            
+            def __init__(self, max_rows=HISTORY_MAX_ROWS):
+                super().__init__()
+                self.rows = []
+                self.max_rows = max_rows
+                self.has_older = False
+                self.has_newer = False
+                
+            def rowCount(self, parent=QModelIndex()):
+                return 0 if parent.isValid() else len(self.rows)
+                
+            def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+                if not index.isValid():
+                    return None
+                row = self.rows[index.row()]
+                if role == Qt.ItemDataRole.UserRole:
+                    return row
+                if role == Qt.ItemDataRole.DisplayRole:
+                    return row["text"]
+                return None
+                
+            def _first(self):
+                """Index du premier message (après la bannière)"""
+                return 1 if self.rows and self.rows[0]["kind"] == "banner" else 0
+                
+            def _count(self):
+                return len(self.rows) - self._first()
+                
+            def oldest(self):
+                return self.rows[self._first()]["record"] if self._count() else None
+                
+            def newest(self):
+                return self.rows[-1]["record"] if self._count() else None
+                
+            def reset(self, banner, rows, has_older):
+                """Afficher une conversation : bannière (optionnelle) + derniers messages"""
+                self.beginResetModel()
+                self.rows = ([{"kind": "banner", "text": banner}] if banner else []) + rows
+                self.has_older = has_older
+                self.has_newer = False
+                self.endResetModel()
+                
+            def append(self, row):
+                """Ajouter un message en fin de conversation"""
+                position = len(self.rows)
+                self.beginInsertRows(QModelIndex(), position, position)
+                self.rows.append(row)
+                self.endInsertRows()
+                if self._count() > self.max_rows:
+                    self._trim_head(min(HISTORY_EVICT_CHUNK, self._count()))
+                    
+            def extend(self, rows, has_newer):
+                """Ajouter une page de messages plus récents (défilement vers le bas)"""
+                if rows:
+                    position = len(self.rows)
+                    self.beginInsertRows(QModelIndex(), position, position + len(rows) - 1)
+                    self.rows.extend(rows)
+                    self.endInsertRows()
+                self.has_newer = has_newer
+                if self._count() > self.max_rows:
+                    self._trim_head(self._count() - self.max_rows)
+                    
+            def prepend(self, rows, has_older):
+                """Insérer une page de messages plus anciens (défilement vers le haut)"""
+                first = self._first()
+                if rows:
+                    self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+                    self.rows[first:first] = rows
+                    self.endInsertRows()
+                self.has_older = has_older
+                if self._count() > self.max_rows:
+                    self._trim_tail(self._count() - self.max_rows)
+                    
+            def _trim_head(self, count):
+                """Retirer les count plus anciens messages de la mémoire"""
+                first = self._first()
+                self.beginRemoveRows(QModelIndex(), first, first + count - 1)
+                del self.rows[first:first + count]
+                self.endRemoveRows()
+                self.has_older = True
+                
+            def _trim_tail(self, count):
+                """Retirer les count plus récents messages de la mémoire"""
+                end = len(self.rows)
+                self.beginRemoveRows(QModelIndex(), end - count, end - 1)
+                del self.rows[end - count:]
+                self.endRemoveRows()
+                self.has_newer = True
+        
+        class BubbleDelegate(QStyledItemDelegate):
+            """Dessin des bulles de message (seules les lignes visibles sont peintes)"""
+            
+            PADDING = 10
+            MARGIN = 5
+            HEADER_SPACING = 3
+            
+            def __init__(self, view):
+                super().__init__(view)
+                self.view = view
+                self.body_font = QFont("Monospace", 11)
+                self.header_font = QFont("Monospace", 10)
+                self.header_font.setBold(True)
+                
+            def _bubble_width(self):
+                return max(int(self.view.viewport().width() * 0.7), 100)
+                
+            def _layout(self, row):
+                """Taille du texte et de l'en-tête d'un message"""
+                text_width = self._bubble_width() - 2 * self.PADDING
+                body = QFontMetrics(self.body_font).boundingRect(
+                    QRect(0, 0, text_width, 1000000),
+                    Qt.TextFlag.TextWordWrap, row["text"]
+                )
+                header_height = QFontMetrics(self.header_font).height()
+                return body, header_height
+                
+            def sizeHint(self, option, index):
+                row = index.data(Qt.ItemDataRole.UserRole)
+                width = self.view.viewport().width() - 2 * self.MARGIN
+                if row["kind"] == "banner":
+                    return QSize(width, QFontMetrics(self.header_font).height() + 2 * self.PADDING)
+                body, header_height = self._layout(row)
+                height = header_height + self.HEADER_SPACING + body.height() + 2 * self.PADDING + 2 * self.MARGIN
+                return QSize(width, height)
+                
+            def paint(self, painter, option, index):
+                row = index.data(Qt.ItemDataRole.UserRole)
+                rect = option.rect
+                painter.save()
+                
+                if row["kind"] == "banner":
+                    painter.setFont(self.header_font)
+                    painter.setPen(QColor("#89b4fa"))
+                    painter.drawText(rect, Qt.AlignmentFlag.AlignCenter, row["text"])
+                    painter.restore()
+                    return
+                    
+                body, header_height = self._layout(row)
+                bubble_width = body.width() + 2 * self.PADDING
+                if row["sent"]:
+                    color = "#a6e3a1"  # Vert pour les messages envoyés
+                    label = "Vous"
+                    x = rect.right() - bubble_width - self.MARGIN
+                    header_align = Qt.AlignmentFlag.AlignRight
+                else:
+                    color = "#89b4fa"  # Bleu pour les messages reçus
+                    label = row["sender"]
+                    x = rect.left() + self.MARGIN
+                    header_align = Qt.AlignmentFlag.AlignLeft
+                    
+                # En-tête : nom • heure
+                header_rect = QRect(rect.left() + self.MARGIN, rect.top() + self.MARGIN,
+                                    rect.width() - 2 * self.MARGIN, header_height)
+                painter.setFont(self.header_font)
+                painter.setPen(QColor(color))
+                painter.drawText(header_rect, header_align, f"{label} • {row['time']}")
+                
+                # Bulle
+                bubble = QRect(x, header_rect.bottom() + self.HEADER_SPACING,
+                               bubble_width, body.height() + 2 * self.PADDING)
+                painter.setRenderHint(painter.RenderHint.Antialiasing)
+                painter.setPen(Qt.PenStyle.NoPen)
+                painter.setBrush(QColor("#45475a"))
+                painter.drawRoundedRect(bubble, 10, 10)
+                
+                painter.setFont(self.body_font)
+                painter.setPen(QColor("#cdd6f4"))
+                painter.drawText(bubble.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING),
+                                 Qt.TextFlag.TextWordWrap, row["text"])
+                painter.restore()
+        
         class LoginWindow(QDialog):
             """Fenêtre de connexion"""
             
-            def __init__(self):
+            def __init__(self, defaults=None):
                 super().__init__()
                 self.username = None
                 self.ip = None
@@ -564,6 +1474,15 @@ def run_gui():
                 self.master_ip = None
                 self.master_port = None
                 self.init_ui()
+                if defaults is not None:
+                    # Champs pré-remplis par les options de lancement
+                    for field, value in ((self.username_input, defaults.username),
+                                         (self.ip_input, defaults.ip),
+                                         (self.port_input, defaults.port),
+                                         (self.master_ip_input, defaults.master_ip),
+                                         (self.master_port_input, defaults.master_port)):
+                        if value is not None:
+                            field.setText(str(value))
                 
             def init_ui(self):
                 self.setWindowTitle("Onion Chat - Connexion")
@@ -773,6 +1692,16 @@ def run_gui():
                 self.signals.message_received.connect(self.on_message_received)
                 self.signals.connection_lost.connect(self.on_connection_lost)
                 self.signals.error_occurred.connect(self.on_error)
+                self.client.delivery.on_result = self.on_delivery_result
+                
+                # Envois en cours (le réseau et le chiffrement ne bloquent pas l'interface)
+                self.send_pool = QThreadPool()
+                self.send_pool.setMaxThreadCount(4)
+                self.pending_sends = set()
+                self.file_progress = {}  # FileTask -> avancement affiché
+                
+                # Historique local des conversations
+                self.store = MessageStore.for_user(self.client.username)
                 
                 self.init_ui()
                 self.update_user_list()
@@ -787,7 +1716,7 @@ def run_gui():
                     QLabel {
                         color: #cdd6f4;
                     }
-                    QTextEdit {
+                    QListView {
                         background-color: #313244;
                         border: 2px solid #45475a;
                         border-radius: 10px;
@@ -897,10 +1826,16 @@ def run_gui():
                 
                 main_layout.addLayout(recipient_layout)
                 
-                # Zone de chat
-                self.chat_display = QTextEdit()
-                self.chat_display.setReadOnly(True)
-                self.chat_display.setFont(QFont("Monospace", 11))
+                # Zone de chat (modèle/vue : seules les lignes visibles sont dessinées)
+                self.chat_model = ChatModel()
+                self.chat_display = QListView()
+                self.chat_display.setModel(self.chat_model)
+                self.chat_display.setItemDelegate(BubbleDelegate(self.chat_display))
+                self.chat_display.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+                self.chat_display.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+                self.chat_display.setResizeMode(QListView.ResizeMode.Adjust)
+                self.chat_display.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+                self.chat_display.verticalScrollBar().valueChanged.connect(self.on_chat_scrolled)
                 main_layout.addWidget(self.chat_display, 1)
                 
                 # Zone d'envoi
@@ -936,8 +1871,20 @@ def run_gui():
                 send_btn.clicked.connect(self.send_message)
                 send_layout.addWidget(send_btn)
                 
+                # Bouton d'envoi de fichier
+                file_btn = QPushButton("📎")
+                file_btn.setFixedSize(50, 45)
+                file_btn.setToolTip("Envoyer un fichier")
+                file_btn.clicked.connect(self.send_file)
+                send_layout.addWidget(file_btn)
+                
                 main_layout.addLayout(send_layout)
                 
+                # Envois en cours
+                self.send_status = QLabel("")
+                self.send_status.setStyleSheet("color: #bac2de; font-size: 11px; font-style: italic;")
+                main_layout.addWidget(self.send_status)
+                
             def update_user_list(self):
                 """Met à jour la liste des utilisateurs"""
                 users = self.client.get_online_users()
@@ -959,11 +1906,57 @@ def run_gui():
                 """Changement de destinataire"""
                 if recipient and recipient != "-- Sélectionner un utilisateur --":
                     self.current_recipient = recipient
-                    self.chat_display.clear()
-                    self.chat_display.append(f"<div style='text-align: center; color: #89b4fa; font-weight: bold;'>")
-                    self.chat_display.append(f"═══ Conversation avec {recipient} ═══")
+                    self.load_conversation(recipient)
                 else:
                     self.current_recipient = None
+                    self.chat_model.reset(None, [], False)
+        
+            def load_conversation(self, recipient):
+                """Afficher les derniers messages d'une conversation"""
+                records = self.store.recent(recipient, HISTORY_PAGE)
+                self.chat_model.reset(f"═══ Conversation avec {recipient} ═══",
+                                      [self.to_row(r) for r in records],
+                                      len(records) == HISTORY_PAGE)
+                self.chat_display.scrollToBottom()
+        
+            def to_row(self, record):
+                """Ligne du modèle pour un message de l'historique"""
+                return {
+                    "kind": "message",
+                    "sender": record["sender"],
+                    "text": record["body"],
+                    "time": datetime.fromtimestamp(record["created_at"]).strftime("%H:%M"),
+                    "sent": record["sent"],
+                    "record": record
+                }
+        
+            def on_chat_scrolled(self, value):
+                """Chargement paresseux de l'historique aux extrémités"""
+                if not self.current_recipient:
+                    return
+                scrollbar = self.chat_display.verticalScrollBar()
+                if value == scrollbar.minimum() and self.chat_model.has_older:
+                    records = self.store.before(self.current_recipient, self.chat_model.oldest(), HISTORY_PAGE)
+                    old_maximum = scrollbar.maximum()
+                    self.chat_model.prepend([self.to_row(r) for r in records], len(records) == HISTORY_PAGE)
+                    # Garder à l'écran le message qui était en haut
+                    self.chat_display.doItemsLayout()
+                    scrollbar.setValue(value + scrollbar.maximum() - old_maximum)
+                elif value == scrollbar.maximum() and self.chat_model.has_newer:
+                    records = self.store.after(self.current_recipient, self.chat_model.newest(), HISTORY_PAGE)
+                    self.chat_model.extend([self.to_row(r) for r in records], len(records) == HISTORY_PAGE)
+        
+            def read_layers(self):
+                """Nombre de couches saisi, None (avec avertissement) s'il est invalide"""
+                try:
+                    nb_layers = int(self.layers_input.text())
+                    if nb_layers <= 0:
+                        QMessageBox.warning(self, "Erreur", "Le nombre de couches doit être positif")
+                        return None
+                except ValueError:
+                    QMessageBox.warning(self, "Erreur", "Nombre de couches invalide")
+                    return None
+                return nb_layers
         
             def send_message(self):
                 """Envoyer un message"""
@@ -975,57 +1968,95 @@ def run_gui():
                 if not message:
                     return
                     
-                try:
-                    nb_layers = int(self.layers_input.text())
-                    if nb_layers <= 0:
-                        QMessageBox.warning(self, "Erreur", "Le nombre de couches doit être positif")
-                        return
-                except ValueError:
-                    QMessageBox.warning(self, "Erreur", "Nombre de couches invalide")
+                nb_layers = self.read_layers()
+                if nb_layers is None:
                     return
                     
-                # Envoi du message
-                success, status = self.client.send_message(self.current_recipient, message, nb_layers)
+                # Envoi du message dans le pool de threads
+                current_time = datetime.now().strftime("%H:%M")
+                task = SendTask(self.client, self.current_recipient, message, nb_layers, current_time)
+                task.signals.finished.connect(self.on_send_finished)
+                self.pending_sends.add(task)
+                self.send_pool.start(task)
+                self.message_input.clear()
+                self.update_send_status()
+        
+            def send_file(self):
+                """Choisir un fichier et l'envoyer au destinataire sélectionné"""
+                if not self.current_recipient:
+                    QMessageBox.warning(self, "Erreur", "Veuillez sélectionner un destinataire")
+                    return
+                
+                nb_layers = self.read_layers()
+                if nb_layers is None:
+                    return
+                
+                path, _ = QFileDialog.getOpenFileName(self, f"Envoyer un fichier à {self.current_recipient}")
+                if not path:
+                    return
+                
+                current_time = datetime.now().strftime("%H:%M")
+                try:
+                    task = FileTask(self.client, self.current_recipient, path, nb_layers, current_time)
+                except OSError as e:
+                    QMessageBox.warning(self, "Erreur", f"Fichier illisible: {e}")
+                    return
+                task.signals.finished.connect(self.on_send_finished)
+                task.signals.progress.connect(self.on_file_progress)
+                self.pending_sends.add(task)
+                self.send_pool.start(task)
+                self.update_send_status()
+        
+            def on_file_progress(self, task, text):
+                """Avancement d'un envoi de fichier (exécuté dans le thread de l'interface)"""
+                if task in self.pending_sends:
+                    self.file_progress[task] = text
+                    self.update_send_status()
+        
+            def on_send_finished(self, task, success, status):
+                """Fin d'un envoi (exécuté dans le thread de l'interface)"""
+                self.pending_sends.discard(task)
+                self.file_progress.pop(task, None)
+                self.update_send_status()
                 
                 if success:
-                    # Afficher le message envoyé
-                    current_time = datetime.now().strftime("%H:%M")
-                    self.display_message(self.client.username, message, current_time, sent=True)
-                    self.message_input.clear()
+                    record = self.store.add(task.recipient, self.client.username, task.message, sent=True)
+                    # Afficher le message envoyé s'il concerne la conversation ouverte
+                    if task.recipient == self.current_recipient:
+                        self.display_message(record)
                 else:
-                    QMessageBox.critical(self, "Erreur d'envoi", status)
+                    QMessageBox.critical(self, "Erreur d'envoi", f"{status}\n\nMessage : {task.message}")
         
-            def display_message(self, sender, message, time, sent=False):
+            def update_send_status(self):
+                """Afficher le nombre d'envois en cours"""
+                count = len(self.pending_sends)
+                text = f"Envoi en cours ({count})..." if count else ""
+                if self.file_progress:
+                    text += " " + " | ".join(self.file_progress.values())
+                self.send_status.setText(text)
+        
+            def display_message(self, record):
                 """Afficher un message dans le chat"""
-                if sent:
-                    color = "#a6e3a1"  # Vert pour les messages envoyés
-                    align = "right"
-                    label = "Vous"
-                    margin_style = "margin-left: 30%; margin-right: 5px;"
-                else:
-                    color = "#89b4fa"  # Bleu pour les messages reçus
-                    align = "left"
-                    label = sender
-                    margin_style = "margin-right: 30%; margin-left: 5px;"
-                
-                html = f"""
-                <div style='text-align: {align};'>
-                    <div style='color: {color}; font-weight: bold; margin-bottom: 3px;'>{label} • {time}</div>
-                    <div style='background-color: #45475a; padding: 10px; border-radius: 10px; 
-                                text-align: left; {margin_style}'>
-                        {message}
-                    </div>
-                </div>
-                <br>
-                """
-                
-                self.chat_display.append(html)
-                self.chat_display.moveCursor(QTextCursor.MoveOperation.End)    
+                if self.chat_model.has_newer:
+                    # L'utilisateur lit l'historique : revenir à la fin de la conversation
+                    if record["sent"]:
+                        self.load_conversation(self.current_recipient)
+                    return
+                    
+                scrollbar = self.chat_display.verticalScrollBar()
+                at_bottom = scrollbar.value() >= scrollbar.maximum() - 5
+                
+                self.chat_model.append(self.to_row(record))
+                
+                # Suivre la fin de la conversation sauf si l'utilisateur lit plus haut
+                if at_bottom or record["sent"]:
+                    self.chat_display.scrollToBottom()
            
             def on_message_received(self, sender, message, time):
                 """Message reçu"""
+                record = self.store.add(sender, sender, message, sent=False)
                 if self.current_recipient and sender == self.current_recipient:
-                    self.display_message(sender, message, time, sent=False)
+                    self.display_message(record)
                 elif not self.current_recipient:
                     # Si aucun destinataire n'est sélectionné, afficher une notification
                     QMessageBox.information(self, "Nouveau message", 
@@ -1036,6 +2067,11 @@ def run_gui():
                 QMessageBox.warning(self, "Connexion perdue", "La connexion au serveur a été perdue")
                 self.close()
             
+            def on_delivery_result(self, target, message, delivered, status):
+                """Message remis après renvois ou abandonné (appelé hors du thread de l'interface)"""
+                if not delivered:
+                    self.signals.error_occurred.emit(f"{status}\n\nMessage : {message}")
+            
             def on_error(self, error_msg):
                 """Erreur"""
                 QMessageBox.critical(self, "Erreur", error_msg)
@@ -1052,19 +2088,21 @@ def run_gui():
             
             def closeEvent(self, event):
                 """Fermeture de la fenêtre"""
+                self.send_pool.waitForDone(int(SEND_TIMEOUT * 1000))
                 self.client.stop()
+                self.store.close()
                 event.accept()
         
         # Point d'entrée de l'interface graphique
         app = QApplication(sys.argv)
         
         # Fenêtre de connexion
-        login = LoginWindow()
+        login = LoginWindow(args)
         if login.exec() != QDialog.DialogCode.Accepted:
             return
         
         # Créer le client et se connecter
-        client = ChatClient()
+        client = configure_client(ChatClient(), args)
         client.gui_mode = True  # Mode GUI activé
         success, message = client.register(login.username, login.ip, login.port, 
                                           login.master_ip, login.master_port)
@@ -1099,8 +2137,43 @@ def run_gui():
     return True
 
 
-def main():
+def parse_args(argv=None):
+    """Options de démarrage (ligne de commande, environnement, fichier de configuration)"""
+    parser = argparse.ArgumentParser(description="Onion chat client")
+    parser.add_argument("--mode", choices=("gui", "cli"), help="interface (menu if missing)")
+    parser.add_argument("--username", help="user name")
+    parser.add_argument("--ip", help="listening IP (default: 127.0.0.1)")
+    parser.add_argument("--port", type=port_type, help="listening port (7001, 7002...)")
+    parser.add_argument("--master-ip", help=f"master server IP (default: {MASTER_IP})")
+    parser.add_argument("--master-port", type=port_type, help=f"master server port (default: {MASTER_PORT})")
+    parser.add_argument("--layers", type=int, help="router layers for CLI messages (asked if missing)")
+    parser.add_argument("--metrics-port", type=int, help="serve /metrics on this port (0 = any)")
+    parser.add_argument("--trace-dir", help="trace sent/received messages in this directory")
+    add_config_argument(parser)
+    args = parser.parse_args(argv)
+    return resolve(args, "client", {
+        "mode": (str, None),
+        "username": (str, None),
+        "ip": (str, None),
+        "port": (port_type, None),
+        "master_ip": (str, None),
+        "master_port": (port_type, None),
+        "layers": (int, None),
+        "metrics_port": (int, None),
+        "trace_dir": (str, None),
+    })
+
+
+def main(argv=None):
     """Fonction principale qui demande le mode d'interface"""
+    args = parse_args(argv)
+    if args.mode == "cli":
+        run_cli(args)
+        return
+    if args.mode == "gui":
+        run_gui(args)
+        return
+    
     print("\n" + "="*60)
     print("ONION CHAT CLIENT")
     print("="*60)
@@ -1115,12 +2188,12 @@ def main():
         
         if choice == "1":
             # Lancer l'interface graphique
-            run_gui()
+            run_gui(args)
             # Après fermeture de l'interface graphique, revenir au menu
             continue
         elif choice == "2":
             # Lancer l'interface en ligne de commande
-            run_cli()
+            run_cli(args)
             # Après fermeture du client CLI, revenir au menu
             continue
         elif choice == "3":
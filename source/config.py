@@ -0,0 +1,83 @@
+"""Configuration des points d'entrée (master, routeur, client) sans saisie
+
+Chaque paramètre est pris, dans l'ordre :
+  1. l'option de ligne de commande (--port 5001)
+  2. la variable d'environnement ONION_<SECTION>_<CLÉ> (ONION_ROUTER_PORT=5001)
+  3. le fichier de configuration (--config, ONION_CONFIG ou ./onion.ini), section [router]
+  4. la valeur par défaut
+
+Un paramètre resté sans valeur (None) est demandé au clavier comme avant.
+
+    [router]
+    ip = 127.0.0.1
+    port = 5001
+    master_ip = 127.0.0.1
+    master_port = 6000
+"""
+import argparse
+import configparser
+import os
+
+CONFIG_ENV = "ONION_CONFIG"
+DEFAULT_CONFIG_FILE = "onion.ini"
+
+
+def add_config_argument(parser):
+    parser.add_argument("--config", help=f"configuration file (default: ${CONFIG_ENV} or ./{DEFAULT_CONFIG_FILE})")
+
+
+def read_config_file(path=None):
+    """Lire le fichier INI ; un fichier explicitement demandé doit exister"""
+    explicit = path or os.environ.get(CONFIG_ENV)
+    path = explicit or DEFAULT_CONFIG_FILE
+    parser = configparser.ConfigParser()
+    if not os.path.exists(path):
+        if explicit:
+            raise SystemExit(f"X Configuration file not found: {path}")
+        return parser
+    parser.read(path, encoding="utf-8")
+    return parser
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ("1", "true", "yes", "on", "oui", "o"):
+        return True
+    if value in ("0", "false", "no", "off", "non", "n"):
+        return False
+    raise ValueError(f"Invalid boolean '{value}'")
+
+
+def resolve(args, section, options):
+    """Compléter args avec l'environnement, le fichier puis les défauts
+
+    options : {clé: (type, défaut)} ; la clé est le nom de l'attribut de args.
+    """
+    config = read_config_file(getattr(args, "config", None))
+    for key, (kind, default) in options.items():
+        value = getattr(args, key, None)
+        source = None
+        if value is None:
+            env_name = f"ONION_{section.upper()}_{key.upper()}"
+            if os.environ.get(env_name, "").strip():
+                value, source = os.environ[env_name].strip(), env_name
+            elif config.has_option(section, key):
+                value, source = config.get(section, key), f"[{section}] {key}"
+        if value is None:
+            value = default
+        elif source is not None:
+            try:
+                value = to_bool(value) if kind is bool else kind(value)
+            except (ValueError, argparse.ArgumentTypeError):
+                raise SystemExit(f"X Invalid value for {source}: {value!r}")
+        setattr(args, key, value)
+    return args
+
+
+def port_type(value):
+    port = int(value)
+    if not 1 <= port <= 65535:
+        raise argparse.ArgumentTypeError("port must be between 1 and 65535")
+    return port
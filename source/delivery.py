@@ -0,0 +1,336 @@
+"""Accusés de réception de bout en bout et file de renvoi des messages
+
+Un message texte part comme message de contrôle (voir transfer.py) portant un
+identifiant aléatoire :
+
+    TEXT       émetteur -> destinataire : id, texte (UTF-8)
+    DELIVERED  destinataire -> émetteur : id
+
+Le destinataire répond par son propre chemin (gardé DELIVERY_ROUTE_TTL
+secondes par expéditeur) et ignore les doublons. Côté émetteur, chaque
+message attend son accusé dans une file SQLite (outbox_<utilisateur>.db) :
+sans réponse, il est renvoyé sur un autre chemin après DELIVERY_TIMEOUT,
+puis avec un délai doublé à chaque essai, jusqu'à MAX_ATTEMPTS essais. Les
+messages encore en file au redémarrage du client sont renvoyés. Si le
+destinataire n'est plus en ligne, le message est confié à sa boîte aux
+lettres sur le master (voir master.py) et quitte la file.
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from transfer import pack_message
+
+MSG_TEXT = 4  # Numéros à la suite de ceux de transfer.py
+MSG_DELIVERED = 5
+DELIVERY_KINDS = (MSG_TEXT, MSG_DELIVERED)
+MESSAGE_ID_SIZE = 16
+
+DELIVERY_TIMEOUT = 10.0  # Attente de l'accusé avant le premier renvoi (s)
+RETRY_MAX_DELAY = 300.0  # Délai max entre deux essais (s)
+RETRY_JITTER = 0.2  # Délai tiré dans ±20 % pour ne pas renvoyer tous les messages ensemble
+MAX_ATTEMPTS = 6  # Essais avant abandon (10 + 20 + 40 + 80 + 160 s d'attente)
+PATH_ALTERNATIVES = 3  # Chemins demandés au master pour éviter les routeurs des essais précédents
+ACK_LAYERS = 3  # Couches des oignons d'accusé de réception
+ACK_WORKERS = 2  # Threads d'envoi des accusés, hors des threads de réception
+DELIVERY_ROUTE_TTL = 30.0  # Durée de réutilisation d'un chemin de réponse (s)
+SEEN_MAX = 4096  # Identifiants reçus gardés pour écarter les doublons
+
+DELIVERY_BUCKETS = metrics.LATENCY_BUCKETS + (10.0, 30.0, 60.0, 300.0, 900.0)
+DELIVERY_SECONDS = metrics.histogram("onion_client_delivery_seconds", "Envoi -> accusé de réception du destinataire",
+                                     buckets=DELIVERY_BUCKETS)
+DELIVERIES = metrics.counter("onion_client_deliveries_total", "Messages acquittés ou abandonnés", ("result",))
+DELIVERY_RETRIES = metrics.counter("onion_client_delivery_retries_total", "Renvois faute d'accusé de réception")
+OUTBOX_PENDING = metrics.gauge("onion_client_outbox_pending", "Messages en attente d'accusé de réception")
+
+
+def pack_text(message_id, text):
+    return pack_message(MSG_TEXT, message_id, text.encode())
+
+
+def retry_delay(attempts):
+    """Attente avant l'essai suivant : DELIVERY_TIMEOUT doublé à chaque essai, plafonné"""
+    delay = min(DELIVERY_TIMEOUT * 2 ** max(attempts - 1, 0), RETRY_MAX_DELAY)
+    return delay * random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
+
+
+class Outbox:
+    """Messages envoyés en attente d'accusé de réception (SQLite)"""
+
+    def __init__(self, path):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self._lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id BLOB PRIMARY KEY,
+                    target TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    layers INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    next_attempt REAL NOT NULL
+                )
+            """)
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next ON outbox(next_attempt)")
+            self.db.commit()
+
+    def add(self, message_id, target, body, layers, created_at):
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO outbox (id, target, body, layers, created_at, attempts, next_attempt) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (message_id, target, body, layers, created_at, created_at + DELIVERY_TIMEOUT)
+            )
+            self.db.commit()
+
+    def reschedule(self, message_id, attempts, next_attempt):
+        """Enregistrer un essai ; False si le message n'est plus en file (déjà acquitté)"""
+        with self._lock:
+            cur = self.db.execute("UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                                  (attempts, next_attempt, message_id))
+            self.db.commit()
+        return cur.rowcount > 0
+
+    def remove(self, message_id, target=None):
+        """Retirer un message (de target seulement, si précisé) ; retourne son enregistrement ou None"""
+        with self._lock:
+            row = self.db.execute("SELECT * FROM outbox WHERE id = ?", (message_id,)).fetchone()
+            if row is not None and target is not None and row["target"] != target:
+                row = None
+            if row is not None:
+                self.db.execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+                self.db.commit()
+        return dict(row) if row is not None else None
+
+    def due(self, now):
+        with self._lock:
+            rows = self.db.execute("SELECT * FROM outbox WHERE next_attempt <= ? ORDER BY next_attempt",
+                                   (now,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def next_due(self):
+        """Instant du prochain essai prévu (None si la file est vide)"""
+        with self._lock:
+            return self.db.execute("SELECT MIN(next_attempt) FROM outbox").fetchone()[0]
+
+    def count(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+class DeliveryManager:
+    """Accusés de réception et renvois d'un ChatClient"""
+
+    def __init__(self, client):
+        self.client = client
+        self.outbox = None  # Ouverte après l'inscription (fichier propre à l'utilisateur)
+        self.on_result = None  # on_result(destinataire, texte, acquitté, statut), hors renvoi immédiat
+        self.attempt_hops = {}  # id -> routeurs mis en cause si le dernier essai reste sans accusé
+        self.suspects = Counter()  # routeur -> essais ou accusés perdus en passant par lui
+        self.routes = {}  # expéditeur -> (chemin de réponse, expiration)
+        self.seen = OrderedDict()  # (expéditeur, id) reçus, pour écarter les doublons
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.acks = ThreadPoolExecutor(max_workers=ACK_WORKERS, thread_name_prefix="delivery-ack")
+        self.thread = None
+        self.running = False
+
+    def open(self, path):
+        """Ouvrir la file de l'utilisateur et renvoyer ce qui y restait"""
+        self.outbox = Outbox(path)
+        OUTBOX_PENDING.set(self.outbox.count())
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True, name="delivery")
+        self.thread.start()
+
+    # ---------- ENVOI ----------
+    def track(self, message_id, target, text, layers):
+        """Mettre un message en attente d'accusé (avant de l'envoyer : l'accusé peut être très rapide)"""
+        if self.outbox is None:
+            return
+        self.outbox.add(message_id, target, text, layers, time.time())
+        OUTBOX_PENDING.inc()
+
+    def sent(self, message_id, routers=None, attempts=1, failed=False):
+        """Noter un essai passé par routers ; failed (premier routeur injoignable) : prochain essai plus tôt"""
+        if self.outbox is None:
+            return
+        delay = retry_delay(1) / 2 if failed else retry_delay(attempts)
+        if self.outbox.reschedule(message_id, attempts, time.time() + delay):
+            with self.lock:
+                if routers:
+                    self.attempt_hops[message_id] = [(r["ip"], r["port"]) for r in routers]
+                self.wakeup.notify()
+
+    def _alternative_path(self, target, layers):
+        """Chemin passant le moins possible par les routeurs suspects
+
+        self.suspects compte, par routeur, les messages et accusés perdus en
+        passant par lui (tous messages confondus) : un routeur en panne est
+        dans tous, il pèse donc le plus lourd.
+        """
+        with self.lock:
+            avoid = Counter(self.suspects)
+        best, best_score = (None, None), None
+        for _ in range(PATH_ALTERNATIVES):
+            routers, target_info = self.client.request_path(target, layers)
+            if not routers:
+                break
+            score = sum(avoid[(r["ip"], r["port"])] for r in routers)
+            if best_score is None or score < best_score:
+                best, best_score = (routers, target_info), score
+            if not score:
+                break
+        return best
+
+    def _retry(self, entry):
+        message_id, attempts = entry["id"], entry["attempts"] + 1
+        if entry["attempts"] >= MAX_ATTEMPTS:
+            if self.outbox.remove(message_id):
+                OUTBOX_PENDING.dec()
+                DELIVERIES.inc(result="expired")
+                with self.lock:
+                    self.attempt_hops.pop(message_id, None)
+                self._report(entry, False, f"Message non remis à {entry['target']} après {entry['attempts']} essais")
+            return
+        with self.lock:
+            self.suspects.update(self.attempt_hops.pop(message_id, ()))
+        DELIVERY_RETRIES.inc()
+        routers, target_info = self._alternative_path(entry["target"], entry["layers"])
+        if not routers:
+            # Destinataire hors ligne : remis par le master à sa prochaine inscription
+            if self.client.deposit_mail(entry["target"], pack_text(message_id, entry["body"])) == "OK":
+                if self.outbox.remove(message_id):
+                    OUTBOX_PENDING.dec()
+                    DELIVERIES.inc(result="mailbox")
+                    self._report(entry, True, f"{entry['target']} hors ligne : message déposé en clair dans sa boîte aux lettres sur le master")
+                return
+            # Aucun routeur, ou boîte pleine : l'essai compte quand même
+            self.sent(message_id, attempts=attempts)
+            return
+        try:
+            self.client.send_payload(routers, target_info, pack_text(message_id, entry["body"]))
+        except OSError:
+            routers = routers[:1]  # Premier routeur injoignable : lui seul est en cause
+        self.sent(message_id, routers, attempts)
+
+    def _run(self):
+        """Renvoyer les messages dont l'accusé n'est pas arrivé à temps"""
+        while True:
+            with self.lock:
+                while self.running:
+                    next_due = self.outbox.next_due()
+                    now = time.time()
+                    if next_due is not None and next_due <= now:
+                        break
+                    self.wakeup.wait(None if next_due is None else next_due - now)
+                if not self.running:
+                    return
+            for entry in self.outbox.due(time.time()):
+                if not self.running:
+                    return
+                try:
+                    self._retry(entry)
+                except Exception as e:
+                    print(f"\nX Retry error for message to {entry['target']}: {type(e).__name__}: {e}")
+                    self.sent(entry["id"], attempts=entry["attempts"] + 1)
+
+    def _report(self, entry, delivered, status):
+        if self.on_result:
+            self.on_result(entry["target"], entry["body"], delivered, status)
+        elif not self.client.gui_mode:
+            print(f"\n   {'' if delivered else 'X '}{status}")
+
+    # ---------- RÉCEPTION ----------
+    def handle(self, sender, body):
+        """Traiter un message texte ou un accusé ; retourne le texte à afficher ou None"""
+        if len(body) < 2 + MESSAGE_ID_SIZE:
+            return None
+        kind = body[1]
+        message_id = bytes(body[2:2 + MESSAGE_ID_SIZE])
+        if kind == MSG_DELIVERED:
+            self._on_delivered(sender, message_id)
+            return None
+        if kind != MSG_TEXT:
+            return None
+        key = (sender, message_id)
+        with self.lock:
+            duplicate = key in self.seen
+            if duplicate:
+                # Notre accusé s'est perdu : le chemin de réponse gardé ne mène plus à l'expéditeur
+                self._drop_route(sender)
+            else:
+                self.seen[key] = True
+                if len(self.seen) > SEEN_MAX:
+                    self.seen.popitem(last=False)
+        try:
+            # Chemin au master et oignon : pas sur le thread de réception
+            self.acks.submit(self._acknowledge, sender, message_id)
+        except RuntimeError:
+            pass  # Client arrêté
+        if duplicate:
+            return None
+        return bytes(body[2 + MESSAGE_ID_SIZE:]).decode(errors="replace")
+
+    def _on_delivered(self, sender, message_id):
+        entry = self.outbox.remove(message_id, sender) if self.outbox else None
+        if entry is None:
+            return  # Accusé en double, ou d'un autre que le destinataire
+        OUTBOX_PENDING.dec()
+        DELIVERIES.inc(result="delivered")
+        DELIVERY_SECONDS.observe(time.time() - entry["created_at"])
+        with self.lock:
+            # Le dernier essai est passé : ses routeurs ne sont plus suspects
+            for hop in self.attempt_hops.pop(message_id, ()):
+                self.suspects.pop(hop, None)
+        if entry["attempts"] > 1:
+            self._report(entry, True, f"Message remis à {sender} après {entry['attempts']} essais")
+
+    def _drop_route(self, sender):
+        """Oublier le chemin de réponse (appelé avec self.lock) ; ses routeurs seront évités"""
+        route, _ = self.routes.pop(sender, (None, 0))
+        if route:
+            self.suspects.update((r["ip"], r["port"]) for r in route[0])
+
+    def _acknowledge(self, sender, message_id):
+        """Accusé de réception par notre propre chemin vers l'expéditeur"""
+        now = time.time()
+        with self.lock:
+            route, expires = self.routes.get(sender, (None, 0))
+        try:
+            if route is None or expires < now:
+                route = self._alternative_path(sender, ACK_LAYERS)
+                if not route[0]:
+                    return
+                with self.lock:
+                    self.routes[sender] = (route, now + DELIVERY_ROUTE_TTL)
+            self.client.send_payload(route[0], route[1], pack_message(MSG_DELIVERED, message_id))
+        except OSError as e:
+            with self.lock:
+                self._drop_route(sender)  # Nouveau chemin au prochain accusé
+            print(f"\nX Cannot acknowledge message to {sender}: {e}")
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
+        self.acks.shutdown(wait=False, cancel_futures=True)
+        if self.thread:
+            self.thread.join(5)
+        if self.outbox:
+            self.outbox.close()
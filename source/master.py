@@ -1,44 +1,42 @@
+import argparse
+import base64
 import sys
 import socket
 import threading
 import random
 import math
-import mariadb
 import time
-from datetime import datetime
+import queue
+from collections import deque
+from datetime import datetime, timedelta
+import metrics
+from config import add_config_argument, port_type, resolve
+from protocol import TEXT_MESSAGE_PREFIX, LineReader, format_line, is_text_message, pack_frame, parse_line
+from storage import StorageError, open_storage
 
-# Import PyQt6 uniquement si disponible
-try:
-    from PyQt6.QtWidgets import (
-        QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
-        QLabel, QTextEdit, QTableWidget, QTableWidgetItem, QTabWidget,
-        QHeaderView, QMessageBox, QDialog, QLineEdit, QPushButton
-    )
-    from PyQt6.QtCore import Qt, pyqtSignal, QObject, QTimer
-    from PyQt6.QtGui import QFont, QColor
-    PYQT_AVAILABLE = True
-except ImportError:
-    PYQT_AVAILABLE = False
-    print("[WARNING] PyQt6 non disponible - Mode GUI désactivé")
+# Logs
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = "INFO"  # Niveau minimum affiché
+LOG_FLUSH_INTERVAL = 0.1  # Livraison des logs par lots (secondes)
+LOG_SAMPLE_AFTER = 20  # Évènements fréquents gardés intégralement par seconde...
+LOG_SAMPLE_RATE = 100  # ...puis un sur LOG_SAMPLE_RATE
 
-# Configuration de la base de données
-DB_CONFIG = {
-    'host': 'localhost',
-    'database': 'routage_oignon',
-    'user': 'routage_user',
-    'password': 'wxcvbn%!',
-    'port': 3306
-}
+# Journal d'évènements (table logs)
+EVENT_TYPES = ("connexion", "deconnexion", "message_recu", "message_envoye", "erreur")
+EVENT_BUFFER_SIZE = 10000  # Évènements en attente max (au-delà : ignorés et comptés)
+EVENT_BATCH_SIZE = 500  # Évènements par INSERT groupé
+EVENT_FLUSH_INTERVAL = 1.0  # Écriture en base (secondes)
+EVENT_MAX_UPLOAD = 1024 * 1024  # Taille max d'un lot envoyé par un routeur
 
-# ---------- SIGNAUX (pour mode GUI) ----------
-if PYQT_AVAILABLE:
-    class MasterSignals(QObject):
-        """Signaux pour la communication entre threads"""
-        log_message = pyqtSignal(str)  # Pour les logs
-        router_connected = pyqtSignal(dict)  # Nouveau routeur
-        client_connected = pyqtSignal(str, dict)  # Nouveau client
-        client_disconnected = pyqtSignal(str)  # Client déconnecté
-        router_disconnected = pyqtSignal(int)  # Routeur déconnecté
+# Boîte aux lettres des utilisateurs hors ligne (table messages)
+MAILBOX_MAX_MESSAGE = 32 * 1024  # Taille max d'un message déposé (octets)
+MAILBOX_MAX_UPLOAD = 4 * 1024 * 1024  # Taille max d'un lot de messages non remis envoyé par un routeur
+MAILBOX_MAX_MESSAGES = 200  # Messages en attente max par destinataire
+MAILBOX_MAX_BYTES = 1024 * 1024  # Octets en attente max par destinataire
+MAILBOX_TTL = 7 * 24 * 3600  # Courrier supprimé après ce délai (secondes)
+MAILBOX_PURGE_INTERVAL = 60.0  # Suppression du courrier expiré, au plus une fois par intervalle (s)
+MAILBOX_CONNECT_ATTEMPTS = 10  # Essais de connexion à l'écoute du client qui vient de s'inscrire
+MAILBOX_CONNECT_DELAY = 0.5  # Attente avant chaque essai : le client écoute après l'inscription (s)
 
 # ---------- RSA ----------
 def generate_keys():
@@ -73,118 +71,301 @@ def is_prime(n):
         i += 6
     return True
 
-# ---------- CONNEXION BDD ----------
-def get_db():
-    """Se connecter à la base de données"""
+# ---------- BASE DE DONNÉES ----------
+def initialize_database(storage):
+    """Créer les tables si elles n'existent pas"""
     try:
-        conn = mariadb.connect(**DB_CONFIG)
-        return conn
-    except mariadb.Error as e:
-        print(f"[MASTER] X Database Error: {e}")
-        return None
+        storage.initialize()
+        print(f"[MASTER] Database tables created/verified ({storage.name})")
+        return True
+    except StorageError as e:
+        print(f"[MASTER] /!\\ Could not initialize {storage.name} database: {e}")
+        return False
 
-def initialize_database():
-    """Créer les tables si elles n'existent pas"""
-    db = get_db()
-    if db:
-        cur = db.cursor()
-        try:
-            # Table routers
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS routers (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    ip VARCHAR(45) NOT NULL,
-                    port INT NOT NULL,
-                    e BIGINT NOT NULL,
-                    n BIGINT NOT NULL,
-                    d BIGINT NOT NULL,
-                    registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                    UNIQUE KEY unique_router (ip, port)
-                )
-            """)
-            
-            # Table users
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    username VARCHAR(100) NOT NULL UNIQUE,
-                    ip VARCHAR(45) NOT NULL,
-                    port INT NOT NULL,
-                    public_key_e BIGINT NOT NULL,
-                    public_key_n BIGINT NOT NULL,
-                    is_online BOOLEAN DEFAULT FALSE,
-                    registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Table messages (optionnelle)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    sender_username VARCHAR(100),
-                    receiver_username VARCHAR(100),
-                    encrypted_message TEXT,
-                    decrypted_message TEXT,
-                    path TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+def clear_database_tables(storage):
+    """Nettoyer toutes les tables dans la base de données au lancement"""
+    try:
+        tables = storage.clear()
+        if tables:
+            print(f"[MASTER] Cleared {len(tables)} tables: {', '.join(tables)}")
+        else:
+            print(f"[MASTER] No tables found in database")
+    except StorageError as e:
+        print(f"[MASTER] X Error clearing tables: {e}")
+
+# ---------- LOGS ----------
+class LogPipeline:
+    """Chaîne de logs structurés du Master
+    
+    Les threads du serveur déposent des enregistrements (horodatage, niveau,
+    évènement, message) dans une file sans verrou applicatif ; un thread unique
+    les formate et les livre par lots au sink (stdout ou signal GUI). Les
+    évènements fréquents (par clé 'event') sont échantillonnés au-delà de
+    sample_after par seconde, au moment de la livraison : le nombre d'écartés
+    est annoncé à chaque livraison et à l'arrêt.
+    """
+    
+    def __init__(self, sink, level=LOG_LEVEL, flush_interval=LOG_FLUSH_INTERVAL,
+                 sample_after=LOG_SAMPLE_AFTER, sample_rate=LOG_SAMPLE_RATE):
+        self.sink = sink
+        self.level = LOG_LEVELS[level]
+        self.flush_interval = flush_interval
+        self.sample_after = sample_after
+        self.sample_rate = sample_rate
+        self.queue = queue.SimpleQueue()
+        self.windows = {}  # évènement -> [début de la seconde, vus, écartés] (sous self.lock)
+        self.lock = threading.Lock()  # flush() : thread de livraison et close()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        
+    def emit(self, message, level="INFO", event=None):
+        """Déposer un enregistrement (appelable depuis n'importe quel thread)"""
+        if LOG_LEVELS[level] < self.level:
+            return
+        self.queue.put((time.time(), level, message, event))
+        
+    def _sample(self, event, now):
+        """Garder tous les évènements jusqu'au seuil, puis un sur sample_rate (sous self.lock)"""
+        window = self.windows.get(event)
+        if window is None or now - window[0] >= 1.0:
+            window = self.windows[event] = [now, 0, window[2] if window else 0]
+        window[1] += 1
+        if window[1] <= self.sample_after or window[1] % self.sample_rate == 0:
+            return True
+        window[2] += 1
+        return False
+        
+    def format(self, record):
+        timestamp, level, message = record
+        prefix = datetime.fromtimestamp(timestamp).strftime("%H:%M:%S")
+        if level == "INFO":
+            return f"[{prefix}] {message}"
+        return f"[{prefix}] {level}: {message}"
+        
+    def flush(self):
+        """Livrer d'un coup tout ce qui est en file, puis le nombre d'évènements écartés"""
+        with self.lock:
+            lines = []
+            while True:
+                try:
+                    timestamp, level, message, event = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if event is None or self._sample(event, timestamp):
+                    lines.append(self.format((timestamp, level, message)))
+            now = time.time()
+            for event, window in list(self.windows.items()):
+                if window[2]:
+                    lines.append(self.format((now, "INFO", f"({window[2]} '{event}' events sampled out)")))
+                    window[2] = 0
+                if now - window[0] >= 1.0:
+                    del self.windows[event]
+            if lines:
+                self.sink(lines)
+            
+    def _run(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            self.flush()
             
-            # Table pour les connexions/routes
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS routes (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    route_id VARCHAR(50) NOT NULL,
-                    hops TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+    def close(self):
+        """Arrêter le thread après une dernière livraison"""
+        self.running = False
+        self.flush()
+
+# ---------- MÉTRIQUES ----------
+REGISTRATIONS = metrics.counter("onion_master_registrations_total", "Inscriptions acceptées", ("kind",))
+UNREGISTRATIONS = metrics.counter("onion_master_unregistrations_total", "Désinscriptions", ("kind",))
+COMMANDS = metrics.counter("onion_master_commands_total", "Commandes reçues sur le canal de contrôle", ("command",))
+PATH_REQUESTS = metrics.counter("onion_master_path_requests_total", "Chemins demandés", ("result",))
+PATH_SECONDS = metrics.histogram("onion_master_path_seconds", "Calcul d'un chemin")
+CONNECTIONS_ACTIVE = metrics.gauge("onion_master_active_connections", "Connexions ouvertes", ("kind",))
+ROUTERS_ONLINE = metrics.gauge("onion_master_routers", "Routeurs enregistrés")
+CLIENTS_ONLINE = metrics.gauge("onion_master_clients", "Clients connectés")
+COMMAND_NAMES = ("QUIT", "LIST", "GET", "PATH", "PATHS", "PING", "MAIL")
+EVENTS_LOGGED = metrics.counter("onion_master_events_total", "Évènements du journal", ("outcome",))
+MAILBOX_DEPOSITS = metrics.counter("onion_master_mailbox_deposits_total", "Dépôts dans la boîte aux lettres", ("result",))
+MAILBOX_DELIVERED = metrics.counter("onion_master_mailbox_delivered_total", "Messages remis depuis la boîte aux lettres")
+MAILBOX_EXPIRED = metrics.counter("onion_master_mailbox_expired_total", "Messages expirés avant d'être remis")
+
+# ---------- JOURNAL D'ÉVÈNEMENTS ----------
+class EventLog:
+    """Évènements du master et des routeurs persistés dans la table logs
+    
+    record() ne fait qu'ajouter à un tampon borné ; un thread écrit les
+    évènements par INSERT groupés. Quand le tampon est plein, les nouveaux
+    évènements sont ignorés et comptés dans dropped.
+    """
+    
+    def __init__(self, storage, capacity=EVENT_BUFFER_SIZE, batch_size=EVENT_BATCH_SIZE,
+                 flush_interval=EVENT_FLUSH_INTERVAL):
+        self.storage = storage
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = deque()
+        self.lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0  # Tampon plein
+        self.failed = 0  # Écriture en base impossible
+        self.running = False
+        self.thread = None
+        
+    def record(self, event_type, message, router_id=None, timestamp=None):
+        """Ajouter un évènement (appelable depuis n'importe quel thread)"""
+        if event_type not in EVENT_TYPES:
+            event_type = "erreur"
+        when = datetime.fromtimestamp(timestamp if timestamp is not None else time.time())
+        with self.lock:
+            if len(self.buffer) >= self.capacity:
+                self.dropped += 1
+                EVENTS_LOGGED.inc(outcome="dropped")
+                return
+            self.buffer.append((router_id, event_type, message, when))
             
-            db.commit()
-            print(f"[MASTER] Database tables created/verified")
-        except mariadb.Error as e:
-            print(f"[MASTER] X Database initialization error: {e}")
-            db.rollback()
-        finally:
-            db.close()
-    else:
-        print("[MASTER] /!\\ Could not connect to database for initialization")
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        
+    def _run(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            self.flush()
+            
+    def flush(self):
+        """Écrire tout le tampon, par lots de batch_size"""
+        while True:
+            with self.lock:
+                count = min(len(self.buffer), self.batch_size)
+                batch = [self.buffer.popleft() for _ in range(count)]
+            if not batch:
+                return
+            try:
+                self.storage.add_events(batch)
+                self.written += len(batch)
+                EVENTS_LOGGED.inc(len(batch), outcome="written")
+            except StorageError as e:
+                print(f"[MASTER] X Event log write error: {e}")
+                self.failed += len(batch)
+                EVENTS_LOGGED.inc(len(batch), outcome="failed")
+                return
+                
+    def stop(self):
+        """Arrêter le thread après une dernière écriture"""
+        self.running = False
+        self.flush()
 
-def clear_database_tables():
-    """Nettoyer toutes les tables dans la base de données au lancement"""
-    db = get_db()
-    if db:
-        cur = db.cursor()
+# ---------- BOÎTE AUX LETTRES ----------
+class Mailbox:
+    """Courrier des utilisateurs hors ligne, gardé dans la table messages
+    
+    Un message que le dernier routeur n'a pas pu remettre (écoute du client
+    injoignable) ou qu'un client adresse à un utilisateur hors ligne (commande
+    MAIL) est déposé tel que le client l'aurait reçu ("expéditeur:contenu"),
+    dans la limite de max_messages / max_bytes par destinataire. Il est remis
+    en une seule connexion quand le destinataire se réinscrit ; au-delà de ttl
+    secondes, il est supprimé.
+    
+    Le courrier n'est PAS chiffré : le master lit et garde l'expéditeur, le
+    destinataire et le texte. Les clients n'ont pas de clé à eux (leur paire
+    RSA est tirée par le master à l'inscription), il n'y a donc rien avec quoi
+    chiffrer pour le seul destinataire. Le dépôt par MAIL passe en outre par
+    le canal de contrôle, hors du circuit de routeurs.
+    """
+    
+    def __init__(self, storage, log, max_messages=MAILBOX_MAX_MESSAGES, max_bytes=MAILBOX_MAX_BYTES,
+                 ttl=MAILBOX_TTL):
+        self.storage = storage
+        self.log = log
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.last_purge = 0.0
+        self.lock = threading.Lock()
+        self.delivering = set()  # Destinataires en cours de remise
+        
+    def deposit(self, receiver, sender, payload):
+        """Déposer un message ; retourne la réponse à renvoyer ("OK" ou "ERROR:...")"""
+        if len(payload) > MAILBOX_MAX_MESSAGE:
+            MAILBOX_DEPOSITS.inc(result="too_large")
+            return "ERROR:TOO_LARGE"
         try:
-            cur.execute("SHOW TABLES")
-            tables = cur.fetchall()
-            if tables:
-                print(f"[MASTER] Clearing {len(tables)} tables...")
-                cur.execute("SET FOREIGN_KEY_CHECKS = 0")
-                for table in tables:
-                    table_name = table[0]
-                    cur.execute(f"TRUNCATE TABLE {table_name}")
-                    print(f"[MASTER] Cleared table: {table_name}")
-                cur.execute("SET FOREIGN_KEY_CHECKS = 1")
-                db.commit()
-                print(f"[MASTER] All tables cleared successfully")
+            self.purge()
+            count, size = self.storage.mailbox_usage(receiver)
+            if count >= self.max_messages or size + len(payload) > self.max_bytes:
+                MAILBOX_DEPOSITS.inc(result="quota")
+                self.log(f"/!\\ Mailbox of '{receiver}' is full ({count} messages)", "WARNING", event="mailbox")
+                return "ERROR:QUOTA"
+            stored = self.storage.add_mail(receiver, sender, payload, datetime.now())
+        except StorageError as e:
+            MAILBOX_DEPOSITS.inc(result="error")
+            self.log(f"X Mailbox error: {e}", "ERROR")
+            return "ERROR:DB_CONNECTION"
+        # Un renvoi identique (même message, autre essai) n'est gardé qu'une fois
+        MAILBOX_DEPOSITS.inc(result="stored" if stored else "duplicate")
+        if stored:
+            self.log(f"Mail from '{sender}' kept for '{receiver}'", event="mailbox")
+        return "OK"
+        
+    def pending(self, receiver):
+        """Nombre de messages en attente pour receiver"""
+        try:
+            return self.storage.mailbox_usage(receiver)[0]
+        except StorageError:
+            return 0
+        
+    def purge(self):
+        """Supprimer le courrier expiré (au plus une fois par MAILBOX_PURGE_INTERVAL)"""
+        now = time.time()
+        with self.lock:
+            if now - self.last_purge < MAILBOX_PURGE_INTERVAL:
+                return
+            self.last_purge = now
+        expired = self.storage.purge_mail(datetime.now() - timedelta(seconds=self.ttl))
+        if expired:
+            MAILBOX_EXPIRED.inc(expired)
+            self.log(f"{expired} expired mail(s) deleted", event="mailbox")
+        
+    def deliver(self, username, ip, port):
+        """Remettre d'un coup le courrier d'un utilisateur qui vient de s'inscrire (thread dédié)"""
+        with self.lock:
+            if username in self.delivering:
+                return
+            self.delivering.add(username)
+        try:
+            self.purge()
+            mail = self.storage.fetch_mail(username)
+            if not mail:
+                return
+            data = b"".join(pack_frame(payload) for _, payload in mail)
+            for _ in range(MAILBOX_CONNECT_ATTEMPTS):
+                time.sleep(MAILBOX_CONNECT_DELAY)
+                try:
+                    with socket.create_connection((ip, port), timeout=5.0) as sock:
+                        sock.sendall(data)
+                    break
+                except OSError:
+                    continue
             else:
-                print(f"[MASTER] No tables found in database")
-        except mariadb.Error as e:
-            print(f"[MASTER] X Error clearing tables: {e}")
-            db.rollback()
+                self.log(f"/!\\ Cannot deliver mail to '{username}' at {ip}:{port}", "WARNING")
+                return
+            self.storage.delete_mail([mail_id for mail_id, _ in mail])
+            MAILBOX_DELIVERED.inc(len(mail))
+            self.log(f"Delivered {len(mail)} mail(s) to '{username}'")
+        except StorageError as e:
+            self.log(f"X Mailbox error: {e}", "ERROR")
         finally:
-            db.close()
-    else:
-        print("[MASTER] /!\\ Could not connect to database for cleanup")
+            with self.lock:
+                self.delivering.discard(username)
 
 # ---------- MASTER SERVER ----------
 class MasterServer:
     """Gestion du serveur Master"""
     
-    def __init__(self, gui_mode=False, host="127.0.0.1", port=6000):
+    def __init__(self, gui_mode=False, host="127.0.0.1", port=6000, log_level=LOG_LEVEL, storage=None,
+                 metrics_port=None):
         self.routers = []
         self.users = {}
         self.online_users = {}
@@ -193,21 +374,34 @@ class MasterServer:
         self.port = port
         self.host = host
         self.gui_mode = gui_mode
+        self.metrics_port = metrics_port
         
-        if gui_mode and PYQT_AVAILABLE:
+        if gui_mode:
+            from master_gui import MasterSignals
             self.signals = MasterSignals()
         else:
             self.signals = None
         
-    def log(self, message):
-        """Envoyer un log via signal (GUI) ou print (shell)"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        formatted_msg = f"[{timestamp}] {message}"
-        
+        self.logs = LogPipeline(self._deliver_logs, level=log_level)
+        self.storage = storage or open_storage()
+        self.events = EventLog(self.storage)
+        self.mailbox = Mailbox(self.storage, self.log)
+        self.known_users = set()  # Utilisateurs inscrits depuis le lancement (courrier accepté)
+        self.addresses = {}  # (ip, port) -> dernier utilisateur inscrit à cette adresse
+        
+    def log(self, message, level="INFO", event=None):
+        """Enregistrer un log (livré par lots via signal (GUI) ou print (shell))"""
+        self.logs.emit(message, level, event)
+        if level == "ERROR":
+            self.events.record("erreur", message)
+        
+    def _deliver_logs(self, lines):
+        """Sink de la chaîne de logs"""
         if self.gui_mode and self.signals:
-            self.signals.log_message.emit(formatted_msg)
+            self.signals.log_batch.emit(lines)
         else:
-            print(formatted_msg)
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
         
     def handle_router(self, conn):
         """Gérer l'enregistrement des routeurs"""
@@ -225,17 +419,12 @@ class MasterServer:
                 d, _ = priv
                 
                 # Sauvegarde en BDD
-                db = get_db()
-                if db:
-                    cur = db.cursor()
-                    cur.execute(
-                        "INSERT INTO routers (ip, port, e, n, d) VALUES (?, ?, ?, ?, ?)",
-                        (ip, port, e, n, d)
-                    )
-                    router_id = cur.lastrowid
-                    db.commit()
-                    db.close()
-                    
+                try:
+                    router_id = self.storage.add_router(ip, port, e, n, d)
+                except StorageError as db_error:
+                    self.log(f"X Database error: {db_error}", "ERROR")
+                    router_id = None
+                if router_id is not None:
                     # Ajout dans la liste
                     router_info = {
                         "id": router_id,
@@ -253,6 +442,9 @@ class MasterServer:
                     conn.send(response.encode())
                     
                     self.log(f"Router {ip}:{port} registered (ID: {router_id})")
+                    self.events.record("connexion", f"Router {ip}:{port} registered", router_id)
+                    REGISTRATIONS.inc(kind="router")
+                    ROUTERS_ONLINE.set(len(self.routers))
                     
                     if self.gui_mode and self.signals:
                         self.signals.router_connected.emit(router_info)
@@ -261,7 +453,7 @@ class MasterServer:
             else:
                 conn.send(b"ERROR:INVALID_FORMAT")
         except Exception as e:
-            self.log(f"X Router handler error: {e}")
+            self.log(f"X Router handler error: {e}", "ERROR")
             conn.send(b"ERROR:INTERNAL")
         finally:
             conn.close()
@@ -278,23 +470,23 @@ class MasterServer:
             self.routers = [r for r in self.routers if r["id"] != router_id]
             
             # Supprimer de la BDD
-            db = get_db()
-            if db:
-                cur = db.cursor()
-                cur.execute("DELETE FROM routers WHERE id = ?", (router_id,))
-                db.commit()
-                db.close()
-                
+            try:
+                self.storage.remove_router(router_id)
+            except StorageError as db_error:
+                self.log(f"X Database error: {db_error}", "ERROR")
+                conn.send(b"ERROR:DB_CONNECTION")
+            else:
                 conn.send(b"OK")
                 self.log(f"Router ID {router_id} unregistered successfully")
+                self.events.record("deconnexion", f"Router ID {router_id} unregistered")
+                UNREGISTRATIONS.inc(kind="router")
+                ROUTERS_ONLINE.set(len(self.routers))
                 
                 if self.gui_mode and self.signals:
                     self.signals.router_disconnected.emit(router_id)
-            else:
-                conn.send(b"ERROR:DB_CONNECTION")
                 
         except Exception as e:
-            self.log(f"X Unregister router error: {e}")
+            self.log(f"X Unregister router error: {e}", "ERROR")
             conn.send(b"ERROR:INTERNAL")
         finally:
             conn.close()
@@ -302,6 +494,7 @@ class MasterServer:
     def handle_client(self, conn):
         """Gérer la connexion et l'enregistrement du Client"""
         username = None
+        registered = False  # Nettoyage à la déconnexion seulement si l'utilisateur a été enregistré
         try:
             conn.settimeout(10.0)
             data = conn.recv(1024).decode().strip()
@@ -319,30 +512,14 @@ class MasterServer:
                     e, n = pub
                     
                     # Sauvegarder en BDD
-                    db = get_db()
-                    if not db:
+                    try:
+                        self.storage.save_user(username, ip, port, e, n)
+                    except StorageError as db_error:
+                        self.log(f"X Database error: {db_error}", "ERROR")
                         conn.send(b"ERROR:DB_CONNECTION")
                         conn.close()
                         return
                     
-                    cur = db.cursor()
-                    cur.execute("SELECT username FROM users WHERE username = ?", (username,))
-                    if cur.fetchone():
-                        cur.execute("""
-                            UPDATE users SET
-                            ip=?, port=?, public_key_e=?, public_key_n=?, is_online=TRUE,
-                            last_seen=NOW()
-                            WHERE username=?
-                        """, (ip, port, e, n, username))
-                    else:
-                        cur.execute("""
-                            INSERT INTO users
-                            (username, ip, port, public_key_e, public_key_n, is_online)
-                            VALUES (?, ?, ?, ?, ?, TRUE)
-                        """, (username, ip, port, e, n))
-                    db.commit()
-                    db.close()
-                    
                     # Stocker en mémoire
                     self.users[username] = {
                         "ip": ip,
@@ -352,12 +529,22 @@ class MasterServer:
                         "active": True
                     }
                     self.online_users[username] = True
+                    self.known_users.add(username)
+                    self.addresses[(ip, port)] = username
+                    registered = True
+                    REGISTRATIONS.inc(kind="client")
+                    CONNECTIONS_ACTIVE.inc(kind="client")
                     
                     # Envoyer succès
                     response = f"OK:{e}:{n}"
                     conn.send(response.encode())
                     
+                    # Courrier reçu pendant l'absence, remis dès que le client écoute
+                    threading.Thread(target=self.mailbox.deliver, args=(username, ip, port), daemon=True).start()
+                    
                     self.log(f"User '{username}' registered at {ip}:{port}")
+                    self.events.record("connexion", f"User '{username}' registered at {ip}:{port}")
+                    CLIENTS_ONLINE.set(len(self.users))
                     
                     if self.gui_mode and self.signals:
                         self.signals.client_connected.emit(username, self.users[username])
@@ -365,65 +552,63 @@ class MasterServer:
                     # Supprimer le timeout
                     conn.settimeout(None)
                     
-                    # Boucle de commandes
+                    # Boucle de commandes (une commande par ligne, "ID#COMMANDE")
+                    reader = LineReader(conn)
                     try:
                         while True:
-                            cmd_data = conn.recv(1024).decode().strip()
-                            if not cmd_data:
+                            line = reader.readline()
+                            if line is None:
                                 self.log(f"Client '{username}' disconnected")
                                 break
+                            if not line:
+                                continue
+                            
+                            request_id, cmd_data = parse_line(line)
+                            command = cmd_data.split(":", 1)[0]
+                            COMMANDS.inc(command=command if command in COMMAND_NAMES else "other")
+                            
+                            def reply(payload):
+                                conn.sendall(format_line(payload, request_id))
                                 
                             if cmd_data == "QUIT":
                                 self.log(f"Client '{username}' quit")
                                 break
                             elif cmd_data == "LIST":
                                 user_list = list(self.users.keys())
-                                response = f"ONLINE:{','.join(user_list)}"
-                                conn.send(response.encode())
-                                self.log(f"Sent user list to '{username}'")
+                                reply(f"ONLINE:{','.join(user_list)}")
+                                self.log(f"Sent user list to '{username}'", "DEBUG", event="list")
                             elif cmd_data.startswith("GET:"):
                                 target = cmd_data[4:]
                                 if target in self.users:
                                     info = self.users[target]
                                     e, n = info["public_key"]
-                                    response = f"USER:{info['ip']}:{info['port']}:{e}:{n}"
+                                    reply(f"USER:{info['ip']}:{info['port']}:{e}:{n}")
                                 else:
-                                    response = "NOT_FOUND"
-                                conn.send(response.encode())
+                                    reply("NOT_FOUND")
                             elif cmd_data.startswith("PATH:"):
                                 _, sender, layers_str, target = cmd_data.split(":", 3)
+                                reply(self.build_path(sender, target, int(layers_str)))
+                            elif cmd_data.startswith("PATHS:"):
+                                # Plusieurs destinataires en une seule requête
+                                _, sender, layers_str, targets = cmd_data.split(":", 3)
                                 layers = int(layers_str)
-                                
-                                if target not in self.users:
-                                    conn.send(b"ERROR:TARGET_NOT_FOUND")
-                                    continue
-                                    
-                                if layers > len(self.routers):
-                                    layers = len(self.routers)
-                                if layers <= 0:
-                                    conn.send(b"ERROR:NO_ROUTERS_AVAILABLE")
-                                    continue
-                                    
-                                path_routers = random.sample(self.routers, layers)
-                                target_info = self.users[target]
-                                
-                                path_str = "|".join([
-                                    f"{r['ip']};{r['port']};{r['e']};{r['n']}"
-                                    for r in path_routers
-                                ])
-                                target_str = f"{target_info['ip']};{target_info['port']}"
-                                response = f"{path_str}||{target_str}"
-                                conn.send(response.encode())
-                                
-                                self.log(f"Path created: {sender} -> {target} ({layers} hops)")
+                                entries = [
+                                    f"{target}={self.build_path(sender, target, layers)}"
+                                    for target in targets.split(",") if target
+                                ]
+                                reply("\t".join(entries))
+                            elif cmd_data.startswith("MAIL:"):
+                                # Message pour un utilisateur hors ligne : 'MAIL:destinataire:base64'
+                                _, target, encoded = cmd_data.split(":", 2)
+                                reply(self.deposit_mail(username, target, encoded))
                             elif cmd_data == "PING":
-                                conn.send(b"PONG")
+                                reply("PONG")
                             else:
-                                conn.send(b"ERROR:UNKNOWN_COMMAND")
+                                reply("ERROR:UNKNOWN_COMMAND")
                     except ConnectionResetError:
                         self.log(f"Client '{username}' connection reset")
                     except Exception as e:
-                        self.log(f"X Command error for '{username}': {type(e).__name__}")
+                        self.log(f"X Command error for '{username}': {type(e).__name__}", "ERROR")
                 else:
                     conn.send(b"ERROR:INVALID_DATA")
             else:
@@ -431,24 +616,162 @@ class MasterServer:
         except socket.timeout:
             self.log("Registration timeout for client")
         except Exception as e:
-            self.log(f"X Client handler error: {type(e).__name__}: {e}")
+            self.log(f"X Client handler error: {type(e).__name__}: {e}", "ERROR")
         finally:
-            if username and username in self.users:
+            if registered and username in self.users:
                 del self.users[username]
                 if self.gui_mode and self.signals:
                     self.signals.client_disconnected.emit(username)
-            if username and username in self.online_users:
+            if registered and username in self.online_users:
                 del self.online_users[username]
-            if username:
-                db = get_db()
-                if db:
-                    cur = db.cursor()
-                    cur.execute("UPDATE users SET is_online = FALSE WHERE username = ?", (username,))
-                    db.commit()
-                    db.close()
+            if registered:
+                try:
+                    self.storage.set_user_offline(username)
+                except StorageError as db_error:
+                    self.log(f"X Database error: {db_error}", "ERROR")
                 self.log(f"Cleaned up client '{username}'")
+                self.events.record("deconnexion", f"User '{username}' disconnected")
+                UNREGISTRATIONS.inc(kind="client")
+                CLIENTS_ONLINE.set(len(self.users))
+                CONNECTIONS_ACTIVE.dec(kind="client")
             conn.close()
             
+    def deposit_mail(self, sender, target, encoded):
+        """Commande MAIL : déposer un message pour un utilisateur hors ligne
+        
+        Le message arrive en clair par le canal de contrôle, sans passer par les
+        routeurs : le master voit qui écrit à qui et ce qui est écrit.
+        """
+        if target in self.users:
+            return "ERROR:USER_ONLINE"
+        if target not in self.known_users and not self.mailbox.pending(target):
+            return "ERROR:UNKNOWN_USER"
+        try:
+            body = base64.b64decode(encoded, validate=True)
+        except ValueError:
+            return "ERROR:INVALID_DATA"
+        if not body.startswith(TEXT_MESSAGE_PREFIX):
+            return "ERROR:NOT_TEXT"  # Seuls les messages texte attendent le destinataire
+        return self.mailbox.deposit(target, sender, f"{sender}:".encode() + body)
+    
+    def handle_mailbox(self, conn, data=b""):
+        """Recevoir d'un routeur un lot de messages que les clients finaux n'ont pas acceptés
+        
+        Format : pour chaque message, 'ip;port;taille' du client puis '\n' puis le
+        message tel qu'il devait être remis, jusqu'à la fermeture en écriture par
+        le routeur. Réponse : une ligne par message, dans l'ordre.
+        """
+        try:
+            conn.settimeout(10.0)
+            chunks = [data]
+            size = len(data)
+            while size <= MAILBOX_MAX_UPLOAD:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+            data = b"".join(chunks)
+            replies = []
+            offset = 0
+            while offset < len(data):
+                end = data.find(b"\n", offset)
+                fields = data[offset:end].decode(errors="replace").split(";") if end >= 0 else []
+                if len(fields) != 3 or not fields[1].isdigit() or not fields[2].isdigit():
+                    replies.append("ERROR:INVALID_DATA")
+                    break
+                ip, port, length = fields
+                offset = end + 1 + int(length)
+                if offset > len(data):
+                    replies.append("ERROR:TRUNCATED")  # Lot au-delà de MAILBOX_MAX_UPLOAD ou coupé
+                    break
+                replies.append(self.deposit_undelivered(ip, int(port), data[end + 1:offset]))
+            conn.sendall("\n".join(replies).encode())
+        except Exception as e:
+            self.log(f"X Mailbox handler error: {type(e).__name__}: {e}", "ERROR")
+        finally:
+            conn.close()
+            
+    def deposit_undelivered(self, ip, port, payload):
+        """Déposer un message final non remis au client ip:port ; "OK" ou "ERROR:..." """
+        receiver = self.addresses.get((ip, port))
+        if receiver is None:
+            return "ERROR:UNKNOWN_ADDRESS"
+        if not is_text_message(payload):
+            return "ERROR:NOT_TEXT"
+        sender = payload.partition(b":")[0].decode(errors="replace")
+        return self.mailbox.deposit(receiver, sender, payload)
+            
+    def handle_events(self, conn):
+        """Recevoir un lot d'évènements d'un routeur
+        
+        Format : 'router_id' puis une ligne 'type\ttimestamp\tmessage' par évènement,
+        jusqu'à la fermeture en écriture par le routeur. Un processus hébergeant
+        plusieurs routeurs envoie tout en un lot : une ligne '@router_id' change
+        le routeur des évènements qui suivent.
+        """
+        try:
+            conn.settimeout(10.0)
+            chunks = []
+            size = 0
+            while size <= EVENT_MAX_UPLOAD:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+            lines = b"".join(chunks).decode(errors="replace").split("\n")
+            
+            router_id = int(lines[0]) if lines[0].strip().isdigit() else None
+            count = 0
+            for line in lines[1:]:
+                if line.startswith("@") and line[1:].strip().isdigit():
+                    router_id = int(line[1:])
+                    continue
+                parts = line.split("\t", 2)
+                if len(parts) != 3:
+                    continue
+                event_type, timestamp, message = parts
+                try:
+                    timestamp = float(timestamp)
+                except ValueError:
+                    timestamp = None
+                self.events.record(event_type, message, router_id, timestamp)
+                count += 1
+            conn.sendall(b"OK")
+            self.log(f"Received {count} events from router {router_id}", "DEBUG", event="events")
+        except Exception as e:
+            self.log(f"X Events handler error: {type(e).__name__}: {e}", "ERROR")
+        finally:
+            conn.close()
+            
+    def build_path(self, sender, target, layers):
+        """Choisir un chemin de routeurs vers target : 'ip;port;e;n|...||ip;port'"""
+        started = time.perf_counter()
+        if target not in self.users:
+            PATH_REQUESTS.inc(result="target_not_found")
+            return "ERROR:TARGET_NOT_FOUND"
+            
+        if layers > len(self.routers):
+            layers = len(self.routers)
+        if layers <= 0:
+            PATH_REQUESTS.inc(result="no_routers")
+            return "ERROR:NO_ROUTERS_AVAILABLE"
+            
+        path_routers = random.sample(self.routers, layers)
+        target_info = self.users[target]
+        
+        path_str = "|".join([
+            f"{r['ip']};{r['port']};{r['e']};{r['n']}"
+            for r in path_routers
+        ])
+        target_str = f"{target_info['ip']};{target_info['port']}"
+        
+        self.log(f"Path created: {sender} -> {target} ({layers} hops)", event="path")
+        PATH_REQUESTS.inc(result="ok")
+        PATH_SECONDS.observe(time.perf_counter() - started)
+        return f"{path_str}||{target_str}"
+            
     def start(self, host=None, port=None):
         """Démarrer le serveur Master"""
         self.running = True
@@ -460,9 +783,10 @@ class MasterServer:
             self.port = port
         
         # Initialiser la base de données (CRÉATION DES TABLES)
-        initialize_database()
+        if initialize_database(self.storage):
+            clear_database_tables(self.storage)
         
-        clear_database_tables()
+        self.events.start()
         
         # Si le port est spécifié, essayer uniquement ce port
         if hasattr(self, 'chosen_port') and self.chosen_port:
@@ -486,13 +810,15 @@ class MasterServer:
                 break
             except OSError as e:
                 if port == ports_to_try[-1]:
-                    self.log(f"X Could not bind to {self.host}:{port}")
+                    self.log(f"X Could not bind to {self.host}:{port}", "ERROR")
                     self.log(f"Error: {e}")
                     print("[MASTER] Try: sudo kill $(sudo lsof -t -i:6000-7000)")
                     return False
-                self.log(f"/!\\ Port {port} busy, trying next...")
+                self.log(f"/!\\ Port {port} busy, trying next...", "WARNING")
                 continue
         
+        metrics.serve_from_env("MASTER", self.log, self.metrics_port)
+        
         # Thread pour accepter les connexions
         threading.Thread(target=self._accept_connections, daemon=True).start()
         return True
@@ -502,510 +828,94 @@ class MasterServer:
         while self.running:
             try:
                 conn, addr = self.server.accept()
-                self.log(f"New connection from {addr}")
+                self.log(f"New connection from {addr}", event="accept")
                 
                 conn.settimeout(5.0)
                 try:
-                    typ_data = conn.recv(32).decode().strip()
-                    self.log(f"Connection type: {typ_data}")
+                    # Un type suivi de '\n' peut arriver avec le début des données (MAILBOX)
+                    typ_bytes, newline, leftover = conn.recv(32).partition(b"\n")
+                    typ_data = typ_bytes.decode().strip()
+                    self.log(f"Connection type: {typ_data}", "DEBUG", event="accept_type")
                     
                     if typ_data == "ROUTER":
-                        self.log(f"New router from {addr}")
+                        self.log(f"New router from {addr}", event="accept_router")
                         threading.Thread(target=self.handle_router, args=(conn,), daemon=True).start()
                     elif typ_data == "CLIENT":
-                        self.log(f"New client from {addr}")
+                        self.log(f"New client from {addr}", event="accept_client")
                         threading.Thread(target=self.handle_client, args=(conn,), daemon=True).start()
+                    elif typ_data == "EVENTS":
+                        threading.Thread(target=self.handle_events, args=(conn,), daemon=True).start()
+                    elif typ_data == "MAILBOX":
+                        threading.Thread(target=self.handle_mailbox, args=(conn, leftover), daemon=True).start()
                     elif typ_data == "UNREGISTER_ROUTER":
                         self.log(f"Router unregister request from {addr}")
                         threading.Thread(target=self.handle_unregister_router, args=(conn,), daemon=True).start()
                     else:
-                        self.log(f"? Unknown type: {typ_data}")
+                        self.log(f"? Unknown type: {typ_data}", "WARNING")
                         conn.send(b"ERROR:UNKNOWN_TYPE")
                         conn.close()
                 except socket.timeout:
-                    self.log(f"Connection timeout from {addr}")
+                    self.log(f"Connection timeout from {addr}", "WARNING", event="accept_timeout")
                     conn.close()
             except Exception as e:
                 if self.running:
-                    self.log(f"X Accept error: {type(e).__name__}: {e}")
+                    self.log(f"X Accept error: {type(e).__name__}: {e}", "ERROR")
                     
     def stop(self):
         """Arrêter le serveur"""
         self.running = False
         if self.server:
             self.server.close()
+        self.events.stop()
+        self.log(f"Event log: {self.events.written} written, {self.events.dropped} dropped, "
+                 f"{self.events.failed} failed")
+        self.storage.close()
         self.log("Server stopped")
+        self.logs.close()
 
-# ---------- INTERFACE GRAPHIQUE ----------
-if PYQT_AVAILABLE:
-    class MasterWindow(QMainWindow):
-        """Fenêtre principale du Master"""
-        
-        def __init__(self, master_server):
-            super().__init__()
-            self.master = master_server
-            
-            # Connecter les signaux
-            self.master.signals.log_message.connect(self.add_log)
-            self.master.signals.router_connected.connect(self.add_router)
-            self.master.signals.client_connected.connect(self.add_client)
-            self.master.signals.client_disconnected.connect(self.remove_client)
-            self.master.signals.router_disconnected.connect(self.remove_router)
-            
-            self.init_ui()
-            
-            # Timer pour rafraîchir l'affichage
-            self.timer = QTimer()
-            self.timer.timeout.connect(self.refresh_status)
-            self.timer.start(2000)  # Toutes les 2 secondes
-            
-        def init_ui(self):
-            self.setWindowTitle(f"Onion Routing - Master Server {self.master.host}:{self.master.port}")
-            self.setGeometry(100, 100, 1200, 700)
-            
-            # Style identique au client
-            self.setStyleSheet("""
-                QMainWindow {
-                    background-color: #1e1e2e;
-                }
-                QLabel {
-                    color: #cdd6f4;
-                    font-size: 13px;
-                }
-                QTextEdit {
-                    background-color: #313244;
-                    border: 2px solid #45475a;
-                    border-radius: 10px;
-                    padding: 10px;
-                    color: #cdd6f4;
-                    font-size: 12px;
-                }
-                QTableWidget {
-                    background-color: #313244;
-                    border: 2px solid #45475a;
-                    border-radius: 10px;
-                    color: #cdd6f4;
-                    gridline-color: #45475a;
-                }
-                QTableWidget::item {
-                    padding: 5px;
-                }
-                QHeaderView::section {
-                    background-color: #45475a;
-                    color: #cdd6f4;
-                    padding: 8px;
-                    border: none;
-                    font-weight: bold;
-                }
-                QTabWidget::pane {
-                    border: 2px solid #45475a;
-                    border-radius: 10px;
-                    background-color: #313244;
-                }
-                QTabBar::tab {
-                    background-color: #313244;
-                    color: #cdd6f4;
-                    padding: 10px 20px;
-                    margin-right: 2px;
-                    border: 2px solid #45475a;
-                    border-bottom: none;
-                    border-top-left-radius: 8px;
-                    border-top-right-radius: 8px;
-                }
-                QTabBar::tab:selected {
-                    background-color: #89b4fa;
-                    color: #1e1e2e;
-                    font-weight: bold;
-                }
-                QTabBar::tab:hover:!selected {
-                    background-color: #45475a;
-                }
-            """)
-            
-            # Widget central
-            central_widget = QWidget()
-            self.setCentralWidget(central_widget)
-            main_layout = QVBoxLayout(central_widget)
-            main_layout.setSpacing(15)
-            main_layout.setContentsMargins(15, 15, 15, 15)
-            
-            # En-tête
-            header = QLabel(f"ONION ROUTING - MASTER SERVER ({self.master.host}:{self.master.port})")
-            header.setStyleSheet("font-size: 20px; font-weight: bold; color: #89b4fa;")
-            header.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            main_layout.addWidget(header)
-            
-            # Onglets
-            self.tabs = QTabWidget()
-            main_layout.addWidget(self.tabs)
-            
-            # Onglet Logs
-            self.logs_tab = QWidget()
-            self.init_logs_tab()
-            self.tabs.addTab(self.logs_tab, "Logs")
-            
-            # Onglet Connexions
-            self.connections_tab = QWidget()
-            self.init_connections_tab()
-            self.tabs.addTab(self.connections_tab, "Connexions")
-            
-        def init_logs_tab(self):
-            """Initialiser l'onglet Logs"""
-            layout = QVBoxLayout(self.logs_tab)
-            layout.setContentsMargins(10, 10, 10, 10)
-            
-            # Zone de logs
-            self.log_display = QTextEdit()
-            self.log_display.setReadOnly(True)
-            self.log_display.setFont(QFont("Monospace", 10))
-            layout.addWidget(self.log_display)
-            
-        def init_connections_tab(self):
-            """Initialiser l'onglet Connexions"""
-            layout = QVBoxLayout(self.connections_tab)
-            layout.setContentsMargins(10, 10, 10, 10)
-            layout.setSpacing(15)
-            
-            # Info Master
-            master_group = QWidget()
-            master_layout = QHBoxLayout(master_group)
-            master_layout.setContentsMargins(10, 10, 10, 10)
-            
-            master_label = QLabel("Master:")
-            master_label.setStyleSheet("font-weight: bold; font-size: 14px;")
-            master_layout.addWidget(master_label)
-            
-            self.master_info = QLabel(f"{self.master.host}:{self.master.port}")
-            self.master_info.setStyleSheet("font-size: 14px; color: #89b4fa;")
-            master_layout.addWidget(self.master_info)
-            
-            self.master_status = QLabel("●")
-            self.master_status.setStyleSheet("color: #a6e3a1; font-size: 20px;")
-            master_layout.addWidget(self.master_status)
-            
-            master_layout.addStretch()
-            
-            # Bouton d'arrêt
-            stop_btn = QPushButton("Arrêter le serveur")
-            stop_btn.setFixedWidth(150)
-            stop_btn.setStyleSheet("""
-                QPushButton {
-                    background-color: #f38ba8;
-                    color: #1e1e2e;
-                }
-                QPushButton:hover {
-                    background-color: #eba0ac;
-                }
-            """)
-            stop_btn.clicked.connect(self.stop_server)
-            master_layout.addWidget(stop_btn)
-            
-            layout.addWidget(master_group)
-            
-            # Layout horizontal pour les deux tables côte à côte
-            tables_layout = QHBoxLayout()
-            tables_layout.setSpacing(15)
-            
-            # ========== COLONNE ROUTEURS (GAUCHE) ==========
-            routers_container = QWidget()
-            routers_layout = QVBoxLayout(routers_container)
-            routers_layout.setContentsMargins(0, 0, 0, 0)
-            routers_layout.setSpacing(10)
-            
-            routers_label = QLabel("Routeurs")
-            routers_label.setStyleSheet("font-weight: bold; font-size: 15px; color: #89b4fa;")
-            routers_layout.addWidget(routers_label)
-            
-            self.routers_table = QTableWidget()
-            self.routers_table.setColumnCount(3)
-            self.routers_table.setHorizontalHeaderLabels(["ID", "IP / Port", "État"])
-            
-            # Élargir la colonne IP/Port pour les routeurs
-            self.routers_table.setColumnWidth(0, 50)   # ID
-            self.routers_table.setColumnWidth(1, 200)  # IP/Port (élargi)
-            self.routers_table.horizontalHeader().setStretchLastSection(True)  # État prend le reste
-            
-            self.routers_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
-            routers_layout.addWidget(self.routers_table)
-            
-            tables_layout.addWidget(routers_container)
-            
-            # ========== COLONNE CLIENTS (DROITE) ==========
-            clients_container = QWidget()
-            clients_layout = QVBoxLayout(clients_container)
-            clients_layout.setContentsMargins(0, 0, 0, 0)
-            clients_layout.setSpacing(10)
-            
-            clients_label = QLabel("Clients")
-            clients_label.setStyleSheet("font-weight: bold; font-size: 15px; color: #89b4fa;")
-            clients_layout.addWidget(clients_label)
-            
-            self.clients_table = QTableWidget()
-            self.clients_table.setColumnCount(4)
-            self.clients_table.setHorizontalHeaderLabels(["ID", "Nom", "IP / Port", "État"])
-            
-            # Élargir la colonne IP/Port pour les clients
-            self.clients_table.setColumnWidth(0, 50)   # ID
-            self.clients_table.setColumnWidth(1, 120)  # Nom
-            self.clients_table.setColumnWidth(2, 200)  # IP/Port (élargi)
-            self.clients_table.horizontalHeader().setStretchLastSection(True)  # État prend le reste
-            
-            self.clients_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
-            clients_layout.addWidget(self.clients_table)
-            
-            tables_layout.addWidget(clients_container)
-            
-            # Ajouter le layout horizontal au layout principal
-            layout.addLayout(tables_layout)
-            
-            # Légende
-            legend = QLabel("● Actif")
-            legend.setStyleSheet("color: #a6e3a1; font-size: 12px;")
-            layout.addWidget(legend)
-            
-        def add_log(self, message):
-            """Ajouter un message dans les logs"""
-            self.log_display.append(message)
-            self.log_display.verticalScrollBar().setValue(
-                self.log_display.verticalScrollBar().maximum()
-            )
-            
-        def add_router(self, router_info):
-            """Ajouter un routeur dans la table"""
-            row = self.routers_table.rowCount()
-            self.routers_table.insertRow(row)
-            
-            self.routers_table.setItem(row, 0, QTableWidgetItem(str(router_info['id'])))
-            self.routers_table.setItem(row, 1, QTableWidgetItem(f"{router_info['ip']}:{router_info['port']}"))
-            
-            status_item = QTableWidgetItem("●")
-            status_item.setForeground(QColor("#a6e3a1"))
-            self.routers_table.setItem(row, 2, status_item)
-            
-        def add_client(self, username, client_info):
-            """Ajouter un client dans la table"""
-            row = self.clients_table.rowCount()
-            self.clients_table.insertRow(row)
-            
-            self.clients_table.setItem(row, 0, QTableWidgetItem(str(row + 1)))
-            self.clients_table.setItem(row, 1, QTableWidgetItem(username))
-            self.clients_table.setItem(row, 2, QTableWidgetItem(f"{client_info['ip']}:{client_info['port']}"))
-            
-            status_item = QTableWidgetItem("●")
-            status_item.setForeground(QColor("#a6e3a1"))
-            self.clients_table.setItem(row, 3, status_item)
-            
-        def remove_client(self, username):
-            """Retirer un client de la table"""
-            for row in range(self.clients_table.rowCount()):
-                if self.clients_table.item(row, 1) and self.clients_table.item(row, 1).text() == username:
-                    self.clients_table.removeRow(row)
-                    break
-                    
-        def remove_router(self, router_id):
-            """Retirer un routeur de la table"""
-            for row in range(self.routers_table.rowCount()):
-                if self.routers_table.item(row, 0) and self.routers_table.item(row, 0).text() == str(router_id):
-                    self.routers_table.removeRow(row)
-                    break
-                    
-        def refresh_status(self):
-            """Rafraîchir l'affichage du statut"""
-            self.master_info.setText(f"{self.master.host}:{self.master.port}")
-                
-        def stop_server(self):
-            """Arrêter le serveur"""
-            reply = QMessageBox.question(
-                self, 'Confirmation',
-                'Êtes-vous sûr de vouloir arrêter le serveur Master ?',
-                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
-            )
-            
-            if reply == QMessageBox.StandardButton.Yes:
-                self.master.stop()
-                self.close()
-                
-        def closeEvent(self, event):
-            """Fermeture de la fenêtre"""
-            self.stop_server()
-            event.accept()
-
+# ---------- MAIN ----------
+def parse_args(argv=None):
+    """Options de démarrage (ligne de commande, environnement, fichier de configuration)"""
+    parser = argparse.ArgumentParser(description="Onion routing master server")
+    parser.add_argument("--mode", choices=("gui", "shell"), help="interface (asked at startup if missing)")
+    parser.add_argument("--host", help="listening IP (default: 127.0.0.1)")
+    parser.add_argument("--port", type=port_type, help="listening port (default: 6000)")
+    parser.add_argument("--storage", help="mariadb (default), sqlite[:path] or memory")
+    parser.add_argument("--log-level", choices=tuple(LOG_LEVELS), help=f"minimum log level (default: {LOG_LEVEL})")
+    parser.add_argument("--metrics-port", type=int, help="serve /metrics on this port (0 = any)")
+    add_config_argument(parser)
+    args = parser.parse_args(argv)
+    return resolve(args, "master", {
+        "mode": (str, None),
+        "host": (str, None),
+        "port": (port_type, None),
+        "storage": (str, None),
+        "log_level": (str.upper, LOG_LEVEL),
+        "metrics_port": (int, None),
+    })
 
-class MasterLoginWindow(QDialog):
-    """Fenêtre de configuration du serveur Master"""
-    
-    def __init__(self):
-        super().__init__()
-        self.host = None
-        self.port = None
-        self.init_ui()
-        
-    def init_ui(self):
-        self.setWindowTitle("Configuration du serveur Master")
-        self.setFixedSize(400, 400)
-        self.setStyleSheet("""
-            QDialog {
-                background-color: #1e1e2e;
-            }
-            QLabel {
-                color: #cdd6f4;
-                font-size: 13px;
-            }
-            QLineEdit {
-                background-color: #313244;
-                border: 2px solid #45475a;
-                border-radius: 8px;
-                padding: 10px;
-                color: #cdd6f4;
-                font-size: 13px;
-            }
-            QLineEdit:focus {
-                border: 2px solid #89b4fa;
-            }
-            QPushButton {
-                background-color: #89b4fa;
-                color: #1e1e2e;
-                border: none;
-                border-radius: 8px;
-                padding: 12px;
-                font-weight: bold;
-                font-size: 13px;
-            }
-            QPushButton:hover {
-                background-color: #74c7ec;
-            }
-            QPushButton:pressed {
-                background-color: #89dceb;
-            }
-        """)
-        
-        layout = QVBoxLayout()
-        layout.setSpacing(15)
-        layout.setContentsMargins(30, 30, 30, 30)
-        
-        # Titre
-        title = QLabel("Configuration du serveur Master")
-        title.setStyleSheet("font-size: 18px; font-weight: bold; color: #89b4fa;")
-        title.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        layout.addWidget(title)
-        
-        layout.addSpacing(20)
-        
-        # IP du serveur
-        ip_label = QLabel("Adresse IP du serveur :")
-        layout.addWidget(ip_label)
-        
-        self.ip_input = QLineEdit()
-        self.ip_input.setPlaceholderText("127.0.0.1")
-        self.ip_input.setText("127.0.0.1")
-        self.ip_input.setMinimumHeight(40)
-        layout.addWidget(self.ip_input)
-        
-        # Port du serveur
-        port_label = QLabel("Port du serveur :")
-        layout.addWidget(port_label)
-        
-        self.port_input = QLineEdit()
-        self.port_input.setPlaceholderText("6000")
-        self.port_input.setText("6000")
-        self.port_input.setMinimumHeight(40)
-        layout.addWidget(self.port_input)
-        
-        layout.addSpacing(20)
-        
-        # Information
-        info_label = QLabel("Note : Le serveur essayera les ports 6000-6002 et 7000 si le port spécifié est occupé.")
-        info_label.setStyleSheet("color: #bac2de; font-size: 11px; font-style: italic;")
-        info_label.setWordWrap(True)
-        layout.addWidget(info_label)
-        
-        layout.addSpacing(10)
-        
-        # Boutons
-        buttons_layout = QHBoxLayout()
-        
-        cancel_btn = QPushButton("Annuler")
-        cancel_btn.setMinimumHeight(45)
-        cancel_btn.clicked.connect(self.reject)
-        buttons_layout.addWidget(cancel_btn)
-        
-        start_btn = QPushButton("Démarrer le serveur")
-        start_btn.setMinimumHeight(45)
-        start_btn.clicked.connect(self.validate_and_start)
-        buttons_layout.addWidget(start_btn)
-        
-        layout.addLayout(buttons_layout)
-        
-        self.setLayout(layout)
-        
-        # Enter pour valider
-        self.ip_input.returnPressed.connect(self.validate_and_start)
-        self.port_input.returnPressed.connect(self.validate_and_start)
-        
-    def validate_ip(self, ip):
-        """Valide une adresse IPv4"""
-        try:
-            socket.inet_aton(ip)
-            return True
-        except socket.error:
-            return False
-            
-    def validate_and_start(self):
-        ip = self.ip_input.text().strip()
-        port_text = self.port_input.text().strip()
-        
-        # Validation IP
-        if ip == "":
-            ip = "127.0.0.1"
-        elif not self.validate_ip(ip):
-            QMessageBox.warning(self, "Erreur", "Adresse IP invalide")
-            return
-            
-        # Validation port
-        if not port_text:
-            QMessageBox.warning(self, "Erreur", "Veuillez entrer un port")
-            return
-            
-        try:
-            port = int(port_text)
-            if not (1 <= port <= 65535):
-                QMessageBox.warning(self, "Erreur", "Le port doit être entre 1 et 65535")
-                return
-        except ValueError:
-            QMessageBox.warning(self, "Erreur", "Le port doit être un nombre")
-            return
-            
-        self.host = ip
-        self.port = port
-        self.accept()
+def make_server(args, gui_mode, host, port):
+    """Créer et démarrer le serveur ; None en cas d'échec"""
+    master_server = MasterServer(gui_mode=gui_mode, host=host, port=port, log_level=args.log_level,
+                                 storage=open_storage(args.storage), metrics_port=args.metrics_port)
+    if not master_server.start():
+        print("[MASTER] ✗ Échec du démarrage du serveur")
+        return None
+    return master_server
 
-# ---------- MAIN ----------
-def main():
-    """Point d'entrée principal"""
-    print("\n" + "="*60)
-    print("ONION ROUTING MASTER SERVER")
-    print("="*60 + "\n")
-    
-    # Question au démarrage
-    while True:
-        choice = input("Voulez-vous utiliser l'interface graphique ? (oui / non) : ").strip().lower()
-        if choice in ['oui', 'non', 'o', 'n']:
-            break
-        print("Veuillez répondre par 'oui' ou 'non'")
+def run_shell(args):
+    """Mode shell : demander l'IP et le port s'ils ne sont pas configurés"""
+    print("\n[MASTER] Mode shell activé\n")
     
-    # Normaliser la réponse
-    use_gui = choice in ['oui', 'o']
-    
-    if not use_gui:
-        # ====== MODE SHELL ======
-        print("\n[MASTER] Mode shell activé\n")
-        
-        # Demander l'IP et le port en mode shell
+    host = args.host
+    port = args.port
+    if host is not None or port is not None:
+        # Configuration fournie au lancement : défauts pour le reste, sans saisie
+        host = host or "127.0.0.1"
+        port = port or 6000
+    else:
         print("Configuration du serveur:")
-        host = input(f"Adresse IP (défaut: 127.0.0.1): ").strip()
-        if not host:
-            host = "127.0.0.1"
-        
+        host = input(f"Adresse IP (défaut: 127.0.0.1): ").strip() or "127.0.0.1"
         port_input = input(f"Port (défaut: 6000): ").strip()
         if not port_input:
             port = 6000
@@ -1015,76 +925,71 @@ def main():
             except ValueError:
                 print("Port invalide, utilisation du port 6000")
                 port = 6000
+    
+    master_server = make_server(args, False, host, port)
+    if master_server is None:
+        sys.exit(1)
+    
+    print(f"\n[MASTER] Serveur démarré sur {host}:{master_server.port}")
+    print("[MASTER] Serveur en cours d'exécution...")
+    print("[MASTER] Appuyez sur Ctrl+C pour arrêter\n")
+    
+    try:
+        # Garder le programme actif
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\n\n[MASTER] Arrêt demandé...")
+        master_server.stop()
+        print("[MASTER] Au revoir!")
+        sys.exit(0)
+
+def main(argv=None):
+    """Point d'entrée principal"""
+    args = parse_args(argv)
+    
+    print("\n" + "="*60)
+    print("ONION ROUTING MASTER SERVER")
+    print("="*60 + "\n")
+    
+    # Question au démarrage (si le mode n'est pas configuré)
+    if args.mode is None:
+        while True:
+            choice = input("Voulez-vous utiliser l'interface graphique ? (oui / non) : ").strip().lower()
+            if choice in ['oui', 'non', 'o', 'n']:
+                break
+            print("Veuillez répondre par 'oui' ou 'non'")
         
-        master_server = MasterServer(gui_mode=False, host=host, port=port)
-        
-        if not master_server.start():
-            print("[MASTER] ✗ Échec du démarrage du serveur")
-            sys.exit(1)
-        
-        print(f"\n[MASTER] Serveur démarré sur {host}:{port}")
-        print("[MASTER] Serveur en cours d'exécution...")
-        print("[MASTER] Appuyez sur Ctrl+C pour arrêter\n")
-        
-        try:
-            # Garder le programme actif
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            print("\n\n[MASTER] Arrêt demandé...")
-            master_server.stop()
-            print("[MASTER] Au revoir!")
-            sys.exit(0)
-    else:
-        # ====== MODE GUI ======
-        if not PYQT_AVAILABLE:
-            print("\n[MASTER] ✗ PyQt6 n'est pas installé")
-            print("[MASTER] Installez-le avec: pip install PyQt6")
-            print("[MASTER] Basculement vers le mode shell...\n")
-            
-            # Mode shell avec paramètres par défaut
-            master_server = MasterServer(gui_mode=False, host="127.0.0.1", port=6000)
-            
-            if not master_server.start():
-                print("[MASTER] ✗ Échec du démarrage du serveur")
-                sys.exit(1)
-            
-            try:
-                while True:
-                    time.sleep(1)
-            except KeyboardInterrupt:
-                print("\n\n[MASTER] Arrêt demandé...")
-                master_server.stop()
-                sys.exit(0)
-        
-        print("\n[MASTER] Lancement de l'interface graphique...\n")
-        
-        # Afficher la fenêtre de configuration
-        app = QApplication(sys.argv)
-        login_window = MasterLoginWindow()
-        
-        if login_window.exec() != QDialog.DialogCode.Accepted:
-            print("[MASTER] Configuration annulée")
-            sys.exit(0)
-        
-        # Récupérer les paramètres
-        host = login_window.host
-        port = login_window.port
-        
-        # Créer le serveur Master
-        master_server = MasterServer(gui_mode=True, host=host, port=port)
-        
-        # Démarrer le serveur
-        if not master_server.start():
-            print("[MASTER] ✗ Échec du démarrage du serveur")
-            QMessageBox.critical(None, "Erreur", f"Impossible de démarrer le serveur sur {host}:{port}")
-            sys.exit(1)
-        
-        # Afficher la fenêtre principale
-        window = MasterWindow(master_server)
-        window.show()
-        
-        sys.exit(app.exec())
+        # Normaliser la réponse
+        args.mode = "gui" if choice in ['oui', 'o'] else "shell"
+    
+    if args.mode == "shell":
+        # ====== MODE SHELL ======
+        run_shell(args)
+        return
+    
+    # ====== MODE GUI ======
+    try:
+        import master_gui
+    except ImportError:
+        print("\n[MASTER] ✗ PyQt6 n'est pas installé")
+        print("[MASTER] Installez-le avec: pip install PyQt6")
+        print("[MASTER] Basculement vers le mode shell...\n")
+        
+        # Mode shell avec paramètres par défaut
+        args.host = args.host or "127.0.0.1"
+        args.port = args.port or 6000
+        run_shell(args)
+        return
+    
+    print("\n[MASTER] Lancement de l'interface graphique...\n")
+    if args.host is not None or args.port is not None:
+        # Configuration fournie au lancement : pas de fenêtre de configuration
+        args.host = args.host or "127.0.0.1"
+        args.port = args.port or 6000
+    sys.exit(master_gui.run_gui(
+        lambda host, port: make_server(args, True, host, port), args.host, args.port
+    ))
 
 if __name__ == "__main__":
     main()
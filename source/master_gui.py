@@ -0,0 +1,582 @@
+"""Interface graphique du Master (PyQt6)
+
+Importé uniquement en mode GUI : le mode shell ne paie pas le chargement de Qt.
+"""
+import socket
+import sys
+
+from PyQt6.QtWidgets import (
+    QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
+    QLabel, QPlainTextEdit, QTableView, QTabWidget, QAbstractItemView,
+    QHeaderView, QMessageBox, QDialog, QLineEdit, QPushButton
+)
+from PyQt6.QtCore import Qt, pyqtSignal, QObject, QTimer, QAbstractTableModel, QModelIndex
+from PyQt6.QtGui import QFont, QColor
+
+GUI_REFRESH_MS = 16  # Application groupée des évènements (une fois par image)
+LOG_MAX_LINES = 5000  # Lignes gardées dans l'onglet Logs
+
+# ---------- SIGNAUX (pour mode GUI) ----------
+class MasterSignals(QObject):
+    """Signaux pour la communication entre threads"""
+    log_batch = pyqtSignal(list)  # Lot de lignes de logs
+    router_connected = pyqtSignal(dict)  # Nouveau routeur
+    client_connected = pyqtSignal(str, dict)  # Nouveau client
+    client_disconnected = pyqtSignal(str)  # Client déconnecté
+    router_disconnected = pyqtSignal(int)  # Routeur déconnecté
+
+# ---------- INTERFACE GRAPHIQUE ----------
+class KeyedTableModel(QAbstractTableModel):
+    """Table indexée par clé (ID routeur, nom de client)
+
+    Un dictionnaire clé -> ligne rend l'ajout, la mise à jour et la
+    suppression en O(1) : la ligne supprimée est remplacée par la dernière.
+    """
+
+    STATUS_COLOR = QColor("#a6e3a1")
+
+    def __init__(self, headers):
+        super().__init__()
+        self.headers = headers
+        self.rows = []
+        self.keys = []
+        self.index_of = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.rows[index.row()][index.column()]
+        if role == Qt.ItemDataRole.ForegroundRole and index.column() == len(self.headers) - 1:
+            return self.STATUS_COLOR
+        return None
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.headers[section]
+        return None
+
+    def upsert(self, key, values):
+        """Ajouter une ligne, ou la remplacer si la clé existe déjà"""
+        row = self.index_of.get(key)
+        if row is not None:
+            self.rows[row] = values
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+            return
+        row = len(self.rows)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.rows.append(values)
+        self.keys.append(key)
+        self.index_of[key] = row
+        self.endInsertRows()
+
+    def remove(self, key):
+        """Supprimer la ligne d'une clé"""
+        row = self.index_of.pop(key, None)
+        if row is None:
+            return
+        last = len(self.rows) - 1
+        if row != last:
+            # La dernière ligne prend la place de la ligne supprimée
+            self.rows[row] = self.rows[last]
+            self.keys[row] = self.keys[last]
+            self.index_of[self.keys[row]] = row
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+        self.beginRemoveRows(QModelIndex(), last, last)
+        self.rows.pop()
+        self.keys.pop()
+        self.endRemoveRows()
+
+class MasterWindow(QMainWindow):
+    """Fenêtre principale du Master"""
+
+    def __init__(self, master_server):
+        super().__init__()
+        self.master = master_server
+
+        # Évènements reçus depuis les threads du serveur, appliqués une fois par image.
+        # Une clé n'y garde que son dernier état (None = supprimé).
+        self.pending_logs = []
+        self.pending_routers = {}
+        self.pending_clients = {}
+        self.next_client_id = 1
+
+        # Connecter les signaux
+        self.master.signals.log_batch.connect(self.add_logs)
+        self.master.signals.router_connected.connect(self.add_router)
+        self.master.signals.client_connected.connect(self.add_client)
+        self.master.signals.client_disconnected.connect(self.remove_client)
+        self.master.signals.router_disconnected.connect(self.remove_router)
+
+        self.init_ui()
+
+        # Timer pour rafraîchir l'affichage
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.refresh_status)
+        self.timer.start(2000)  # Toutes les 2 secondes
+
+        # Timer d'application des évènements groupés
+        self.flush_timer = QTimer()
+        self.flush_timer.timeout.connect(self.flush_events)
+        self.flush_timer.start(GUI_REFRESH_MS)
+
+    def init_ui(self):
+        self.setWindowTitle(f"Onion Routing - Master Server {self.master.host}:{self.master.port}")
+        self.setGeometry(100, 100, 1200, 700)
+
+        # Style identique au client
+        self.setStyleSheet("""
+            QMainWindow {
+                background-color: #1e1e2e;
+            }
+            QLabel {
+                color: #cdd6f4;
+                font-size: 13px;
+            }
+            QPlainTextEdit {
+                background-color: #313244;
+                border: 2px solid #45475a;
+                border-radius: 10px;
+                padding: 10px;
+                color: #cdd6f4;
+                font-size: 12px;
+            }
+            QTableView {
+                background-color: #313244;
+                border: 2px solid #45475a;
+                border-radius: 10px;
+                color: #cdd6f4;
+                gridline-color: #45475a;
+            }
+            QTableView::item {
+                padding: 5px;
+            }
+            QHeaderView::section {
+                background-color: #45475a;
+                color: #cdd6f4;
+                padding: 8px;
+                border: none;
+                font-weight: bold;
+            }
+            QTabWidget::pane {
+                border: 2px solid #45475a;
+                border-radius: 10px;
+                background-color: #313244;
+            }
+            QTabBar::tab {
+                background-color: #313244;
+                color: #cdd6f4;
+                padding: 10px 20px;
+                margin-right: 2px;
+                border: 2px solid #45475a;
+                border-bottom: none;
+                border-top-left-radius: 8px;
+                border-top-right-radius: 8px;
+            }
+            QTabBar::tab:selected {
+                background-color: #89b4fa;
+                color: #1e1e2e;
+                font-weight: bold;
+            }
+            QTabBar::tab:hover:!selected {
+                background-color: #45475a;
+            }
+        """)
+
+        # Widget central
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        main_layout = QVBoxLayout(central_widget)
+        main_layout.setSpacing(15)
+        main_layout.setContentsMargins(15, 15, 15, 15)
+
+        # En-tête
+        header = QLabel(f"ONION ROUTING - MASTER SERVER ({self.master.host}:{self.master.port})")
+        header.setStyleSheet("font-size: 20px; font-weight: bold; color: #89b4fa;")
+        header.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        main_layout.addWidget(header)
+
+        # Onglets
+        self.tabs = QTabWidget()
+        main_layout.addWidget(self.tabs)
+
+        # Onglet Logs
+        self.logs_tab = QWidget()
+        self.init_logs_tab()
+        self.tabs.addTab(self.logs_tab, "Logs")
+
+        # Onglet Connexions
+        self.connections_tab = QWidget()
+        self.init_connections_tab()
+        self.tabs.addTab(self.connections_tab, "Connexions")
+
+    def init_logs_tab(self):
+        """Initialiser l'onglet Logs"""
+        layout = QVBoxLayout(self.logs_tab)
+        layout.setContentsMargins(10, 10, 10, 10)
+
+        # Zone de logs (tampon circulaire de LOG_MAX_LINES lignes)
+        self.log_display = QPlainTextEdit()
+        self.log_display.setReadOnly(True)
+        self.log_display.setMaximumBlockCount(LOG_MAX_LINES)
+        self.log_display.setFont(QFont("Monospace", 10))
+        layout.addWidget(self.log_display)
+
+    def init_connections_tab(self):
+        """Initialiser l'onglet Connexions"""
+        layout = QVBoxLayout(self.connections_tab)
+        layout.setContentsMargins(10, 10, 10, 10)
+        layout.setSpacing(15)
+
+        # Info Master
+        master_group = QWidget()
+        master_layout = QHBoxLayout(master_group)
+        master_layout.setContentsMargins(10, 10, 10, 10)
+
+        master_label = QLabel("Master:")
+        master_label.setStyleSheet("font-weight: bold; font-size: 14px;")
+        master_layout.addWidget(master_label)
+
+        self.master_info = QLabel(f"{self.master.host}:{self.master.port}")
+        self.master_info.setStyleSheet("font-size: 14px; color: #89b4fa;")
+        master_layout.addWidget(self.master_info)
+
+        self.master_status = QLabel("●")
+        self.master_status.setStyleSheet("color: #a6e3a1; font-size: 20px;")
+        master_layout.addWidget(self.master_status)
+
+        master_layout.addStretch()
+
+        # Bouton d'arrêt
+        stop_btn = QPushButton("Arrêter le serveur")
+        stop_btn.setFixedWidth(150)
+        stop_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #f38ba8;
+                color: #1e1e2e;
+            }
+            QPushButton:hover {
+                background-color: #eba0ac;
+            }
+        """)
+        stop_btn.clicked.connect(self.stop_server)
+        master_layout.addWidget(stop_btn)
+
+        layout.addWidget(master_group)
+
+        # Layout horizontal pour les deux tables côte à côte
+        tables_layout = QHBoxLayout()
+        tables_layout.setSpacing(15)
+
+        # ========== COLONNE ROUTEURS (GAUCHE) ==========
+        routers_container = QWidget()
+        routers_layout = QVBoxLayout(routers_container)
+        routers_layout.setContentsMargins(0, 0, 0, 0)
+        routers_layout.setSpacing(10)
+
+        routers_label = QLabel("Routeurs")
+        routers_label.setStyleSheet("font-weight: bold; font-size: 15px; color: #89b4fa;")
+        routers_layout.addWidget(routers_label)
+
+        self.routers_model = KeyedTableModel(["ID", "IP / Port", "État"])
+        self.routers_table = QTableView()
+        self.routers_table.setModel(self.routers_model)
+        self.routers_table.verticalHeader().setVisible(False)
+
+        # Élargir la colonne IP/Port pour les routeurs
+        self.routers_table.setColumnWidth(0, 50)   # ID
+        self.routers_table.setColumnWidth(1, 200)  # IP/Port (élargi)
+        self.routers_table.horizontalHeader().setStretchLastSection(True)  # État prend le reste
+
+        self.routers_table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        routers_layout.addWidget(self.routers_table)
+
+        tables_layout.addWidget(routers_container)
+
+        # ========== COLONNE CLIENTS (DROITE) ==========
+        clients_container = QWidget()
+        clients_layout = QVBoxLayout(clients_container)
+        clients_layout.setContentsMargins(0, 0, 0, 0)
+        clients_layout.setSpacing(10)
+
+        clients_label = QLabel("Clients")
+        clients_label.setStyleSheet("font-weight: bold; font-size: 15px; color: #89b4fa;")
+        clients_layout.addWidget(clients_label)
+
+        self.clients_model = KeyedTableModel(["ID", "Nom", "IP / Port", "État"])
+        self.clients_table = QTableView()
+        self.clients_table.setModel(self.clients_model)
+        self.clients_table.verticalHeader().setVisible(False)
+
+        # Élargir la colonne IP/Port pour les clients
+        self.clients_table.setColumnWidth(0, 50)   # ID
+        self.clients_table.setColumnWidth(1, 120)  # Nom
+        self.clients_table.setColumnWidth(2, 200)  # IP/Port (élargi)
+        self.clients_table.horizontalHeader().setStretchLastSection(True)  # État prend le reste
+
+        self.clients_table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        clients_layout.addWidget(self.clients_table)
+
+        tables_layout.addWidget(clients_container)
+
+        # Ajouter le layout horizontal au layout principal
+        layout.addLayout(tables_layout)
+
+        # Légende
+        legend = QLabel("● Actif")
+        legend.setStyleSheet("color: #a6e3a1; font-size: 12px;")
+        layout.addWidget(legend)
+
+    def add_logs(self, lines):
+        """Ajouter un lot de lignes dans les logs"""
+        self.pending_logs.extend(lines)
+
+    def add_router(self, router_info):
+        """Ajouter un routeur dans la table"""
+        self.pending_routers[router_info['id']] = router_info
+
+    def add_client(self, username, client_info):
+        """Ajouter un client dans la table"""
+        self.pending_clients[username] = client_info
+
+    def remove_client(self, username):
+        """Retirer un client de la table"""
+        self.pending_clients[username] = None
+
+    def remove_router(self, router_id):
+        """Retirer un routeur de la table"""
+        self.pending_routers[router_id] = None
+
+    def flush_events(self):
+        """Appliquer en une fois les évènements reçus depuis la dernière image"""
+        if self.pending_logs:
+            scrollbar = self.log_display.verticalScrollBar()
+            at_bottom = scrollbar.value() >= scrollbar.maximum() - 5
+            self.log_display.appendPlainText("\n".join(self.pending_logs))
+            self.pending_logs = []
+            if at_bottom:
+                scrollbar.setValue(scrollbar.maximum())
+
+        if self.pending_routers:
+            pending, self.pending_routers = self.pending_routers, {}
+            for router_id, info in pending.items():
+                if info is None:
+                    self.routers_model.remove(router_id)
+                else:
+                    self.routers_model.upsert(router_id, (str(router_id), f"{info['ip']}:{info['port']}", "●"))
+
+        if self.pending_clients:
+            pending, self.pending_clients = self.pending_clients, {}
+            for username, info in pending.items():
+                if info is None:
+                    self.clients_model.remove(username)
+                    continue
+                row = self.clients_model.index_of.get(username)
+                client_id = self.clients_model.rows[row][0] if row is not None else str(self.next_client_id)
+                if row is None:
+                    self.next_client_id += 1
+                self.clients_model.upsert(username, (client_id, username, f"{info['ip']}:{info['port']}", "●"))
+
+    def refresh_status(self):
+        """Rafraîchir l'affichage du statut"""
+        self.master_info.setText(f"{self.master.host}:{self.master.port}")
+
+    def stop_server(self):
+        """Arrêter le serveur"""
+        reply = QMessageBox.question(
+            self, 'Confirmation',
+            'Êtes-vous sûr de vouloir arrêter le serveur Master ?',
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+        )
+
+        if reply == QMessageBox.StandardButton.Yes:
+            self.master.stop()
+            self.close()
+
+    def closeEvent(self, event):
+        """Fermeture de la fenêtre"""
+        self.stop_server()
+        event.accept()
+
+
+class MasterLoginWindow(QDialog):
+    """Fenêtre de configuration du serveur Master"""
+    
+    def __init__(self):
+        super().__init__()
+        self.host = None
+        self.port = None
+        self.init_ui()
+        
+    def init_ui(self):
+        self.setWindowTitle("Configuration du serveur Master")
+        self.setFixedSize(400, 400)
+        self.setStyleSheet("""
+            QDialog {
+                background-color: #1e1e2e;
+            }
+            QLabel {
+                color: #cdd6f4;
+                font-size: 13px;
+            }
+            QLineEdit {
+                background-color: #313244;
+                border: 2px solid #45475a;
+                border-radius: 8px;
+                padding: 10px;
+                color: #cdd6f4;
+                font-size: 13px;
+            }
+            QLineEdit:focus {
+                border: 2px solid #89b4fa;
+            }
+            QPushButton {
+                background-color: #89b4fa;
+                color: #1e1e2e;
+                border: none;
+                border-radius: 8px;
+                padding: 12px;
+                font-weight: bold;
+                font-size: 13px;
+            }
+            QPushButton:hover {
+                background-color: #74c7ec;
+            }
+            QPushButton:pressed {
+                background-color: #89dceb;
+            }
+        """)
+        
+        layout = QVBoxLayout()
+        layout.setSpacing(15)
+        layout.setContentsMargins(30, 30, 30, 30)
+        
+        # Titre
+        title = QLabel("Configuration du serveur Master")
+        title.setStyleSheet("font-size: 18px; font-weight: bold; color: #89b4fa;")
+        title.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        layout.addWidget(title)
+        
+        layout.addSpacing(20)
+        
+        # IP du serveur
+        ip_label = QLabel("Adresse IP du serveur :")
+        layout.addWidget(ip_label)
+        
+        self.ip_input = QLineEdit()
+        self.ip_input.setPlaceholderText("127.0.0.1")
+        self.ip_input.setText("127.0.0.1")
+        self.ip_input.setMinimumHeight(40)
+        layout.addWidget(self.ip_input)
+        
+        # Port du serveur
+        port_label = QLabel("Port du serveur :")
+        layout.addWidget(port_label)
+        
+        self.port_input = QLineEdit()
+        self.port_input.setPlaceholderText("6000")
+        self.port_input.setText("6000")
+        self.port_input.setMinimumHeight(40)
+        layout.addWidget(self.port_input)
+        
+        layout.addSpacing(20)
+        
+        # Information
+        info_label = QLabel("Note : Le serveur essayera les ports 6000-6002 et 7000 si le port spécifié est occupé.")
+        info_label.setStyleSheet("color: #bac2de; font-size: 11px; font-style: italic;")
+        info_label.setWordWrap(True)
+        layout.addWidget(info_label)
+        
+        layout.addSpacing(10)
+        
+        # Boutons
+        buttons_layout = QHBoxLayout()
+        
+        cancel_btn = QPushButton("Annuler")
+        cancel_btn.setMinimumHeight(45)
+        cancel_btn.clicked.connect(self.reject)
+        buttons_layout.addWidget(cancel_btn)
+        
+        start_btn = QPushButton("Démarrer le serveur")
+        start_btn.setMinimumHeight(45)
+        start_btn.clicked.connect(self.validate_and_start)
+        buttons_layout.addWidget(start_btn)
+        
+        layout.addLayout(buttons_layout)
+        
+        self.setLayout(layout)
+        
+        # Enter pour valider
+        self.ip_input.returnPressed.connect(self.validate_and_start)
+        self.port_input.returnPressed.connect(self.validate_and_start)
+        
+    def validate_ip(self, ip):
+        """Valide une adresse IPv4"""
+        try:
+            socket.inet_aton(ip)
+            return True
+        except socket.error:
+            return False
+            
+    def validate_and_start(self):
+        ip = self.ip_input.text().strip()
+        port_text = self.port_input.text().strip()
+        
+        # Validation IP
+        if ip == "":
+            ip = "127.0.0.1"
+        elif not self.validate_ip(ip):
+            QMessageBox.warning(self, "Erreur", "Adresse IP invalide")
+            return
+            
+        # Validation port
+        if not port_text:
+            QMessageBox.warning(self, "Erreur", "Veuillez entrer un port")
+            return
+            
+        try:
+            port = int(port_text)
+            if not (1 <= port <= 65535):
+                QMessageBox.warning(self, "Erreur", "Le port doit être entre 1 et 65535")
+                return
+        except ValueError:
+            QMessageBox.warning(self, "Erreur", "Le port doit être un nombre")
+            return
+            
+        self.host = ip
+        self.port = port
+        self.accept()
+
+
+# ---------- LANCEMENT ----------
+def run_gui(start_server, host=None, port=None):
+    """Afficher la configuration (si host/port manquent) puis la fenêtre principale
+    
+    start_server(host, port) crée et démarre le MasterServer, ou retourne None.
+    """
+    app = QApplication(sys.argv)
+    if host is None or port is None:
+        login_window = MasterLoginWindow()
+        if login_window.exec() != QDialog.DialogCode.Accepted:
+            print("[MASTER] Configuration annulée")
+            return 0
+        
+        # Récupérer les paramètres
+        host = login_window.host
+        port = login_window.port
+    
+    master_server = start_server(host, port)
+    if master_server is None:
+        QMessageBox.critical(None, "Erreur", f"Impossible de démarrer le serveur sur {host}:{port}")
+        return 1
+    
+    # Afficher la fenêtre principale
+    window = MasterWindow(master_server)
+    window.show()
+    return app.exec()
@@ -0,0 +1,149 @@
+"""Micro-benchmarks des fonctions de chiffrement (chemins critiques par caractère)
+
+    python microbench.py                  # mesurer et comparer à la référence
+    python microbench.py --save           # enregistrer les mesures comme référence
+    python microbench.py -k build_onion   # seulement les cas dont le nom contient ce texte
+
+Chaque cas est chronométré avec timeit (meilleur de --repeat séries). La
+référence est stockée dans microbench_baseline.json ; un cas plus lent que
+référence x --threshold est signalé et le script se termine avec le code 1.
+Les mesures dépendent de la machine : enregistrer la référence sur la machine
+qui sert aux comparaisons.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+from client import ChatClient
+from master import generate_keys
+from router import decrypt, peel_layer
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "microbench_baseline.json")
+MESSAGE_SIZES = (16, 256, 4096)
+LAYER_COUNTS = (1, 3, 5)
+REGRESSION_THRESHOLD = 1.25  # Plus lent que 125 % de la référence = régression
+
+
+def make_routers(count, rng):
+    """Chemin de routeurs fictifs avec leurs clés (publique pour le client, privée pour decrypt)"""
+    routers = []
+    for i in range(count):
+        random.seed(rng.random())
+        pub, priv = generate_keys()
+        routers.append({"ip": "127.0.0.1", "port": 5001 + i, "pub_key": pub, "priv_key": priv})
+    return routers
+
+
+def build_cases():
+    """Liste des cas : (nom, fonction sans argument)"""
+    rng = random.Random(1234)  # Mêmes clés et messages d'une exécution à l'autre
+    client = ChatClient()
+    target = {"ip": "127.0.0.1", "port": 7001}
+    routers = make_routers(max(LAYER_COUNTS), rng)
+    key = routers[0]["pub_key"]
+    cases = [("generate_keys", generate_keys)]
+
+    for size in MESSAGE_SIZES:
+        message = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(size))
+        cases.append((f"encrypt_message[size={size}]",
+                      lambda message=message: client.encrypt_message(message, key)))
+
+        cipher = client.encrypt_message(message, key)
+        priv = routers[0]["priv_key"]
+        cases.append((f"router.decrypt[size={size}]",
+                      lambda cipher=cipher, priv=priv: decrypt(cipher, priv)))
+
+        # Couche complète telle que reçue par un routeur (octets -> en-tête + contenu)
+        layer = client.build_onion(f"bench:{message}", routers[:2], target)
+        cases.append((f"router.peel_layer[size={size}]",
+                      lambda layer=layer, priv=priv: peel_layer(layer, priv)))
+
+        for layers in LAYER_COUNTS:
+            path = routers[:layers]
+            cases.append((f"build_onion[size={size},layers={layers}]",
+                          lambda message=message, path=path: client.build_onion(f"bench:{message}", path, target)))
+    return cases
+
+
+def measure(func, repeat):
+    """Temps par appel (secondes) : meilleur et médiane de repeat séries"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()  # Nombre d'appels pour une série d'au moins 0,2 s
+    runs = sorted(t / number for t in timer.repeat(repeat=repeat, number=number))
+    return {"best": runs[0], "median": runs[len(runs) // 2], "calls": number}
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.0f} ns"
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the crypto hot paths")
+    parser.add_argument("-k", "--filter", default="", help="only run cases whose name contains this text")
+    parser.add_argument("--repeat", type=int, default=5, help="timing series per case (default: 5)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline file")
+    parser.add_argument("--save", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown ratio reported as a regression (default: 1.25)")
+    args = parser.parse_args()
+
+    baseline = None if args.save else load_baseline(args.baseline)
+    reference = baseline["results"] if baseline else {}
+    results = {}
+    regressions = []
+
+    print(f"{'case':<36} {'best':>11} {'median':>11} {'vs baseline':>12}")
+    for name, func in build_cases():
+        if args.filter not in name:
+            continue
+        result = measure(func, args.repeat)
+        results[name] = result
+        comparison = ""
+        if name in reference:
+            ratio = result["best"] / reference[name]["best"]
+            comparison = f"{ratio:10.2f}x"
+            if ratio > args.threshold:
+                comparison += " !"
+                regressions.append((name, ratio))
+        print(f"{name:<36} {format_time(result['best']):>11} {format_time(result['median']):>11} {comparison:>12}")
+
+    if args.save:
+        saved = load_baseline(args.baseline) or {}
+        saved_results = saved.get("results", {})
+        saved_results.update(results)  # Garder les cas non mesurés cette fois (filtre -k)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": saved_results,
+            }, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nBaseline saved to {args.baseline}")
+    elif baseline is None:
+        print(f"\nNo baseline at {args.baseline} (run with --save to create it)")
+    elif regressions:
+        print(f"\n{len(regressions)} regression(s) above {args.threshold:.2f}x:")
+        for name, ratio in regressions:
+            print(f"   {name}: {ratio:.2f}x slower")
+        sys.exit(1)
+    else:
+        print("\nNo regression against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Format des couches de l'oignon (client -> routeurs)
+
+Une couche est faite d'un en-tête de taille fixe chiffré en RSA pour le
+routeur, suivi du contenu chiffré symétriquement :
+
+    LAYER_MAGIC (1 octet) | en-tête (HEADER_SIZE octets) | contenu
+
+L'en-tête en clair est "ip;port;clé" complété par des espaces jusqu'à
+HEADER_CHARS caractères, chaque caractère chiffré en RSA et stocké sur 4
+octets. La clé (aléatoire, propre à la couche) sert à retirer la couche
+symétrique du contenu : le routeur ne fait donc du RSA que sur l'en-tête,
+quelle que soit la taille du message, puis transmet le contenu dévoilé
+(couche suivante ou message final "utilisateur:message") à ip:port.
+
+L'ancien format (nombres séparés par des virgules, tout le contenu chiffré
+en RSA, donc un coût par routeur qui croît avec la taille du message) n'est
+plus accepté par les routeurs.
+"""
+import hashlib
+import struct
+
+LAYER_MAGIC = b"\x02"
+HEADER_CHARS = 64  # "255.255.255.255;65535;<32 caractères hexadécimaux>" tient dedans
+HEADER_ITEM = struct.Struct("!I")  # Un caractère chiffré (entier < n)
+HEADER_SIZE = HEADER_CHARS * HEADER_ITEM.size
+HEADER_FORMAT = struct.Struct(f"!{HEADER_CHARS}I")
+KEY_SIZE = 16
+KEYSTREAM_BLOCK = 64 * 1024  # Flux de clé calculé par blocs : on peut commencer à n'importe quel décalage
+
+
+def is_layer(data):
+    """La couche reçue est-elle au format en-tête + contenu ?"""
+    return data[:1] == LAYER_MAGIC
+
+
+def format_header(ip, port, key):
+    """En-tête en clair, de longueur fixe"""
+    header = f"{ip};{port};{key.hex()}"
+    if len(header) > HEADER_CHARS:
+        raise ValueError(f"Layer header too long: {header!r}")
+    return header.ljust(HEADER_CHARS)
+
+
+def parse_header(text):
+    """'ip;port;clé' -> (ip, port, clé) ; ValueError si l'en-tête est invalide"""
+    ip, port, key = text.strip().split(";")
+    key = bytes.fromhex(key)
+    if len(key) != KEY_SIZE:
+        raise ValueError("Invalid layer key")
+    return ip, int(port), key
+
+
+def keystream(key, offset, size):
+    """Octets offset..offset+size du flux de clé (SHAKE-256 par blocs numérotés)"""
+    first = offset // KEYSTREAM_BLOCK
+    end = offset + size
+    blocks = []
+    for index in range(first, (end - 1) // KEYSTREAM_BLOCK + 1):
+        length = min(KEYSTREAM_BLOCK, end - index * KEYSTREAM_BLOCK)
+        blocks.append(hashlib.shake_256(key + index.to_bytes(8, "big")).digest(length))
+    start = offset - first * KEYSTREAM_BLOCK
+    return b"".join(blocks)[start:start + size]
+
+
+def xor_stream(data, key, offset=0):
+    """Ajouter ou retirer la couche symétrique (même opération dans les deux sens)"""
+    size = len(data)
+    if not size:
+        return b""
+    mask = int.from_bytes(keystream(key, offset, size), "big")
+    return (int.from_bytes(data, "big") ^ mask).to_bytes(size, "big")
+
+
+def pack_layer(header_cipher, key, payload):
+    """Couche complète à partir de l'en-tête chiffré (liste d'entiers) et du contenu en clair"""
+    return LAYER_MAGIC + HEADER_FORMAT.pack(*header_cipher) + xor_stream(payload, key)
+
+
+def unpack_header(data):
+    """Entiers de l'en-tête chiffré et vue sur le contenu encore chiffré"""
+    if len(data) < 1 + HEADER_SIZE:
+        raise ValueError("Truncated layer")
+    view = memoryview(data)
+    return HEADER_FORMAT.unpack_from(view, 1), view[1 + HEADER_SIZE:]
@@ -0,0 +1,329 @@
+"""Fonctions partagées du protocole réseau (master, routeurs, clients)"""
+import socket
+import struct
+import threading
+import time
+
+# ---------- CANAL DE CONTRÔLE (client <-> master) ----------
+# Après l'inscription, chaque commande et chaque réponse tient sur une ligne
+# terminée par "\n". Une commande peut être préfixée par un ID de requête
+# ("12#PATH:..."), le master renvoie alors la réponse avec le même préfixe
+# ("12#...") : plusieurs requêtes peuvent ainsi être en vol en même temps.
+LINE_SEP = b"\n"
+MAX_LINE = 65536  # Commande reçue par le master
+# Réponse reçue par le client : ONLINE et PATHS grandissent avec le nombre
+# d'utilisateurs (PATHS est en plus découpé par le client, voir PATHS_BATCH)
+MAX_REPLY_LINE = 4 * 1024 * 1024
+
+
+def format_line(payload, request_id=None):
+    """Encoder une ligne du canal de contrôle (avec ID de requête optionnel)"""
+    if request_id is None:
+        return f"{payload}\n".encode()
+    return f"{request_id}#{payload}\n".encode()
+
+
+def parse_line(line):
+    """Séparer l'ID de requête du contenu: '12#LIST' -> (12, 'LIST')"""
+    prefix, sep, rest = line.partition("#")
+    if sep and prefix.isdigit():
+        return int(prefix), rest
+    return None, line
+
+
+class LineReader:
+    """Découpe le flux d'une socket en lignes"""
+
+    def __init__(self, sock, max_line=MAX_LINE):
+        self.sock = sock
+        self.max_line = max_line
+        self.buffer = b""
+
+    def readline(self):
+        """Retourne la ligne suivante (sans '\\n'), ou None à la fermeture"""
+        while LINE_SEP not in self.buffer:
+            if len(self.buffer) > self.max_line:
+                raise ValueError("Line too long")
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                return None
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(LINE_SEP, 1)
+        return line.decode().strip()
+
+
+# ---------- TRAMES ENTRE SAUTS (client -> routeurs -> client) ----------
+# Chaque connexion vers un routeur ou vers l'écoute d'un client transporte
+# une ou plusieurs trames jusqu'à sa fermeture :
+#   type (1 octet) | longueur (4 octets, big-endian) | contenu
+FRAME_HEADER = struct.Struct("!BI")
+FRAME_MESSAGE = 1
+FRAME_BATCH = 2  # Contenu = suite de trames FRAME_MESSAGE / FRAME_TRACED (envoi groupé)
+FRAME_TRACED = 3  # Contenu = identifiant de trace (TRACE_ID_SIZE octets) + oignon
+FRAME_BUSY = 4  # Routeur -> émetteur, avant fermeture : connexion délestée (contenu = raison)
+TRACE_ID_SIZE = 8
+# Trame lue en entier : c'est aussi la taille max d'un message final, que le client
+# destinataire reçoit d'un bloc (les routeurs relaient en flux les oignons plus grands,
+# voir MAX_STREAM_FRAME dans router.py, mais pas au-delà de cette limite pour le client)
+MAX_FRAME = 16 * 1024 * 1024  # 16 Mo
+# Durée de vie d'une connexion inutilisée du pool : nettement plus courte que
+# l'inactivité tolérée par le destinataire (client 10 s, routeur 30 s), pour ne
+# jamais réutiliser une connexion qu'il est en train de fermer
+POOL_IDLE_TIMEOUT = 5.0
+
+
+class Overloaded(ConnectionError):
+    """Le saut suivant a délesté notre connexion (trame FRAME_BUSY) : choisir un autre chemin"""
+
+
+def pack_frame(payload, kind=FRAME_MESSAGE):
+    """Encoder une trame"""
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+def payload_parts(payload):
+    """Contenu d'une trame sous forme de morceaux : bytes, memoryview ou liste de morceaux"""
+    if isinstance(payload, (list, tuple)):
+        return [memoryview(part).cast("B") for part in payload]
+    return [memoryview(payload).cast("B")]
+
+
+def payload_size(payload):
+    return sum(part.nbytes for part in payload_parts(payload))
+
+
+def send_buffers(sock, buffers):
+    """Envoyer plusieurs tampons à la suite sans les concaténer (sendmsg si disponible)"""
+    buffers = [buffer for buffer in buffers if buffer.nbytes]
+    if not hasattr(sock, "sendmsg"):  # Windows
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        # Envoi partiel : retirer ce qui est parti, reprendre au milieu d'un tampon
+        while buffers and sent >= buffers[0].nbytes:
+            sent -= buffers[0].nbytes
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def send_frame(sock, payload, kind=FRAME_MESSAGE):
+    """Envoyer une trame complète
+    
+    payload peut être une liste de morceaux (identifiant de trace + oignon...) :
+    l'en-tête et les morceaux partent ensemble sans copie intermédiaire.
+    """
+    parts = payload_parts(payload)
+    header = memoryview(FRAME_HEADER.pack(kind, sum(part.nbytes for part in parts)))
+    send_buffers(sock, [header] + parts)
+
+
+def is_readable(sock):
+    """Des données (ou la fermeture) attendent-elles sur la socket ? Sans bloquer
+    
+    Lecture MSG_PEEK non bloquante plutôt que select.select, limité aux
+    descripteurs inférieurs à 1024.
+    """
+    timeout = sock.gettimeout()
+    try:
+        sock.setblocking(False)
+        sock.recv(1, socket.MSG_PEEK)
+        return True  # Octet en attente, ou b"" : fermeture par l'autre bout
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True  # Erreur en attente : la prochaine lecture la signalera
+    finally:
+        sock.settimeout(timeout)
+
+
+def recv_exact(sock, size):
+    """Lire exactement size octets (bytearray) ; None si la connexion est fermée avant le premier octet"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            if received == 0:
+                return None
+            raise ConnectionError(f"Connection closed after {received}/{size} bytes")
+        received += count
+    return buffer
+
+
+def recv_frame_header(sock, max_size=MAX_FRAME):
+    """Lire seulement l'en-tête d'une trame : (type, longueur), ou None en fin de connexion
+    
+    Le contenu reste à lire (recv_exact) : permet de le traiter au fil de l'eau.
+    """
+    header = recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    kind, length = FRAME_HEADER.unpack(header)
+    if length > max_size:
+        raise ValueError(f"Frame too large ({length} bytes)")
+    return kind, length
+
+
+def recv_frame(sock, max_size=MAX_FRAME):
+    """Lire une trame : (type, contenu), ou None en fin de connexion"""
+    header = recv_frame_header(sock, max_size)
+    if header is None:
+        return None
+    kind, length = header
+    payload = recv_exact(sock, length) if length else b""
+    if payload is None:
+        raise ConnectionError("Connection closed before frame payload")
+    return kind, payload
+
+
+# Message final remis au client : "expéditeur:" + contenu. Un message texte commence
+# par le préfixe de contrôle puis MSG_TEXT (voir transfer.py et delivery.py) ; les
+# accusés de réception et les transferts de fichiers ont d'autres types.
+TEXT_MESSAGE_PREFIX = b"\x00\x04"
+MAX_SENDER = 255  # Longueur max du nom de l'expéditeur cherchée avant ':'
+
+
+def is_text_message(payload):
+    """Le message final est-il un message texte ? (seul gardé en boîte aux lettres)"""
+    head = bytes(payload[:MAX_SENDER + 1 + len(TEXT_MESSAGE_PREFIX)])
+    index = head.find(b":")
+    return index > 0 and head[index + 1:index + 1 + len(TEXT_MESSAGE_PREFIX)] == TEXT_MESSAGE_PREFIX
+
+
+def pack_batch(frames):
+    """Contenu d'une trame FRAME_BATCH regroupant plusieurs oignons [(type, contenu), ...]"""
+    return b"".join(pack_frame(payload, kind) for kind, payload in frames)
+
+
+def iter_batch(data):
+    """Parcourir les trames (type, contenu) contenues dans une trame FRAME_BATCH"""
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        if offset + FRAME_HEADER.size > len(view):
+            raise ValueError("Truncated batch")
+        kind, length = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        if offset + length > len(view):
+            raise ValueError("Truncated batch")
+        yield kind, view[offset:offset + length]  # Sans copie : vue sur la trame reçue
+        offset += length
+
+
+def pack_traced(trace_id, payload):
+    """Contenu d'une trame FRAME_TRACED (trace_id en hexadécimal)"""
+    return bytes.fromhex(trace_id) + payload
+
+
+def traced_parts(trace_id, payload):
+    """Comme pack_traced, en morceaux pour send_frame (l'oignon n'est pas recopié)"""
+    return [bytes.fromhex(trace_id), payload]
+
+
+def unpack_traced(data):
+    """Séparer l'identifiant de trace (hexadécimal) de l'oignon
+    
+    Sur une memoryview, l'oignon renvoyé est une vue (pas de copie).
+    """
+    if len(data) < TRACE_ID_SIZE:
+        raise ValueError("Truncated traced frame")
+    return bytes(data[:TRACE_ID_SIZE]).hex(), data[TRACE_ID_SIZE:]
+
+
+class ConnectionPool:
+    """Connexions réutilisables vers les sauts suivants (une par adresse)
+
+    Une connexion transporte plusieurs trames : un envoi groupé ne paie la
+    connexion TCP qu'une fois par destination. Partagée entre threads (et entre
+    les routeurs d'un même processus) : les envois vers une même adresse sont
+    sérialisés, ceux vers des adresses différentes sont parallèles.
+    """
+
+    def __init__(self, timeout=5.0, idle_timeout=POOL_IDLE_TIMEOUT, bytes_out=None):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.bytes_out = bytes_out  # Compteur (metrics) des octets envoyés, optionnel
+        self._conns = {}  # (ip, port) -> [socket, dernier usage]
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _lock_for(self, addr):
+        with self._lock:
+            return self._locks.setdefault(addr, threading.Lock())
+
+    def _connect(self, addr):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(addr)
+        return sock
+
+    def _is_stale(self, sock, last_used):
+        """Connexion trop ancienne ou fermée par le destinataire"""
+        if time.monotonic() - last_used > self.idle_timeout:
+            return True
+        # Lisible alors que le destinataire n'envoie rien = fermeture (EOF) ou délestage
+        return is_readable(sock)
+
+    def _busy_reason(self, sock):
+        """Raison de la trame FRAME_BUSY laissée par le destinataire, ou None"""
+        try:
+            sock.setblocking(False)
+            data = sock.recv(FRAME_HEADER.size + 256)
+        except OSError:
+            return None
+        if len(data) < FRAME_HEADER.size or data[0] != FRAME_BUSY:
+            return None
+        _, length = FRAME_HEADER.unpack_from(data)
+        return data[FRAME_HEADER.size:FRAME_HEADER.size + length].decode(errors="replace")
+
+    def _take(self, addr):
+        """Connexion pour addr (appelé avec le verrou de addr) : (socket, réutilisée ?)
+        
+        Lève Overloaded si le destinataire a délesté la connexion gardée : la
+        trame part ailleurs plutôt que de le solliciter à nouveau tout de suite.
+        """
+        entry = self._conns.pop(addr, None)
+        if entry and self._is_stale(*entry):
+            reason = self._busy_reason(entry[0])
+            self._close(entry[0])
+            if reason is not None:
+                raise Overloaded(f"{addr[0]}:{addr[1]} shed the connection ({reason})")
+            entry = None
+        if entry:
+            return entry[0], True
+        return self._connect(addr), False
+
+    def send(self, addr, payload, kind=FRAME_MESSAGE):
+        """Envoyer une trame à addr en réutilisant la connexion si possible"""
+        with self._lock_for(addr):
+            sock, reused = self._take(addr)
+            if self.bytes_out is not None:
+                self.bytes_out.inc(payload_size(payload))
+            try:
+                send_frame(sock, payload, kind)
+            except OSError:
+                self._close(sock)
+                if not reused:
+                    raise
+                # Connexion réutilisée morte entre-temps : une seule nouvelle tentative
+                sock = self._connect(addr)
+                send_frame(sock, payload, kind)
+            self._conns[addr] = [sock, time.monotonic()]
+
+    def _close(self, sock):
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def close(self):
+        """Fermer toutes les connexions"""
+        with self._lock:
+            entries = list(self._conns.values())
+            self._conns.clear()
+        for sock, _ in entries:
+            self._close(sock)
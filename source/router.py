@@ -1,17 +1,78 @@
+import argparse
+import queue
 import socket
+import selectors
 import threading
 import time
 import sys
 import signal
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import tracing
+from config import add_config_argument, port_type, resolve
+from onion import HEADER_SIZE, is_layer, parse_header, unpack_header, xor_stream
+from protocol import (
+    FRAME_BATCH, FRAME_BUSY, FRAME_HEADER, FRAME_MESSAGE, FRAME_TRACED, MAX_FRAME, TRACE_ID_SIZE,
+    ConnectionPool, is_readable, is_text_message, iter_batch, pack_frame, payload_parts, payload_size,
+    recv_exact, recv_frame_header, send_buffers, traced_parts, unpack_traced
+)
 
 # Configuration par défaut
 MASTER_IP = "127.0.0.1"
 MASTER_PORT = 6000
 
-ROUTER_IP = "127.0.0.1"  # Sera demandé au démarrage
-ROUTER_PORT = None  # Sera demandé au démarrage
-private_key = None
-router_id = None  # ID du routeur attribué par le master
+IDLE_TIMEOUT = 30  # Fermeture d'une connexion entrante inactive (secondes)
+LISTEN_BACKLOG = 5  # Connexions en attente d'acceptation, par routeur
+ROUTER_WORKERS = 32  # Threads de traitement des trames (tous les routeurs du processus)
+WORK_QUEUE_SIZE = 256  # Connexions prêtes en attente d'un thread libre, au-delà : délestage
+MAX_CONNECTIONS = 1024  # Connexions entrantes ouvertes en même temps, au-delà : délestage
+RATE_LIMIT = 2000  # Connexions + oignons par seconde et par adresse source (0 = sans limite)
+RATE_BURST = 2  # Seau de jetons : RATE_LIMIT * RATE_BURST jetons au plus
+RATE_BUCKETS_MAX = 10000  # Adresses suivies au plus (les moins récemment vues sont oubliées)
+FRAMES_PER_TURN = 32  # Trames traitées d'affilée sur une connexion avant de la rendre
+SHED_DRAIN_READS = 4  # Lectures de ce qui est déjà arrivé avant de fermer une connexion délestée
+FORWARD_QUEUE_DEPTH = 256  # Trames en attente max par saut suivant
+FORWARD_QUEUE_BYTES = 8 * 1024 * 1024  # Octets en attente max par saut suivant
+FORWARD_POLICY = "defer"  # File pleine : "defer" attend une place (FORWARD_DEFER_TIMEOUT), "drop" abandonne
+FORWARD_DEFER_TIMEOUT = 0.5  # Attente max d'une place dans une file pleine (secondes)
+FORWARD_DOWN_DELAY = 1.0  # Après un échec d'envoi, trames vers ce saut abandonnées pendant ce délai (s)
+FORWARD_BATCH = 64  # Trames envoyées d'un coup (FRAME_BATCH) par le thread d'un saut
+FORWARD_BATCH_BYTES = 1024 * 1024  # Taille max d'un envoi groupé
+FORWARD_SENDER_IDLE = 30.0  # Arrêt du thread d'envoi d'un saut resté sans trame (secondes)
+ACCEPT_POLL = 1.0  # Réveil de la boucle d'acceptation pour voir l'arrêt (secondes)
+REGISTER_WORKERS = 16  # Inscriptions / désinscriptions simultanées auprès du master
+EVENT_BUFFER_SIZE = 5000  # Évènements en attente max avant envoi au master
+EVENT_FLUSH_INTERVAL = 2.0  # Envoi des évènements au master (secondes)
+STREAM_THRESHOLD = 256 * 1024  # Trame relayée en flux au-delà de cette taille (octets)
+STREAM_CHUNK = 64 * 1024  # Morceau lu, dévoilé et transmis à la fois en flux
+STREAM_MAX_LAYERS = 32  # Couches au plus d'un oignon relayé en flux
+# Un oignon ne dépasse le message final que de ses en-têtes de couche ; le message
+# final est lu en entier par le client destinataire (MAX_FRAME)
+MAX_STREAM_FRAME = MAX_FRAME + STREAM_MAX_LAYERS * (1 + HEADER_SIZE)
+MAILBOX_MAX_MESSAGE = 32 * 1024  # Au-delà, un message non remis n'est pas confié au master
+MAILBOX_QUEUE_SIZE = 1024  # Messages non remis en attente d'envoi au master, au-delà : abandon
+MAILBOX_BATCH = 64  # Messages non remis envoyés au master par connexion
+MAILBOX_TIMEOUT = 5.0  # Connexion et échange d'un lot avec le master (secondes)
+
+# ---------- METRICS ----------
+ROUTERS_HOSTED = metrics.gauge("onion_router_hosted_routers", "Routeurs inscrits hébergés par ce processus")
+CONNECTIONS_ACTIVE = metrics.gauge("onion_router_active_connections", "Connexions entrantes ouvertes")
+CONNECTIONS_SHED = metrics.counter("onion_router_shed_total", "Connexions délestées (trame FRAME_BUSY)", ("reason",))
+WORK_QUEUE = metrics.gauge("onion_router_work_queue", "Connexions prêtes en attente d'un thread du pool")
+ONIONS_RECEIVED = metrics.counter("onion_router_onions_received_total", "Oignons reçus")
+ONIONS_STREAMED = metrics.counter("onion_router_onions_streamed_total", "Oignons relayés en flux (grandes trames)")
+BYTES_IN = metrics.counter("onion_router_bytes_in_total", "Octets d'oignons reçus")
+BYTES_OUT = metrics.counter("onion_router_bytes_out_total", "Octets transmis au saut suivant")
+DECRYPT_SECONDS = metrics.histogram("onion_router_decrypt_seconds", "Déchiffrement d'une couche")
+FORWARD_SECONDS = metrics.histogram("onion_router_forward_seconds", "Connexion et envoi au saut suivant")
+FORWARD_ERRORS = metrics.counter("onion_router_forward_errors_total", "Échecs de transmission", ("reason",))
+FORWARD_QUEUED = metrics.gauge("onion_router_forward_queued", "Trames en attente d'envoi (tous sauts suivants)")
+FORWARD_QUEUES = metrics.gauge("onion_router_forward_queues", "Sauts suivants avec une file et un thread d'envoi")
+FORWARD_QUEUE_SECONDS = metrics.histogram("onion_router_forward_queue_seconds", "Attente d'une trame dans la file du saut suivant")
+FORWARD_DEFERRED = metrics.counter("onion_router_forward_deferred_total", "Trames ayant attendu une place dans une file pleine")
+FORWARD_DROPPED = metrics.counter("onion_router_forward_dropped_total", "Trames abandonnées avant envoi", ("reason",))
+MAILBOX_DEPOSITS = metrics.counter("onion_router_mailbox_deposits_total", "Messages finaux non remis confiés au master", ("result",))
 
 # ---------- UTILITY FUNCTIONS ----------
 def validate_ip(ip):
@@ -22,42 +83,358 @@ def validate_ip(ip):
     except socket.error:
         return False
 
-# ---------- UNREGISTER ----------
-def unregister(master_ip, master_port):
-    """Se désincrire du master lors de l'arrêt"""
-    global router_id
-    
-    if router_id is None:
-        return False
-    
-    print(f"\n[ROUTER] Unregistering from master...")
-    
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)
-        sock.connect((master_ip, master_port))
-        
-        # Envoyer le type de requête
-        sock.send(b"UNREGISTER_ROUTER")
-        time.sleep(0.1)
-        
-        # Envoyer l'ID du routeur
-        sock.send(str(router_id).encode())
-        
-        # Attendre la confirmation
-        response = sock.recv(1024).decode().strip()
-        sock.close()
-        
-        if response == "OK":
-            print(f"[ROUTER] Successfully unregistered (ID: {router_id})")
-            return True
+# ---------- EVENTS ----------
+class EventReporter:
+    """Évènements des routeurs d'un processus envoyés au master par lots (table logs)
+
+    record() ajoute à un tampon borné sans bloquer le traitement des messages ;
+    un thread envoie le tampon au master toutes les EVENT_FLUSH_INTERVAL secondes,
+    en une seule connexion pour tous les routeurs hébergés.
+    """
+
+    def __init__(self, capacity=EVENT_BUFFER_SIZE, flush_interval=EVENT_FLUSH_INTERVAL):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.buffer = deque()  # (router_id, ligne)
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.master = None
+
+    def record(self, router_id, event_type, message):
+        """Ajouter un évènement (connexion, message_recu, message_envoye, erreur...)"""
+        if router_id is None:
+            return  # Routeur pas (ou plus) inscrit : rien à rattacher côté master
+        message = message.replace("\n", " ").replace("\t", " ")
+        with self.lock:
+            if len(self.buffer) >= self.capacity:
+                self.dropped += 1
+                return
+            self.buffer.append((router_id, f"{event_type}\t{time.time():.3f}\t{message}"))
+
+    def start(self, master_ip, master_port):
+        self.master = (master_ip, master_port)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Envoyer le tampon au master ; remis en file si le master est injoignable"""
+        with self.lock:
+            entries = list(self.buffer)
+            self.buffer.clear()
+        if not entries or not self.master:
+            return
+        # 'router_id' puis les évènements ; '@router_id' quand le routeur change
+        lines = [str(entries[0][0])]
+        current = entries[0][0]
+        for router_id, line in entries:
+            if router_id != current:
+                lines.append(f"@{router_id}")
+                current = router_id
+            lines.append(line)
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            sock.connect(self.master)
+            sock.send(b"EVENTS")
+            time.sleep(0.1)
+            sock.sendall("\n".join(lines).encode())
+            sock.shutdown(socket.SHUT_WR)
+            sock.recv(16)
+            sock.close()
+        except Exception as e:
+            print(f"[ROUTER] X Event upload error: {type(e).__name__}: {e}")
+            with self.lock:
+                # Garder les plus récents dans la limite du tampon
+                kept = entries[-max(self.capacity - len(self.buffer), 0):] if self.capacity > len(self.buffer) else []
+                self.dropped += len(entries) - len(kept)
+                self.buffer.extendleft(reversed(kept))
+
+# ---------- BOÎTE AUX LETTRES ----------
+class MailDrop:
+    """Messages finaux non remis confiés au master par lots (boîte aux lettres)
+
+    put() ajoute à une file bornée sans attendre le master : il est appelé par
+    les threads du pool et par les threads d'envoi des sauts suivants. Un
+    thread unique vide la file, jusqu'à MAILBOX_BATCH messages par connexion.
+    """
+
+    def __init__(self, capacity=MAILBOX_QUEUE_SIZE, batch_size=MAILBOX_BATCH):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.items = deque()  # (ip, port, message) du client injoignable
+        self.cond = threading.Condition()
+        self.master = None
+
+    def put(self, ip, port, payload):
+        """Mettre un message en file ; False si la file est pleine"""
+        with self.cond:
+            if len(self.items) >= self.capacity:
+                MAILBOX_DEPOSITS.inc(result="dropped")
+                return False
+            self.items.append((ip, port, bytes(payload)))
+            self.cond.notify()
+        return True
+
+    def start(self, master_ip, master_port):
+        self.master = (master_ip, master_port)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.items:
+                    self.cond.wait()
+            self.flush()
+
+    def flush(self):
+        """Envoyer au master tout ce qui est en file, par lots"""
+        while self.master:
+            with self.cond:
+                batch = [self.items.popleft() for _ in range(min(self.batch_size, len(self.items)))]
+            if not batch:
+                return
+            for (ip, port, _), reply in zip(batch, self._send(batch)):
+                MAILBOX_DEPOSITS.inc(result="ok" if reply == "OK" else "refused")
+                print(f"[ROUTER] Undelivered message for {ip}:{port} left to the master mailbox: {reply}")
+
+    def _send(self, batch):
+        """Un lot en une connexion : 'MAILBOX\n' puis 'ip;port;taille\n' + message par
+        message ; une réponse par ligne ("OK" ou "ERROR:...")"""
+        data = [b"MAILBOX\n"]
+        for ip, port, payload in batch:
+            data.append(f"{ip};{port};{len(payload)}\n".encode())
+            data.append(payload)
+        try:
+            with socket.create_connection(self.master, timeout=MAILBOX_TIMEOUT) as sock:
+                sock.sendall(b"".join(data))
+                sock.shutdown(socket.SHUT_WR)
+                chunks = []
+                while chunk := sock.recv(4096):
+                    chunks.append(chunk)
+            replies = b"".join(chunks).decode(errors="replace").split("\n")
+        except OSError as e:
+            replies = [f"ERROR:{type(e).__name__}"] * len(batch)
+        return replies + ["ERROR:NO_REPLY"] * (len(batch) - len(replies))
+
+# ---------- FORWARDING ----------
+class HopQueue:
+    """File bornée des trames vers un saut suivant, vidée par son propre thread"""
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.items = deque()  # (routeur, oignon, trace_id, trace, mise en file)
+        self.bytes = 0
+        self.down_until = 0.0  # Dernier envoi en échec : trames refusées jusqu'à cet instant
+        self.progress = time.monotonic()  # Dernières trames prises par le thread d'envoi
+        self.closed = False  # Thread d'envoi arrêté : la file n'accepte plus rien
+        self.cond = threading.Condition()
+
+
+class ForwardQueues:
+    """Envoi aux sauts suivants par files séparées, chacune avec son thread
+
+    Un thread de traitement ne fait que mettre l'oignon dévoilé en file : un
+    saut suivant lent ou injoignable n'immobilise que son propre thread
+    d'envoi. Le thread vide sa file par envois groupés (FRAME_BATCH). File
+    pleine : la trame attend une place au plus FORWARD_DEFER_TIMEOUT secondes
+    (policy "defer") ou est abandonnée tout de suite ("drop"). Un envoi en
+    échec abandonne la file et les trames suivantes pendant FORWARD_DOWN_DELAY.
+    """
+
+    def __init__(self, pool, depth=FORWARD_QUEUE_DEPTH, max_bytes=FORWARD_QUEUE_BYTES, policy=FORWARD_POLICY):
+        self.pool = pool
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.queues = {}  # (ip, port) -> HopQueue
+        self.lock = threading.Lock()
+        self.running = True
+
+    def _queue_for(self, addr):
+        with self.lock:
+            hop = self.queues.get(addr)
+            if hop is None:
+                hop = self.queues[addr] = HopQueue(addr)
+                FORWARD_QUEUES.set(len(self.queues))
+                threading.Thread(target=self._run, args=(hop,), daemon=True).start()
+            return hop
+
+    def _full(self, hop, size):
+        return len(hop.items) >= self.depth or (hop.bytes > 0 and hop.bytes + size > self.max_bytes)
+
+    def _defer(self, hop, size):
+        """Attendre une place (appelé avec hop.cond) ; False si la trame doit être abandonnée"""
+        if self.policy != "defer" or time.monotonic() - hop.progress > FORWARD_DEFER_TIMEOUT:
+            return False  # Saut bloqué : attendre ne ferait qu'immobiliser ce thread
+        FORWARD_DEFERRED.inc()
+        deadline = time.monotonic() + FORWARD_DEFER_TIMEOUT
+        while self._full(hop, size):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or hop.closed:
+                return False
+            hop.cond.wait(remaining)
+        return True
+
+    def put(self, node, addr, payload, trace_id=None, trace=None):
+        """Mettre un oignon en file pour addr ; None si accepté, sinon la raison de l'abandon"""
+        size = payload_size(payload)
+        while True:
+            hop = self._queue_for(addr)
+            with hop.cond:
+                if hop.closed:
+                    continue  # Thread arrêté entre-temps : nouvelle file
+                if time.monotonic() < hop.down_until:
+                    reason = "hop_down"
+                elif self._full(hop, size) and not self._defer(hop, size):
+                    reason = "queue_full"
+                else:
+                    hop.items.append((node, payload, trace_id, trace, time.monotonic()))
+                    hop.bytes += size
+                    FORWARD_QUEUED.inc()
+                    hop.cond.notify_all()
+                    return None
+            FORWARD_DROPPED.inc(reason=reason)
+            return reason
+
+    def _take(self, hop):
+        """Trames du prochain envoi groupé (appelé avec hop.cond)"""
+        batch = []
+        size = 0
+        while hop.items and len(batch) < FORWARD_BATCH:
+            item_size = payload_size(hop.items[0][1])
+            if batch and size + item_size > FORWARD_BATCH_BYTES:
+                break
+            batch.append(hop.items.popleft())
+            size += item_size
+        hop.bytes -= size
+        hop.progress = time.monotonic()
+        FORWARD_QUEUED.dec(len(batch))
+        hop.cond.notify_all()  # Places libérées pour les trames en attente (defer)
+        return batch
+
+    def _run(self, hop):
+        """Thread d'envoi d'un saut suivant ; s'arrête après FORWARD_SENDER_IDLE sans trame"""
+        while True:
+            with hop.cond:
+                if not hop.items and self.running:
+                    hop.cond.wait(FORWARD_SENDER_IDLE)
+                batch = self._take(hop)
+            if batch:
+                self._send(hop, batch)
+                continue
+            with self.lock, hop.cond:
+                if hop.items:
+                    continue
+                hop.closed = True
+                hop.cond.notify_all()
+                del self.queues[hop.addr]
+                FORWARD_QUEUES.set(len(self.queues))
+            return
+
+    def _frame(self, item):
+        """(contenu, type) de la trame d'un oignon en file"""
+        _, payload, trace_id, _, _ = item
+        if trace_id:
+            return traced_parts(trace_id, payload), FRAME_TRACED
+        return payload, FRAME_MESSAGE
+
+    def _send(self, hop, batch):
+        now = time.monotonic()
+        for item in batch:
+            FORWARD_QUEUE_SECONDS.observe(now - item[4])
+        # Un client ne lit pas FRAME_BATCH : seules les couches destinées à un routeur sont groupées
+        if len(batch) > 1 and all(is_layer(item[1]) for item in batch):
+            # Trames à la suite dans une trame FRAME_BATCH, sans recopier les oignons
+            data = []
+            for item in batch:
+                parts, kind = self._frame(item)
+                parts = payload_parts(parts)
+                data.append(memoryview(FRAME_HEADER.pack(kind, sum(part.nbytes for part in parts))))
+                data.extend(parts)
+            sends = [(batch, data, FRAME_BATCH)]
         else:
-            print(f"[ROUTER] Unregister response: {response}")
-            return False
-            
-    except Exception as e:
-        print(f"[ROUTER] X Unregister error: {type(e).__name__}: {e}")
-        return False
+            sends = [([item], *self._frame(item)) for item in batch]
+        for index, (items, data, kind) in enumerate(sends):
+            try:
+                with FORWARD_SECONDS.time():
+                    self.pool.send(hop.addr, data, kind)
+            except OSError as e:
+                # Saut injoignable : les trames suivantes et celles en file ne passeraient pas non plus
+                with hop.cond:
+                    hop.down_until = time.monotonic() + FORWARD_DOWN_DELAY
+                    dropped = list(hop.items)
+                    hop.items.clear()
+                    hop.bytes = 0
+                    FORWARD_QUEUED.dec(len(dropped))
+                    hop.cond.notify_all()
+                reason = "refused" if isinstance(e, ConnectionRefusedError) else type(e).__name__
+                failed = [item for pending, _, _ in sends[index:] for item in pending] + dropped
+                for node, payload, trace_id, trace, _ in failed:
+                    node.forward_failed(hop.addr, payload, reason, trace_id, trace)
+                return
+            for node, payload, trace_id, trace, _ in items:
+                node.forwarded(hop.addr, payload, trace_id, trace)
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            queues = list(self.queues.values())
+        for hop in queues:
+            with hop.cond:
+                hop.cond.notify_all()
+
+# ---------- ADMISSION ----------
+class Admission:
+    """Contrôle d'admission du processus : connexions ouvertes et débit par adresse source
+
+    Chaque adresse IP source a un seau de jetons (rate par seconde, rate * RATE_BURST
+    au plus) : une connexion acceptée et chaque oignon reçu en consomment un.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, rate=RATE_LIMIT):
+        self.max_connections = max_connections
+        self.rate = rate
+        self.burst = rate * RATE_BURST
+        self.connections = 0
+        self.buckets = OrderedDict()  # ip -> (jetons, instant du dernier calcul), du moins récent au plus récent
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Réserver une place pour une nouvelle connexion ; False si le maximum est atteint"""
+        with self.lock:
+            if self.connections >= self.max_connections:
+                return False
+            self.connections += 1
+        CONNECTIONS_ACTIVE.inc()
+        return True
+
+    def close(self):
+        with self.lock:
+            self.connections -= 1
+        CONNECTIONS_ACTIVE.dec()
+
+    def allow(self, ip, cost=1):
+        """Consommer cost jetons de l'adresse ip ; False si son débit est dépassé"""
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(ip, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= cost
+            self.buckets[ip] = (tokens - cost if allowed else tokens, now)
+            # Oublier par le début (moins récemment vues) les adresses au seau de nouveau
+            # plein, et au-delà de RATE_BUCKETS_MAX : quelques entrées par appel au plus
+            while len(self.buckets) > 1:
+                oldest, (left, since) = next(iter(self.buckets.items()))
+                if len(self.buckets) <= RATE_BUCKETS_MAX and left + (now - since) * self.rate < self.burst:
+                    break
+                del self.buckets[oldest]
+        return allowed
 
 # ---------- DECRYPT ----------
 def decrypt(cipher_list, priv_key):
@@ -76,206 +453,729 @@ def decrypt(cipher_list, priv_key):
             decrypted.append('?')
     return ''.join(decrypted)
 
-# ---------- REGISTER ----------
-def register(master_ip, master_port):
-    global private_key, router_id
-    print(f"[ROUTER] Connecting to master at {master_ip}:{master_port}...")
+def code_to_char(char_code):
+    if char_code < 0 or char_code > 1114111:  # Plage Unicode
+        char_code = char_code % 256
+    return chr(char_code)
+
+def peel_layer(data, priv_key):
+    """Retirer une couche au format en-tête + contenu (voir onion.py) : (en-tête, contenu)
+
+    Seul l'en-tête de taille fixe passe par le RSA ; le contenu est dévoilé
+    par la clé symétrique qu'il contient. En-tête None si la couche est invalide.
+    """
+    if not priv_key:
+        return None, b""
+    try:
+        next_ip, next_port, key, body = open_layer(data, priv_key)
+    except ValueError as e:
+        print(f"[ROUTER] Warning: Invalid layer header ({e})")
+        return None, b""
+    return f"{next_ip};{next_port}", xor_stream(body, key)
+
+def open_layer(data, priv_key):
+    """Déchiffrer l'en-tête d'une couche : (ip, port, clé, vue sur le contenu chiffré)
+
+    data peut s'arrêter juste après l'en-tête (relais en flux). ValueError si invalide.
+    """
+    d, n = priv_key
+    cipher, body = unpack_header(data)
+    codes = {c: pow(c, d, n) for c in set(cipher)}
+    next_ip, next_port, key = parse_header("".join(code_to_char(codes[c]) for c in cipher))
+    return next_ip, next_port, key, body
+
+class StreamAborted(Exception):
+    """Connexion entrante perdue au milieu d'une trame relayée en flux"""
+
+class FinalTooLarge(ValueError):
+    """Message final relayé en flux plus grand que ce qu'un client accepte (MAX_FRAME)"""
+
+def recv_stream(conn, size):
+    """recv_exact sur la connexion entrante d'un relais en flux
 
-    max_retries = 3
-    for attempt in range(max_retries):
+    Ses erreurs deviennent StreamAborted pour ne pas être confondues avec
+    celles de la connexion vers le saut suivant.
+    """
+    try:
+        data = recv_exact(conn, size)
+    except OSError as e:
+        raise StreamAborted(f"{type(e).__name__}: {e}") from e
+    if data is None:
+        raise StreamAborted("Connection closed")
+    return data
+
+# ---------- ROUTER ----------
+class RouterNode:
+    """Un routeur logique : adresse d'écoute, identité et clé privée données par le master
+
+    Les ressources lourdes (connexions sortantes, remontée des évènements,
+    fichier de trace) appartiennent au RouterHost et sont partagées par tous
+    les routeurs du processus.
+    """
+
+    def __init__(self, host, ip, port):
+        self.host = host
+        self.ip = ip
+        self.port = port
+        self.tag = f"[ROUTER {port}]"
+        self.private_key = None
+        self.router_id = None  # ID du routeur attribué par le master
+        self.server = None  # Socket d'écoute
+
+    # ---------- LISTEN ----------
+    def listen(self):
+        """Ouvrir la socket d'écoute (avant l'inscription : le master ne doit
+        pas proposer un routeur qui ne peut pas recevoir)"""
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)  # Timeout de 10 secondes
-            sock.connect((master_ip, master_port))
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((self.ip, self.port))
+            server.listen(LISTEN_BACKLOG)
+            server.setblocking(False)
+        except OSError as e:
+            print(f"{self.tag} X Server error: {type(e).__name__}: {e}")
+            return False
+        self.server = server
+        print(f"{self.tag} Listening on {self.ip}:{self.port}")
+        return True
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
 
-            # Envoyer le type
-            sock.send(b"ROUTER")
-            time.sleep(0.5)  # Petite pause
+    # ---------- REGISTER ----------
+    def register(self):
+        master_ip, master_port = self.host.master
+        print(f"{self.tag} Connecting to master at {master_ip}:{master_port}...")
 
-            # Envoyer l'adresse
-            address_msg = f"{ROUTER_IP};{ROUTER_PORT}"
-            sock.send(address_msg.encode())
+        max_retries = 3
+        for attempt in range(max_retries):
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.settimeout(10)  # Timeout de 10 secondes
+                sock.connect((master_ip, master_port))
 
-            # Recevoir la réponse: ID;d;n
-            data = sock.recv(1024).decode().strip()
+                # Envoyer le type
+                sock.send(b"ROUTER")
+                time.sleep(0.5)  # Petite pause
 
-            if not data:
-                print(f"[ROUTER] X Empty response from master (attempt {attempt + 1}/{max_retries})")
-                sock.close()
-                time.sleep(2)
-                continue
+                # Envoyer l'adresse
+                address_msg = f"{self.ip};{self.port}"
+                sock.send(address_msg.encode())
 
-            if data.startswith("ERROR"):
-                print(f"[ROUTER] X Master error: {data}")
-                sock.close()
-                return False
+                # Recevoir la réponse: ID;d;n
+                data = sock.recv(1024).decode().strip()
 
-            # Parser: ID;d;n
-            if ";" in data:
-                parts = data.split(";")
-                if len(parts) == 3:
-                    router_id = int(parts[0])
-                    d_str = parts[1]
-                    n_str = parts[2]
-                    private_key = (int(d_str), int(n_str))
+                if not data:
+                    print(f"{self.tag} X Empty response from master (attempt {attempt + 1}/{max_retries})")
                     sock.close()
-                    print(f"[ROUTER] Registered successfully!")
-                    print(f"[ROUTER] Router ID: {router_id}")
-                    print(f"[ROUTER] Address: {ROUTER_IP}:{ROUTER_PORT}")
-                    print(f"[ROUTER] Master: {master_ip}:{master_port}")
-                    print(f"[ROUTER] Private key received")
-                    return True
+                    time.sleep(2)
+                    continue
+
+                if data.startswith("ERROR"):
+                    print(f"{self.tag} X Master error: {data}")
+                    sock.close()
+                    return False
+
+                # Parser: ID;d;n
+                if ";" in data:
+                    parts = data.split(";")
+                    if len(parts) == 3:
+                        self.router_id = int(parts[0])
+                        d_str = parts[1]
+                        n_str = parts[2]
+                        self.private_key = (int(d_str), int(n_str))
+                        sock.close()
+                        print(f"{self.tag} Registered successfully!")
+                        print(f"{self.tag} Router ID: {self.router_id}")
+                        print(f"{self.tag} Address: {self.ip}:{self.port}")
+                        print(f"{self.tag} Master: {master_ip}:{master_port}")
+                        print(f"{self.tag} Private key received")
+                        return True
+                    else:
+                        print(f"{self.tag} X Invalid response format: {data}")
+                        sock.close()
                 else:
-                    print(f"[ROUTER] X Invalid response format: {data}")
+                    print(f"{self.tag} X Invalid response format: {data}")
                     sock.close()
+
+            except ConnectionRefusedError:
+                print(f"{self.tag} X Master not available (attempt {attempt + 1}/{max_retries})")
+                print(f"{self.tag} Make sure master.py is running on port {master_port}")
+                time.sleep(3)
+            except ConnectionResetError:
+                print(f"{self.tag} X Connection reset by master (attempt {attempt + 1}/{max_retries})")
+                print(f"{self.tag} Master might be rejecting connections")
+                time.sleep(3)
+            except socket.timeout:
+                print(f"{self.tag} X Connection timeout (attempt {attempt + 1}/{max_retries})")
+                time.sleep(3)
+            except Exception as e:
+                print(f"{self.tag} X Error: {type(e).__name__}: {e}")
+                time.sleep(3)
+
+        print(f"{self.tag} X Failed to register after all attempts")
+        return False
+
+    # ---------- UNREGISTER ----------
+    def unregister(self):
+        """Se désincrire du master lors de l'arrêt"""
+        if self.router_id is None:
+            return False
+
+        print(f"\n{self.tag} Unregistering from master...")
+
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            sock.connect(self.host.master)
+
+            # Envoyer le type de requête
+            sock.send(b"UNREGISTER_ROUTER")
+            time.sleep(0.1)
+
+            # Envoyer l'ID du routeur
+            sock.send(str(self.router_id).encode())
+
+            # Attendre la confirmation
+            response = sock.recv(1024).decode().strip()
+            sock.close()
+
+            if response == "OK":
+                print(f"{self.tag} Successfully unregistered (ID: {self.router_id})")
+                self.router_id = None
+                return True
             else:
-                print(f"[ROUTER] X Invalid response format: {data}")
-                sock.close()
-
-        except ConnectionRefusedError:
-            print(f"[ROUTER] X Master not available (attempt {attempt + 1}/{max_retries})")
-            print(f"[ROUTER] Make sure master.py is running on port {master_port}")
-            time.sleep(3)
-        except ConnectionResetError:
-            print(f"[ROUTER] X Connection reset by master (attempt {attempt + 1}/{max_retries})")
-            print(f"[ROUTER] Master might be rejecting connections")
-            time.sleep(3)
+                print(f"{self.tag} Unregister response: {response}")
+                return False
+
+        except Exception as e:
+            print(f"{self.tag} X Unregister error: {type(e).__name__}: {e}")
+            return False
+
+    # ---------- HANDLE MESSAGES ----------
+    def record_event(self, event_type, message):
+        self.host.events.record(self.router_id, event_type, message)
+
+    def handle_ready(self, conn, addr):
+        """Traiter les trames arrivées sur une connexion ; False quand elle doit être fermée
+
+        Appelé par un thread du pool quand la connexion est lisible : traite au
+        plus FRAMES_PER_TURN trames tant que des données attendent, puis la
+        connexion retourne à la boucle d'acceptation (une connexion réutilisable
+        inactive n'occupe aucun thread).
+        """
+        admission = self.host.admission
+        try:
+            for _ in range(FRAMES_PER_TURN):
+                frame = recv_frame_header(conn, MAX_STREAM_FRAME)
+                if frame is None or self.private_key is None:
+                    return False
+                kind, length = frame
+                if kind in (FRAME_MESSAGE, FRAME_TRACED) and length > STREAM_THRESHOLD:
+                    if not admission.allow(addr[0]):
+                        self.host.shed(conn, "rate_limited")
+                        return False
+                    # Grand oignon : relayé au fil de la réception, mémoire bornée
+                    self.stream_onion(conn, kind, length, addr)
+                else:
+                    if length > MAX_FRAME:
+                        raise ValueError(f"Frame too large ({length} bytes)")
+                    data = memoryview(recv_exact(conn, length) if length else b"")
+                    # Envoi groupé : chaque oignon a son propre saut suivant (vues sur la trame)
+                    onions = list(iter_batch(data)) if kind == FRAME_BATCH else [(kind, data)]
+                    if not admission.allow(addr[0], len(onions)):
+                        self.host.shed(conn, "rate_limited")
+                        return False
+                    for sub_kind, onion in onions:
+                        self.process_frame(sub_kind, onion, addr)
+                if not is_readable(conn):
+                    return True
+            return True
         except socket.timeout:
-            print(f"[ROUTER] X Connection timeout (attempt {attempt + 1}/{max_retries})")
-            time.sleep(3)
+            return False  # Trame commencée mais jamais terminée
         except Exception as e:
-            print(f"[ROUTER] X Error: {type(e).__name__}: {e}")
-            time.sleep(3)
+            print(f"{self.tag} X Handler error: {type(e).__name__}: {e}")
+            self.record_event("erreur", f"Handler error from {addr[0]}: {type(e).__name__}: {e}")
+            return False
 
-    print("[ROUTER] X Failed to register after all attempts")
-    return False
+    def stream_onion(self, conn, kind, length, addr):
+        """Relayer un grand oignon sans l'avoir reçu en entier
 
-# ---------- HANDLE MESSAGES ----------
-def handle_connection(conn, addr):
-    try:
-        data = conn.recv(1048576).decode()  # Un tres grand nombre (2^20) pour que tout le message soit recu
-        if not data or private_key is None:
-            conn.close()
-            return
+        L'en-tête de la couche est lu et déchiffré d'abord ; la trame sortante
+        part dès que le saut suivant est joint, puis le contenu est lu, dévoilé
+        et transmis par morceaux de STREAM_CHUNK octets. Une trame qui n'est pas
+        une couche (ancien format) est refusée et la connexion fermée.
+        Un message final (contenu qui n'est pas une couche) va à un client, qui
+        ne lit pas plus de MAX_FRAME octets : au-delà, il est refusé ici.
 
-        print(f"[ROUTER] Received {len(data)} bytes from {addr}")
+        Le flux a sa propre connexion, hors du pool : un émetteur lent ne
+        bloque pas les autres trames vers le même saut suivant.
+        """
+        trace_id = None
+        if kind == FRAME_TRACED:
+            trace_id = bytes(recv_stream(conn, TRACE_ID_SIZE)).hex()
+            length -= TRACE_ID_SIZE
+        head = recv_stream(conn, min(length, 1 + HEADER_SIZE))
+        if not is_layer(head):
+            FORWARD_ERRORS.inc(reason="unsupported_format")
+            raise ValueError(f"Unsupported onion format ({length} bytes)")
 
-        # Convertir en liste d'entiers
-        cipher_list = []
-        parts = data.split(",")
-        for part in parts:
-            part = part.strip()
-            if part:
-                try:
-                    cipher_list.append(int(part))
-                except ValueError:
-                    print(f"[ROUTER] Warning: Invalid number '{part}'")
+        trace_sink = self.host.trace_sink
+        trace = {"received": time.time(), "bytes": length, "streamed": True} if trace_id and trace_sink else None
+        remaining = length - len(head)
+        print(f"{self.tag} Streaming {length} bytes from {addr}")
+        ONIONS_RECEIVED.inc()
+        ONIONS_STREAMED.inc()
+        BYTES_IN.inc(len(head))
+        self.record_event("message_recu", f"{length} bytes (stream) from {addr[0]}:{addr[1]}")
+        next_hop = None
+        try:
+            with DECRYPT_SECONDS.time():
+                next_ip, next_port, key, _ = open_layer(head, self.private_key)
+            next_hop = f"{next_ip}:{next_port}"
+            if trace is not None:
+                trace["decrypted"] = time.time()
+            size = remaining  # Contenu dévoilé transmis au saut suivant
+            first = xor_stream(recv_stream(conn, min(STREAM_CHUNK, remaining)), key)
+            BYTES_IN.inc(len(first))
+            remaining -= len(first)
+            if not is_layer(first) and size > MAX_FRAME:
+                # Message final : le client destinataire ne lit pas de trame au-delà de MAX_FRAME
+                raise FinalTooLarge(f"Final message too large for a client ({size} bytes)")
+            prefix = [bytes.fromhex(trace_id)] if trace_id else []
+            header = FRAME_HEADER.pack(FRAME_TRACED if trace_id else FRAME_MESSAGE,
+                                       size + sum(len(part) for part in prefix))
+            with FORWARD_SECONDS.time():
+                with socket.create_connection((next_ip, next_port), timeout=self.host.pool.timeout) as out:
+                    send_buffers(out, [memoryview(part) for part in [header] + prefix + [first]])
+                    BYTES_OUT.inc(len(first))
+                    offset = len(first)
+                    while remaining:
+                        chunk = recv_stream(conn, min(STREAM_CHUNK, remaining))
+                        BYTES_IN.inc(len(chunk))
+                        out.sendall(xor_stream(chunk, key, offset))
+                        BYTES_OUT.inc(len(chunk))
+                        offset += len(chunk)
+                        remaining -= len(chunk)
+            if trace is not None:
+                trace["forwarded"] = time.time()
+                trace["next"] = next_hop
+            print(f"{self.tag} Streamed {length} bytes to {next_hop}")
+            self.record_event("message_envoye", f"{length} bytes (stream) to {next_hop}")
+        except (ValueError, OSError) as e:
+            # En-tête invalide, message final trop grand ou saut suivant injoignable : l'oignon est perdu
+            if isinstance(e, FinalTooLarge):
+                reason = "too_large"
+            else:
+                reason = "invalid_header" if isinstance(e, ValueError) else type(e).__name__
+            print(f"{self.tag} X Stream error to {next_hop}: {type(e).__name__}: {e}")
+            FORWARD_ERRORS.inc(reason=reason)
+            if trace is not None:
+                trace["error"] = reason
+            self.record_event("erreur", f"Stream error to {next_hop}: {type(e).__name__}")
+            # Lire le reste de la trame pour garder la connexion entrante utilisable
+            while remaining:
+                remaining -= len(recv_stream(conn, min(STREAM_CHUNK, remaining)))
+        finally:
+            if trace is not None:
+                trace_sink.record(trace_id, f"router {self.ip}:{self.port}", **trace)
 
-        if not cipher_list:
-            print("[ROUTER] No valid data received")
-            conn.close()
-            return
+    def process_frame(self, kind, data, addr):
+        """Extraire l'identifiant de trace éventuel puis traiter l'oignon"""
+        if kind == FRAME_TRACED:
+            trace_id, onion = unpack_traced(data)
+            self.process_onion(onion, addr, trace_id)
+        else:
+            self.process_onion(data, addr)
 
-        # Dechiffrer
-        plain = decrypt(cipher_list, private_key)
-        if not plain:
-            print("[ROUTER] Decryption failed")
-            conn.close()
-            return
+    def process_onion(self, data, addr, trace_id=None):
+        """Déchiffrer une couche et transmettre le reste au saut suivant
+
+        Avec un trace_id, l'identifiant suit l'oignon au saut suivant et le
+        passage (réception, déchiffrement, transmission) est noté dans le
+        fichier de trace du processus.
+        """
+        trace_sink = self.host.trace_sink
+        trace = {"received": time.time(), "bytes": len(data)} if trace_id and trace_sink else None
+        queued = False
+        try:
+            queued = self.relay_onion(data, addr, trace_id, trace)
+        finally:
+            # Oignon en file : le passage est noté par le thread d'envoi
+            if trace is not None and not queued:
+                trace_sink.record(trace_id, f"router {self.ip}:{self.port}", **trace)
 
-        print(f"[ROUTER] Decrypted: {plain[:100]}...")
+    def relay_onion(self, data, addr, trace_id, trace):
+        """Dévoiler une couche et mettre le reste en file pour le saut suivant ; True si en file"""
+        if not data:
+            return False
 
-        # Parser: next_ip;next_port|encrypted_payload
-        if "|" in plain:
-            header, payload = plain.split("|", 1)
-            if ";" in header:
-                next_ip, next_port_str = header.split(";")
-                try:
-                    next_port = int(next_port_str)
-                    # Forwarder au prochain saut
-                    print(f"[ROUTER] Forwarding to {next_ip}:{next_port}")
-                    forward_sock = socket.socket()
-                    forward_sock.settimeout(5)
-                    forward_sock.connect((next_ip, next_port))
-                    forward_sock.send(payload.encode())
-                    forward_sock.close()
-                    print(f"[ROUTER] Forwarded successfully")
-                except ValueError:
-                    print(f"[ROUTER] X Invalid port: {next_port_str}")
-                except ConnectionRefusedError:
-                    print(f"[ROUTER] X Next hop {next_ip}:{next_port} refused connection")
-                except Exception as e:
-                    print(f"[ROUTER] X Forward error: {type(e).__name__}: {e}")
+        print(f"{self.tag} Received {len(data)} bytes from {addr}")
+        ONIONS_RECEIVED.inc()
+        BYTES_IN.inc(len(data))
+        self.record_event("message_recu", f"{len(data)} bytes from {addr[0]}:{addr[1]}")
+
+        if not is_layer(data):
+            # Ancien format (tout le contenu en RSA) : plus accepté, son coût croît avec la taille
+            print(f"{self.tag} X Unsupported onion format ({len(data)} bytes)")
+            FORWARD_ERRORS.inc(reason="unsupported_format")
+            if trace is not None:
+                trace["error"] = "unsupported_format"
+            self.record_event("erreur", f"Unsupported onion format from {addr[0]}:{addr[1]}")
+            return False
+
+        # Dechiffrer l'en-tête puis le contenu (octets, vue sur la trame reçue)
+        with DECRYPT_SECONDS.time():
+            header, payload = peel_layer(data, self.private_key)
+        if trace is not None:
+            trace["decrypted"] = time.time()
+        if header is None:
+            if not payload:
+                print(f"{self.tag} No valid data received")
             else:
-                # Message final
-                print(f"[ROUTER] Final message: {payload[:100]}...")
+                print(f"{self.tag} Received: {payload[:100].decode(errors='replace')}...")
+            return False
+
+        print(f"{self.tag} Decrypted header: {header} ({len(payload)} bytes of payload)")
+
+        # En-tête: next_ip;next_port
+        if ";" in header:
+            next_ip, next_port_str = header.split(";", 1)
+            try:
+                next_port = int(next_port_str)
+            except ValueError:
+                print(f"{self.tag} X Invalid port: {next_port_str}")
+                FORWARD_ERRORS.inc(reason="invalid_port")
+                if trace is not None:
+                    trace["error"] = "invalid_port"
+                self.record_event("erreur", f"Invalid port: {next_port_str}")
+                return False
+            # File du saut suivant (thread et connexion partagés par le processus)
+            print(f"{self.tag} Forwarding to {next_ip}:{next_port}")
+            if trace is not None:
+                trace["queued"] = time.time()
+            reason = self.host.forward.put(self, (next_ip, next_port), payload, trace_id, trace)
+            if reason is not None:
+                self.forward_failed((next_ip, next_port), payload, reason, trace_id, trace)
+            return True
         else:
-            print(f"[ROUTER] Received: {plain[:100]}...")
+            # Message final
+            print(f"{self.tag} Final message: {payload[:100].decode(errors='replace')}...")
+            return False
 
-    except Exception as e:
-        print(f"[ROUTER] X Handler error: {type(e).__name__}: {e}")
-    finally:
-        conn.close()
+    def forwarded(self, next_hop, payload, trace_id, trace):
+        """Oignon parti vers le saut suivant (thread d'envoi)"""
+        print(f"{self.tag} Forwarded successfully")
+        self.record_event("message_envoye", f"{len(payload)} bytes to {next_hop[0]}:{next_hop[1]}")
+        if trace is not None:
+            trace["forwarded"] = time.time()
+            trace["next"] = f"{next_hop[0]}:{next_hop[1]}"
+            self.host.trace_sink.record(trace_id, f"router {self.ip}:{self.port}", **trace)
 
-# ---------- SERVER ----------
-def start_server():
-    try:
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind((ROUTER_IP, ROUTER_PORT))
-        server.listen(5)
-        print(f"[ROUTER] Listening on {ROUTER_IP}:{ROUTER_PORT}")
-        print("[ROUTER] Waiting for messages...")
+    def forward_failed(self, next_hop, payload, reason, trace_id, trace):
+        """Oignon abandonné : saut suivant injoignable, file pleine ou saut en échec"""
+        next_ip, next_port = next_hop
+        print(f"{self.tag} X Forward to {next_ip}:{next_port} failed: {reason}")
+        if reason not in ("queue_full", "hop_down"):
+            FORWARD_ERRORS.inc(reason=reason)  # Les abandons en file ont leur propre compteur
+        self.record_event("erreur", f"Forward error to {next_ip}:{next_port}: {reason}")
+        if trace is not None:
+            trace["error"] = reason
+            self.host.trace_sink.record(trace_id, f"router {self.ip}:{self.port}", **trace)
+        self.keep_undelivered(next_ip, next_port, payload)
 
-        while True:
-            conn, addr = server.accept()
-            threading.Thread(target=handle_connection, args=(conn, addr), daemon=True).start()
+    def keep_undelivered(self, ip, port, payload):
+        """Dernier saut : confier au master le message que le client n'a pas accepté
+
+        Seul un message texte final est déposé : une couche va à un routeur, pas
+        à un client, et un accusé de réception ou un morceau de fichier n'a pas
+        de sens remis plus tard.
+        """
+        if is_layer(payload) or len(payload) > MAILBOX_MAX_MESSAGE or not is_text_message(payload):
+            return
+        if not self.host.mail.put(ip, port, payload):
+            print(f"{self.tag} X Mailbox queue full: undelivered message for {ip}:{port} dropped")
 
-    except Exception as e:
-        print(f"[ROUTER] X Server error: {type(e).__name__}: {e}")
-        return False
 
-    return True
+class RouterHost:
+    """Processus hébergeant un ou plusieurs routeurs logiques
 
-# ---------- CLEANUP ----------
-# Variables globales pour le cleanup
-master_ip_global = None
-master_port_global = None
+    Un seul thread accepte et surveille les connexions de tous les ports
+    (selectors) ; une connexion sur laquelle une trame arrive est traitée par
+    un pool de threads de taille fixe (file bornée), par le routeur du port
+    concerné, qui met l'oignon dévoilé dans la file du saut suivant. Les
+    files et connexions vers les sauts suivants, la remontée des évènements
+    et le fichier de trace sont communs à tous les routeurs.
+    """
 
-def cleanup_handler():
-    """Handler pour nettoyer proprement lors de l'arrêt"""
-    global master_ip_global, master_port_global
-    if master_ip_global and master_port_global:
-        unregister(master_ip_global, master_port_global)
+    def __init__(self, master_ip, master_port, trace_sink=None, workers=ROUTER_WORKERS,
+                 queue_size=WORK_QUEUE_SIZE, max_connections=MAX_CONNECTIONS, rate_limit=RATE_LIMIT,
+                 forward_policy=FORWARD_POLICY, forward_depth=FORWARD_QUEUE_DEPTH):
+        self.master = (master_ip, master_port)
+        self.nodes = []
+        self.pool = ConnectionPool(bytes_out=BYTES_OUT)
+        self.forward = ForwardQueues(self.pool, forward_depth, policy=forward_policy)
+        self.events = EventReporter()
+        self.mail = MailDrop()  # Messages finaux non remis, envoyés au master par lots
+        self.trace_sink = trace_sink  # Fichier de trace (ONION_TRACE_DIR), None si désactivé
+        self.workers = workers
+        self.jobs = queue.Queue(maxsize=queue_size)  # (routeur, connexion, adresse) prêtes
+        self.admission = Admission(max_connections, rate_limit)
+        self.ready = deque()  # Connexions rendues par le pool, à surveiller de nouveau
+        self.wakeup, self.wakeup_signal = socket.socketpair()  # Réveil de la boucle par le pool
+        self.wakeup.setblocking(False)
+        self.wakeup_signal.setblocking(False)
+        self.running = False
+        self.stopped = False
+        self.lock = threading.Lock()
 
-def signal_handler(signum, frame):
-    """Handler pour les signaux d'interruption"""
-    print("\n[ROUTER] Shutdown signal received...")
-    cleanup_handler()
-    sys.exit(0)
+    def add(self, ip, port):
+        node = RouterNode(self, ip, port)
+        self.nodes.append(node)
+        return node
+
+    def _each(self, method):
+        """Appeler method(node) pour tous les routeurs, en parallèle ; [(node, résultat)]"""
+        if len(self.nodes) == 1:
+            return [(self.nodes[0], method(self.nodes[0]))]
+        with ThreadPoolExecutor(max_workers=REGISTER_WORKERS) as executor:
+            return list(zip(self.nodes, executor.map(method, self.nodes)))
+
+    def start(self):
+        """Ouvrir les ports puis inscrire les routeurs ; False si aucun n'est utilisable
+
+        Un routeur dont le port est pris ou que le master refuse est retiré,
+        les autres continuent.
+        """
+        self.nodes = [node for node in self.nodes if node.listen()]
+        registered = []
+        for node, ok in self._each(RouterNode.register):
+            if ok:
+                registered.append(node)
+            else:
+                node.close()
+        self.nodes = registered
+        ROUTERS_HOSTED.set(len(self.nodes))
+        if not self.nodes:
+            return False
+        self.events.start(*self.master)
+        self.mail.start(*self.master)
+        self.running = True
+        return True
+
+    def serve_forever(self):
+        """Boucle d'acceptation et de surveillance commune à tous les ports (jusqu'à stop())
+
+        Trop de connexions ouvertes, débit de l'adresse source dépassé ou file
+        du pool pleine : la connexion est délestée (trame FRAME_BUSY puis
+        fermeture) au lieu de laisser le processus s'effondrer.
+        """
+        selector = selectors.DefaultSelector()
+        for node in self.nodes:
+            selector.register(node.server, selectors.EVENT_READ, node)
+        selector.register(self.wakeup, selectors.EVENT_READ, None)
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        idle = {}  # connexion surveillée -> (routeur, adresse, dernière activité)
+        last_sweep = time.monotonic()
+        print(f"[ROUTER] Waiting for messages on {len(self.nodes)} router(s)...")
+        try:
+            while self.running:
+                for key, _ in selector.select(timeout=ACCEPT_POLL):
+                    if key.data is None:
+                        self._drain_wakeup()
+                    elif isinstance(key.data, RouterNode):
+                        self._accept(key.data, selector, idle)
+                    else:
+                        # Trame arrivée : la connexion passe au pool le temps de la traiter
+                        selector.unregister(key.fileobj)
+                        node, addr, _ = idle.pop(key.fileobj)
+                        self._dispatch(node, key.fileobj, addr)
+                now = time.monotonic()
+                while self.ready:
+                    node, conn, addr = self.ready.popleft()
+                    idle[conn] = (node, addr, now)
+                    selector.register(conn, selectors.EVENT_READ, addr)
+                if now - last_sweep >= ACCEPT_POLL:
+                    last_sweep = now
+                    for conn, (_, _, last_used) in list(idle.items()):
+                        if now - last_used > IDLE_TIMEOUT:
+                            # Connexion réutilisable restée inactive
+                            selector.unregister(conn)
+                            del idle[conn]
+                            self.release(conn)
+        finally:
+            for conn in idle:
+                self.release(conn)
+            selector.close()
+            for _ in range(self.workers):
+                try:
+                    self.jobs.put_nowait(None)
+                except queue.Full:
+                    break
+
+    def _accept(self, node, selector, idle):
+        try:
+            conn, addr = node.server.accept()
+        except (BlockingIOError, OSError):
+            return  # Déjà acceptée ou socket fermée par stop()
+        if not self.admission.open():
+            self.shed(conn, "too_many_connections")
+            conn.close()
+            return
+        if not self.admission.allow(addr[0]):
+            self.shed(conn, "rate_limited")
+            self.release(conn)
+            return
+        conn.setblocking(True)
+        conn.settimeout(IDLE_TIMEOUT)
+        idle[conn] = (node, addr, time.monotonic())
+        selector.register(conn, selectors.EVENT_READ, addr)
+
+    def _dispatch(self, node, conn, addr):
+        """Confier une connexion prête au pool ; délestée si la file est pleine"""
+        try:
+            self.jobs.put_nowait((node, conn, addr))
+        except queue.Full:
+            self.shed(conn, "overloaded")
+            self.release(conn)
+            return
+        WORK_QUEUE.set(self.jobs.qsize())
+
+    def _work(self):
+        """Thread du pool : traiter les connexions prêtes puis les rendre à la boucle"""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            WORK_QUEUE.set(self.jobs.qsize())
+            node, conn, addr = job
+            if node.handle_ready(conn, addr) and self.running:
+                self.ready.append((node, conn, addr))
+                try:
+                    self.wakeup_signal.send(b"\0")
+                except OSError:
+                    pass  # Réveil déjà en attente
+            else:
+                self.release(conn)
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def shed(self, conn, reason):
+        """Délester une connexion : trame FRAME_BUSY (raison) avant sa fermeture"""
+        CONNECTIONS_SHED.inc(reason=reason)
+        try:
+            conn.setblocking(False)
+            conn.send(pack_frame(reason.encode(), FRAME_BUSY))
+            conn.shutdown(socket.SHUT_WR)
+            # Fermer avec des données non lues enverrait un RST, qui peut effacer
+            # la trame FRAME_BUSY avant que l'émetteur ne la lise
+            for _ in range(SHED_DRAIN_READS):
+                if not conn.recv(65536):
+                    break
+        except OSError:
+            pass
+
+    def release(self, conn):
+        """Fermer une connexion entrante et libérer sa place"""
+        try:
+            conn.close()
+        except OSError:
+            pass
+        self.admission.close()
+
+    def stop(self):
+        """Envoyer les derniers évènements et désinscrire tous les routeurs (une seule fois)"""
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        self.running = False
+        try:
+            self.wakeup_signal.send(b"\0")
+        except OSError:
+            pass
+        self.events.flush()
+        self.mail.flush()
+        self._each(RouterNode.unregister)
+        ROUTERS_HOSTED.set(0)
+        for node in self.nodes:
+            node.close()
+        self.forward.close()
+        self.pool.close()
+        if self.trace_sink:
+            self.trace_sink.close()
 
 # ---------- MAIN ----------
-def main():
-    global ROUTER_IP, ROUTER_PORT, master_ip_global, master_port_global
+def parse_args(argv=None):
+    """Options de démarrage (ligne de commande, environnement, fichier de configuration)"""
+    parser = argparse.ArgumentParser(description="Onion routing router")
+    parser.add_argument("--ip", help=f"router listening IP (default: {MASTER_IP})")
+    parser.add_argument("--port", type=port_type, help="router listening port (5001, 5002...)")
+    parser.add_argument("--master-ip", help=f"master server IP (default: {MASTER_IP})")
+    parser.add_argument("--master-port", type=port_type, help=f"master server port (default: {MASTER_PORT})")
+    parser.add_argument("--count", type=int, help="start COUNT routers on consecutive ports from --port")
+    parser.add_argument("--metrics-port", type=int, help="serve /metrics on this port (0 = any)")
+    parser.add_argument("--trace-dir", help="write per-hop traces to this directory")
+    parser.add_argument("--workers", type=int, help=f"frame processing threads (default: {ROUTER_WORKERS})")
+    parser.add_argument("--max-connections", type=int,
+                        help=f"open incoming connections before shedding (default: {MAX_CONNECTIONS})")
+    parser.add_argument("--rate-limit", type=int,
+                        help=f"connections + onions per second per source IP, 0 = unlimited (default: {RATE_LIMIT})")
+    parser.add_argument("--forward-policy", choices=("defer", "drop"),
+                        help=f"full next-hop queue: wait for room or drop (default: {FORWARD_POLICY})")
+    parser.add_argument("--forward-depth", type=int,
+                        help=f"frames queued per next hop (default: {FORWARD_QUEUE_DEPTH})")
+    add_config_argument(parser)
+    args = parser.parse_args(argv)
+    return resolve(args, "router", {
+        "ip": (str, None),
+        "port": (port_type, None),
+        "master_ip": (str, None),
+        "master_port": (port_type, None),
+        "count": (int, 1),
+        "metrics_port": (int, None),
+        "trace_dir": (str, None),
+        "workers": (int, ROUTER_WORKERS),
+        "max_connections": (int, MAX_CONNECTIONS),
+        "rate_limit": (int, RATE_LIMIT),
+        "forward_policy": (str, FORWARD_POLICY),
+        "forward_depth": (int, FORWARD_QUEUE_DEPTH),
+    })
 
-    print(f"\n{'='*60}")
-    print("ROUTER CONFIGURATION")
-    print(f"{'='*60}")
+def ask_configuration(args):
+    """Demander au clavier les paramètres qui n'ont pas été fournis"""
+    if args.port is not None:
+        # Lancement configuré : valeurs par défaut pour le reste, sans saisie
+        args.ip = args.ip or MASTER_IP
+        args.master_ip = args.master_ip or MASTER_IP
+        args.master_port = args.master_port or MASTER_PORT
+        return
+
+    if args.ip is None or args.port is None or args.master_ip is None or args.master_port is None:
+        print(f"\n{'='*60}")
+        print("ROUTER CONFIGURATION")
+        print(f"{'='*60}")
 
     # Demander l'IP du routeur
-    while True:
+    while args.ip is None:
         ip_input = input(f"Enter router IP address (default: {MASTER_IP}): ").strip()
         if ip_input == "":
-            ROUTER_IP = MASTER_IP
-            break
+            args.ip = MASTER_IP
         elif validate_ip(ip_input):
-            ROUTER_IP = ip_input
-            break
+            args.ip = ip_input
         else:
             print("X Invalid IP address format. Please use IPv4 format (e.g., 127.0.0.1)")
 
     # Demander le port du routeur
-    while True:
+    while args.port is None:
         try:
             port_input = input("Enter router listening port (5001, 5002, 5003...): ")
             port = int(port_input)
@@ -287,80 +1187,94 @@ def main():
             # Vérifier si le port est disponible
             try:
                 test_sock = socket.socket()
-                test_sock.bind((ROUTER_IP, port))
+                test_sock.bind((args.ip, port))
                 test_sock.close()
-                ROUTER_PORT = port
-                break
+                args.port = port
             except OSError:
-                print(f"X Port {port} on {ROUTER_IP} is already in use. Please choose another.")
+                print(f"X Port {port} on {args.ip} is already in use. Please choose another.")
 
         except ValueError:
             print("X Please enter a valid number.")
 
     # Demander l'IP du Master
-    master_ip = MASTER_IP
-    while True:
+    while args.master_ip is None:
         master_ip_input = input(f"Enter Master server IP (default: {MASTER_IP}): ").strip()
         if master_ip_input == "":
-            master_ip = MASTER_IP
-            break
+            args.master_ip = MASTER_IP
         elif validate_ip(master_ip_input):
-            master_ip = master_ip_input
-            break
+            args.master_ip = master_ip_input
         else:
             print("X Invalid IP address format. Please use IPv4 format (e.g., 127.0.0.1)")
 
     # Demander le port du Master
-    master_port = MASTER_PORT
-    while True:
+    while args.master_port is None:
         master_port_input = input(f"Enter Master server port (default: {MASTER_PORT}): ").strip()
         if master_port_input == "":
-            master_port = MASTER_PORT
+            args.master_port = MASTER_PORT
             break
         try:
             port_num = int(master_port_input)
             if 1 <= port_num <= 65535:
-                master_port = port_num
-                break
+                args.master_port = port_num
             else:
                 print("X Port must be between 1 and 65535")
         except ValueError:
             print("X Please enter a valid number")
 
-    # Sauvegarder les informations du master pour le cleanup
-    master_ip_global = master_ip
-    master_port_global = master_port
+def main(argv=None):
+    args = parse_args(argv)
+    ask_configuration(args)
+    if args.count < 1:
+        raise SystemExit("X --count must be at least 1")
+    if args.workers < 1 or args.max_connections < 1 or args.rate_limit < 0:
+        raise SystemExit("X --workers and --max-connections must be at least 1, --rate-limit at least 0")
+    if args.forward_policy not in ("defer", "drop") or args.forward_depth < 1:
+        raise SystemExit("X --forward-policy must be defer or drop, --forward-depth at least 1")
+
+    ports = range(args.port, args.port + args.count)
+    name = f"router-{args.port}" if args.count == 1 else f"router-{ports[0]}-{ports[-1]}"
+    host = RouterHost(args.master_ip, args.master_port, workers=args.workers,
+                      max_connections=args.max_connections, rate_limit=args.rate_limit,
+                      forward_policy=args.forward_policy, forward_depth=args.forward_depth)
+    for port in ports:
+        host.add(args.ip, port)
+
+    def signal_handler(signum, frame):
+        """Handler pour les signaux d'interruption"""
+        print("\n[ROUTER] Shutdown signal received...")
+        host.stop()
+        sys.exit(0)
+
     import atexit
     # Enregistrer les handlers de nettoyage
-    atexit.register(cleanup_handler)
+    atexit.register(host.stop)
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
     print(f"\n{'='*60}")
     print(f"ROUTER CONFIGURATION SUMMARY")
     print(f"{'='*60}")
-    print(f"Router address: {ROUTER_IP}:{ROUTER_PORT}")
-    print(f"Master server: {master_ip}:{master_port}")
+    if args.count == 1:
+        print(f"Router address: {args.ip}:{args.port}")
+    else:
+        print(f"Router addresses: {args.ip}:{ports[0]}-{ports[-1]} ({args.count} routers)")
+    print(f"Master server: {args.master_ip}:{args.master_port}")
     print(f"{'='*60}")
 
-    # S'enregistrer auprès du master
-    if not register(master_ip, master_port):
+    # Ouvrir les ports et s'enregistrer auprès du master
+    if not host.start():
         print("[ROUTER] X Cannot continue without registration")
         sys.exit(1)
+    if len(host.nodes) < args.count:
+        print(f"[ROUTER] /!\\ Only {len(host.nodes)}/{args.count} routers started")
+
+    host.trace_sink = tracing.sink_from_env(name, args.trace_dir)
+    metrics.serve_from_env("ROUTER", port=args.metrics_port)
 
     print("\n[ROUTER] Press Ctrl+C to stop the router")
     print("[ROUTER] The router will automatically unregister from master\n")
 
-    # Démarrer le serveur
-    try:
-        if not start_server():
-            print("[ROUTER] X Server failed to start")
-            cleanup_handler()
-            sys.exit(1)
-    except KeyboardInterrupt:
-        print("\n[ROUTER] Keyboard interrupt received")
-        cleanup_handler()
-        sys.exit(0)
+    host.serve_forever()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,583 @@
+"""Stockage du Master : MariaDB, SQLite (mode WAL) ou mémoire
+
+Le Master garde son état de travail en mémoire (routeurs, clients connectés) ;
+le stockage conserve les inscriptions, le journal d'évènements et la boîte aux
+lettres des utilisateurs hors ligne (table messages, gardée au redémarrage).
+Toutes les implémentations offrent les mêmes opérations et signalent leurs
+échecs par StorageError.
+
+    open_storage("mariadb")            # serveur MariaDB (DB_CONFIG)
+    open_storage("sqlite:master.db")   # fichier local, sans serveur
+    open_storage("memory")             # tests, déploiements légers
+"""
+import abc
+import base64
+import os
+import sqlite3
+import threading
+from collections import deque
+
+# Connecteur MariaDB facultatif : seul le backend "mariadb" en a besoin
+try:
+    import mariadb
+except ImportError:
+    mariadb = None
+
+STORAGE_ENV = "ONION_STORAGE"
+DEFAULT_STORAGE = "mariadb"
+DEFAULT_SQLITE_PATH = "master.db"
+MEMORY_MAX_EVENTS = 100000  # Évènements gardés par le stockage mémoire
+KEPT_TABLES = ("messages",)  # Non vidées au lancement : courrier en attente
+
+# Configuration de la base de données
+DB_CONFIG = {
+    'host': 'localhost',
+    'database': 'routage_oignon',
+    'user': 'routage_user',
+    'password': 'wxcvbn%!',
+    'port': 3306
+}
+
+
+class StorageError(Exception):
+    """Base indisponible ou requête en échec"""
+
+
+class Storage(abc.ABC):
+    """Opérations de stockage utilisées par le Master
+
+    Un routeur est unique par (ip, port) dans tous les stockages : une seconde
+    inscription à la même adresse lève StorageError, comme sous MariaDB.
+    """
+    name = None
+
+    @abc.abstractmethod
+    def initialize(self):
+        """Créer les tables si elles n'existent pas"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self):
+        """Vider les tables (au lancement du Master)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_router(self, ip, port, e, n, d):
+        """Enregistrer un routeur ; retourne son ID"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove_router(self, router_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_user(self, username, ip, port, e, n):
+        """Créer ou mettre à jour un utilisateur et le marquer en ligne"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_user_offline(self, username):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_events(self, rows):
+        """Insérer des évènements [(routeur_id, type, message, datetime), ...]"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_mail(self, receiver, sender, payload, when):
+        """Mettre un message (octets) dans la boîte de receiver ; False s'il y est déjà"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def mailbox_usage(self, receiver):
+        """(nombre de messages, octets) en attente pour receiver"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def fetch_mail(self, receiver):
+        """Messages en attente pour receiver, du plus ancien au plus récent : [(id, octets), ...]"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_mail(self, ids):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def purge_mail(self, before):
+        """Supprimer le courrier déposé avant before (datetime) ; retourne le nombre supprimé"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# ---------- MARIADB ----------
+class MariaDBStorage(Storage):
+    """Serveur MariaDB : une connexion par opération"""
+    name = "mariadb"
+
+    def __init__(self, config=None):
+        self.config = config or DB_CONFIG
+
+    def _connect(self):
+        if mariadb is None:
+            raise StorageError("mariadb connector not installed")
+        try:
+            return mariadb.connect(**self.config)
+        except mariadb.Error as e:
+            raise StorageError(e) from e
+
+    def _run(self, statements):
+        """Exécuter [(requête, paramètres), ...] dans une transaction ; retourne le curseur"""
+        db = self._connect()
+        try:
+            cur = db.cursor()
+            for query, params in statements:
+                cur.execute(query, params)
+            db.commit()
+            return cur
+        except mariadb.Error as e:
+            db.rollback()
+            raise StorageError(e) from e
+        finally:
+            db.close()
+
+    def initialize(self):
+        self._run([(query, ()) for query in (
+            """
+                CREATE TABLE IF NOT EXISTS routers (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    ip VARCHAR(45) NOT NULL,
+                    port INT NOT NULL,
+                    e BIGINT NOT NULL,
+                    n BIGINT NOT NULL,
+                    d BIGINT NOT NULL,
+                    registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    UNIQUE KEY unique_router (ip, port)
+                )
+            """,
+            """
+                CREATE TABLE IF NOT EXISTS users (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    username VARCHAR(100) NOT NULL UNIQUE,
+                    ip VARCHAR(45) NOT NULL,
+                    port INT NOT NULL,
+                    public_key_e BIGINT NOT NULL,
+                    public_key_n BIGINT NOT NULL,
+                    is_online BOOLEAN DEFAULT FALSE,
+                    registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                )
+            """,
+            """
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    sender_username VARCHAR(100),
+                    receiver_username VARCHAR(100),
+                    encrypted_message TEXT,
+                    decrypted_message TEXT,
+                    path TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """,
+            """
+                CREATE TABLE IF NOT EXISTS logs (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    routeur_id INT,
+                    type_evenement ENUM('connexion', 'deconnexion', 'message_recu', 'message_envoye', 'erreur') NOT NULL,
+                    message TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    INDEX idx_logs_routeur (routeur_id),
+                    INDEX idx_logs_timestamp (timestamp)
+                )
+            """,
+            """
+                CREATE TABLE IF NOT EXISTS routes (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    route_id VARCHAR(50) NOT NULL,
+                    hops TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_username, created_at)",
+        )])
+        # Base créée avec database/schema.sql : logs.routeur_id y référence routeurs(id),
+        # alors que les ID viennent de la table routers ; un seul évènement refusé
+        # annulerait tout le lot
+        legacy = self._query("""
+            SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'logs'
+            AND COLUMN_NAME = 'routeur_id' AND REFERENCED_TABLE_NAME = 'routeurs'
+        """, ())
+        self._run([(f"ALTER TABLE logs DROP FOREIGN KEY `{name}`", ()) for (name,) in legacy])
+
+    def clear(self):
+        db = self._connect()
+        try:
+            cur = db.cursor()
+            cur.execute("SHOW TABLES")
+            tables = [table[0] for table in cur.fetchall() if table[0] not in KEPT_TABLES]
+            cur.execute("SET FOREIGN_KEY_CHECKS = 0")
+            for table in tables:
+                cur.execute(f"TRUNCATE TABLE {table}")
+            cur.execute("SET FOREIGN_KEY_CHECKS = 1")
+            db.commit()
+            return tables
+        except mariadb.Error as e:
+            db.rollback()
+            raise StorageError(e) from e
+        finally:
+            db.close()
+
+    def add_router(self, ip, port, e, n, d):
+        cur = self._run([(
+            "INSERT INTO routers (ip, port, e, n, d) VALUES (?, ?, ?, ?, ?)",
+            (ip, port, e, n, d)
+        )])
+        return cur.lastrowid
+
+    def remove_router(self, router_id):
+        self._run([("DELETE FROM routers WHERE id = ?", (router_id,))])
+
+    def save_user(self, username, ip, port, e, n):
+        self._run([("""
+            INSERT INTO users
+            (username, ip, port, public_key_e, public_key_n, is_online)
+            VALUES (?, ?, ?, ?, ?, TRUE)
+            ON DUPLICATE KEY UPDATE
+            ip=VALUES(ip), port=VALUES(port), public_key_e=VALUES(public_key_e),
+            public_key_n=VALUES(public_key_n), is_online=TRUE, last_seen=NOW()
+        """, (username, ip, port, e, n))])
+
+    def set_user_offline(self, username):
+        self._run([("UPDATE users SET is_online = FALSE WHERE username = ?", (username,))])
+
+    def add_events(self, rows):
+        db = self._connect()
+        try:
+            db.cursor().executemany(
+                "INSERT INTO logs (routeur_id, type_evenement, message, timestamp) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            db.commit()
+        except mariadb.Error as e:
+            db.rollback()
+            raise StorageError(e) from e
+        finally:
+            db.close()
+
+    def add_mail(self, receiver, sender, payload, when):
+        encoded = base64.b64encode(payload).decode()
+        cur = self._run([("""
+            INSERT INTO messages (sender_username, receiver_username, encrypted_message, created_at)
+            SELECT ?, ?, ?, ? FROM DUAL WHERE NOT EXISTS
+            (SELECT 1 FROM messages WHERE receiver_username = ? AND encrypted_message = ?)
+        """, (sender, receiver, encoded, when, receiver, encoded))])
+        return cur.rowcount > 0
+
+    def _query(self, query, params):
+        db = self._connect()
+        try:
+            cur = db.cursor()
+            cur.execute(query, params)
+            return cur.fetchall()
+        except mariadb.Error as e:
+            raise StorageError(e) from e
+        finally:
+            db.close()
+
+    def mailbox_usage(self, receiver):
+        count, size = self._query(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(encrypted_message)), 0) FROM messages WHERE receiver_username = ?",
+            (receiver,)
+        )[0]
+        return count, int(size) * 3 // 4
+
+    def fetch_mail(self, receiver):
+        rows = self._query(
+            "SELECT id, encrypted_message FROM messages WHERE receiver_username = ? ORDER BY id",
+            (receiver,)
+        )
+        return [(mail_id, base64.b64decode(encoded)) for mail_id, encoded in rows]
+
+    def delete_mail(self, ids):
+        self._run([("DELETE FROM messages WHERE id = ?", (mail_id,)) for mail_id in ids])
+
+    def purge_mail(self, before):
+        return self._run([("DELETE FROM messages WHERE created_at < ?", (before,))]).rowcount
+
+
+# ---------- SQLITE ----------
+class SQLiteStorage(Storage):
+    """Fichier SQLite local en mode WAL (aucun serveur à lancer)
+
+    Une seule connexion partagée entre les threads du Master, protégée par un
+    verrou : SQLite n'accepte de toute façon qu'un écrivain à la fois.
+    """
+    name = "sqlite"
+
+    SCHEMA = (
+        """
+            CREATE TABLE IF NOT EXISTS routers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ip TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                e INTEGER NOT NULL,
+                n INTEGER NOT NULL,
+                d INTEGER NOT NULL,
+                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (ip, port)
+            )
+        """,
+        # Fichier créé avant la contrainte : routeurs en double retirés (la table est
+        # vidée au lancement de toute façon), puis index unique
+        "DELETE FROM routers WHERE id NOT IN (SELECT MIN(id) FROM routers GROUP BY ip, port)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS unique_router ON routers (ip, port)",
+        """
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL UNIQUE,
+                ip TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                public_key_e INTEGER NOT NULL,
+                public_key_n INTEGER NOT NULL,
+                is_online INTEGER DEFAULT 0,
+                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender_username TEXT,
+                receiver_username TEXT,
+                encrypted_message TEXT,
+                decrypted_message TEXT,
+                path TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                routeur_id INTEGER,
+                type_evenement TEXT NOT NULL CHECK (type_evenement IN
+                    ('connexion', 'deconnexion', 'message_recu', 'message_envoye', 'erreur')),
+                message TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_logs_routeur ON logs (routeur_id)",
+        "CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs (timestamp)",
+        """
+            CREATE TABLE IF NOT EXISTS routes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                route_id TEXT NOT NULL,
+                hops TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_username, created_at)",
+    )
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")  # Suffisant en WAL, bien plus rapide
+        except sqlite3.Error as e:
+            raise StorageError(e) from e
+
+    def _run(self, query, params=(), many=False):
+        with self.lock:
+            try:
+                cur = self.db.executemany(query, params) if many else self.db.execute(query, params)
+                self.db.commit()
+                return cur
+            except sqlite3.Error as e:
+                self.db.rollback()
+                raise StorageError(e) from e
+
+    def initialize(self):
+        with self.lock:
+            try:
+                for query in self.SCHEMA:
+                    self.db.execute(query)
+                self.db.commit()
+            except sqlite3.Error as e:
+                raise StorageError(e) from e
+
+    def clear(self):
+        with self.lock:
+            try:
+                tables = [row[0] for row in self.db.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+                ) if row[0] not in KEPT_TABLES]
+                for table in tables:
+                    self.db.execute(f"DELETE FROM {table}")
+                self.db.commit()
+                return tables
+            except sqlite3.Error as e:
+                self.db.rollback()
+                raise StorageError(e) from e
+
+    def add_router(self, ip, port, e, n, d):
+        return self._run(
+            "INSERT INTO routers (ip, port, e, n, d) VALUES (?, ?, ?, ?, ?)",
+            (ip, port, e, n, d)
+        ).lastrowid
+
+    def remove_router(self, router_id):
+        self._run("DELETE FROM routers WHERE id = ?", (router_id,))
+
+    def save_user(self, username, ip, port, e, n):
+        self._run("""
+            INSERT INTO users (username, ip, port, public_key_e, public_key_n, is_online)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT(username) DO UPDATE SET
+            ip=excluded.ip, port=excluded.port, public_key_e=excluded.public_key_e,
+            public_key_n=excluded.public_key_n, is_online=1, last_seen=CURRENT_TIMESTAMP
+        """, (username, ip, port, e, n))
+
+    def set_user_offline(self, username):
+        self._run("UPDATE users SET is_online = 0 WHERE username = ?", (username,))
+
+    def add_events(self, rows):
+        self._run(
+            "INSERT INTO logs (routeur_id, type_evenement, message, timestamp) VALUES (?, ?, ?, ?)",
+            [(router_id, event_type, message, when.isoformat(" ")) for router_id, event_type, message, when in rows],
+            many=True
+        )
+
+    def add_mail(self, receiver, sender, payload, when):
+        encoded = base64.b64encode(payload).decode()
+        return self._run("""
+            INSERT INTO messages (sender_username, receiver_username, encrypted_message, created_at)
+            SELECT ?, ?, ?, ? WHERE NOT EXISTS
+            (SELECT 1 FROM messages WHERE receiver_username = ? AND encrypted_message = ?)
+        """, (sender, receiver, encoded, when.isoformat(" "), receiver, encoded)).rowcount > 0
+
+    def mailbox_usage(self, receiver):
+        count, size = self._run(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(encrypted_message)), 0) FROM messages WHERE receiver_username = ?",
+            (receiver,)
+        ).fetchone()
+        return count, size * 3 // 4
+
+    def fetch_mail(self, receiver):
+        rows = self._run(
+            "SELECT id, encrypted_message FROM messages WHERE receiver_username = ? ORDER BY id",
+            (receiver,)
+        ).fetchall()
+        return [(mail_id, base64.b64decode(encoded)) for mail_id, encoded in rows]
+
+    def delete_mail(self, ids):
+        self._run("DELETE FROM messages WHERE id = ?", [(mail_id,) for mail_id in ids], many=True)
+
+    def purge_mail(self, before):
+        return self._run("DELETE FROM messages WHERE created_at < ?", (before.isoformat(" "),)).rowcount
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# ---------- MÉMOIRE ----------
+class MemoryStorage(Storage):
+    """Tout en mémoire, rien n'est conservé à l'arrêt (tests, bancs d'essai)"""
+    name = "memory"
+
+    def __init__(self, max_events=MEMORY_MAX_EVENTS):
+        self.lock = threading.Lock()
+        self.routers = {}
+        self.users = {}
+        self.events = deque(maxlen=max_events)
+        self.mail = {}  # id -> (destinataire, expéditeur, octets, datetime)
+        self.next_router_id = 1
+        self.next_mail_id = 1
+
+    def initialize(self):
+        pass
+
+    def clear(self):
+        with self.lock:
+            self.routers.clear()
+            self.users.clear()
+            self.events.clear()
+        return ["routers", "users", "logs"]
+
+    def add_router(self, ip, port, e, n, d):
+        with self.lock:
+            if any(router["ip"] == ip and router["port"] == port for router in self.routers.values()):
+                raise StorageError(f"Duplicate router {ip}:{port}")
+            router_id = self.next_router_id
+            self.next_router_id += 1
+            self.routers[router_id] = {"ip": ip, "port": port, "e": e, "n": n, "d": d}
+            return router_id
+
+    def remove_router(self, router_id):
+        with self.lock:
+            self.routers.pop(router_id, None)
+
+    def save_user(self, username, ip, port, e, n):
+        with self.lock:
+            self.users[username] = {"ip": ip, "port": port, "e": e, "n": n, "is_online": True}
+
+    def set_user_offline(self, username):
+        with self.lock:
+            if username in self.users:
+                self.users[username]["is_online"] = False
+
+    def add_events(self, rows):
+        with self.lock:
+            self.events.extend(rows)
+
+    def add_mail(self, receiver, sender, payload, when):
+        with self.lock:
+            if any(to == receiver and data == payload for to, _, data, _ in self.mail.values()):
+                return False
+            self.mail[self.next_mail_id] = (receiver, sender, bytes(payload), when)
+            self.next_mail_id += 1
+            return True
+
+    def mailbox_usage(self, receiver):
+        with self.lock:
+            sizes = [len(data) for to, _, data, _ in self.mail.values() if to == receiver]
+        return len(sizes), sum(sizes)
+
+    def fetch_mail(self, receiver):
+        with self.lock:
+            return [(mail_id, data) for mail_id, (to, _, data, _) in sorted(self.mail.items()) if to == receiver]
+
+    def delete_mail(self, ids):
+        with self.lock:
+            for mail_id in ids:
+                self.mail.pop(mail_id, None)
+
+    def purge_mail(self, before):
+        with self.lock:
+            expired = [mail_id for mail_id, (_, _, _, when) in self.mail.items() if when < before]
+            for mail_id in expired:
+                del self.mail[mail_id]
+        return len(expired)
+
+
+def open_storage(spec=None):
+    """Créer le stockage décrit par spec ("mariadb", "sqlite[:chemin]", "memory")
+
+    Sans spec : variable d'environnement ONION_STORAGE, sinon MariaDB.
+    """
+    spec = spec or os.environ.get(STORAGE_ENV, "").strip() or DEFAULT_STORAGE
+    kind, _, arg = spec.partition(":")
+    if kind == "mariadb":
+        return MariaDBStorage()
+    if kind == "sqlite":
+        return SQLiteStorage(arg or DEFAULT_SQLITE_PATH)
+    if kind == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage '{spec}' (mariadb, sqlite[:path], memory)")
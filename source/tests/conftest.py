@@ -0,0 +1,5 @@
+"""Les modules du projet s'importent à plat depuis source/ (import storage, import onion...)"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,89 @@
+"""Format des couches (onion.py) et leur retrait par les routeurs"""
+import os
+import random
+
+import pytest
+
+from client import ChatClient
+from master import generate_keys
+from onion import (
+    HEADER_SIZE, KEY_SIZE, KEYSTREAM_BLOCK, format_header, is_layer, parse_header,
+    unpack_header, xor_stream
+)
+from router import STREAM_CHUNK, open_layer, peel_layer
+
+
+@pytest.fixture
+def path():
+    """Trois routeurs avec leurs clés et un destinataire"""
+    random.seed(42)
+    routers = []
+    for i in range(3):
+        pub, priv = generate_keys()
+        routers.append({"ip": "127.0.0.1", "port": 5001 + i, "pub_key": pub, "priv_key": priv})
+    return routers, {"ip": "127.0.0.1", "port": 7001}
+
+
+def test_xor_stream_round_trip_and_offsets():
+    key = os.urandom(KEY_SIZE)
+    data = os.urandom(KEYSTREAM_BLOCK * 2 + 123)
+    cipher = xor_stream(data, key)
+    assert cipher != data and xor_stream(cipher, key) == data
+    # Par morceaux, à cheval sur les blocs du flux de clé (relais en flux)
+    split = KEYSTREAM_BLOCK - 10
+    assert xor_stream(data[:split], key) + xor_stream(data[split:], key, split) == cipher
+
+
+def test_header_round_trip():
+    key = os.urandom(KEY_SIZE)
+    assert parse_header(format_header("10.0.0.1", 5001, key)) == ("10.0.0.1", 5001, key)
+
+
+@pytest.mark.parametrize("text", ["garbage", "10.0.0.1;5001", "10.0.0.1;port;" + "00" * KEY_SIZE,
+                                  "10.0.0.1;5001;" + "00" * (KEY_SIZE - 1), "10.0.0.1;5001;zz"])
+def test_bad_header_rejected(text):
+    with pytest.raises(ValueError):
+        parse_header(text)
+
+
+def test_header_too_long():
+    with pytest.raises(ValueError):
+        format_header("x" * 60, 5001, os.urandom(KEY_SIZE))
+
+
+def test_onion_peeled_hop_by_hop(path):
+    routers, target = path
+    message = "alice:héllo".encode()
+    layer = ChatClient().build_onion(message, routers, target)
+    hops = [(r["ip"], r["port"]) for r in routers[1:]] + [(target["ip"], target["port"])]
+    for router, (ip, port) in zip(routers, hops):
+        assert is_layer(layer)
+        header, layer = peel_layer(layer, router["priv_key"])
+        assert header == f"{ip};{port}"
+    assert bytes(layer) == message and not is_layer(layer)
+
+
+def test_streamed_peel_matches(path):
+    routers, target = path
+    body = os.urandom(3 * STREAM_CHUNK + 7)
+    layer = ChatClient().build_onion(body, routers[:1], target)
+    ip, port, key, _ = open_layer(layer[:1 + HEADER_SIZE], routers[0]["priv_key"])
+    assert (ip, port) == (target["ip"], target["port"])
+    content = layer[1 + HEADER_SIZE:]
+    chunks = [xor_stream(content[i:i + STREAM_CHUNK], key, i) for i in range(0, len(content), STREAM_CHUNK)]
+    assert b"".join(chunks) == body
+
+
+def test_truncated_layer(path):
+    routers, target = path
+    layer = ChatClient().build_onion(b"alice:hi", routers[:1], target)
+    with pytest.raises(ValueError):
+        unpack_header(layer[:HEADER_SIZE])
+    assert peel_layer(layer[:HEADER_SIZE], routers[0]["priv_key"]) == (None, b"")
+
+
+def test_wrong_key_or_legacy_format(path):
+    routers, target = path
+    layer = ChatClient().build_onion(b"alice:hi", routers[:1], target)
+    assert peel_layer(layer, routers[1]["priv_key"]) == (None, b"")  # Couche d'un autre routeur
+    assert not is_layer(b"123,456,789")  # Ancien format : refusé par relay_onion
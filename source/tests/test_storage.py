@@ -0,0 +1,82 @@
+"""Stockages mémoire et SQLite : même comportement que MariaDB pour le Master"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import master
+from storage import MemoryStorage, SQLiteStorage, Storage, StorageError
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request):
+    store = MemoryStorage() if request.param == "memory" else SQLiteStorage(":memory:")
+    store.initialize()
+    yield store
+    store.close()
+
+
+def mailbox(storage, **limits):
+    return master.Mailbox(storage, lambda *args, **kwargs: None, **limits)
+
+
+def test_incomplete_backend_cannot_be_instantiated():
+    class Partial(Storage):
+        def initialize(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_router_unique_by_address(storage):
+    first = storage.add_router("127.0.0.1", 5001, 3, 437, 55)
+    with pytest.raises(StorageError):
+        storage.add_router("127.0.0.1", 5001, 3, 437, 55)
+    assert storage.add_router("127.0.0.1", 5002, 3, 437, 55) != first
+    storage.remove_router(first)
+    storage.add_router("127.0.0.1", 5001, 3, 437, 55)  # Adresse libérée
+
+
+def test_save_user_updates_existing_user(storage):
+    storage.save_user("bob", "127.0.0.1", 7001, 3, 437)
+    storage.set_user_offline("bob")
+    storage.save_user("bob", "127.0.0.1", 7002, 5, 493)  # Réinscription : pas de doublon
+    storage.set_user_offline("unknown")
+
+
+def test_mail_fetched_in_order_and_deleted(storage):
+    now = datetime.now()
+    assert storage.add_mail("bob", "alice", b"alice:\x00\x04one", now)
+    assert storage.add_mail("bob", "alice", b"alice:\x00\x04two", now)
+    assert storage.add_mail("carol", "alice", b"alice:\x00\x04one", now)  # Autre destinataire
+    mail = storage.fetch_mail("bob")
+    assert [payload for _, payload in mail] == [b"alice:\x00\x04one", b"alice:\x00\x04two"]
+    storage.delete_mail([mail_id for mail_id, _ in mail])
+    assert storage.fetch_mail("bob") == []
+    assert storage.mailbox_usage("carol")[0] == 1
+
+
+def test_mail_dedup(storage):
+    box = mailbox(storage)
+    assert box.deposit("bob", "alice", b"alice:\x00\x04same") == "OK"
+    assert box.deposit("bob", "alice", b"alice:\x00\x04same") == "OK"  # Renvoi : gardé une fois
+    assert storage.mailbox_usage("bob") == (1, len(b"alice:\x00\x04same"))
+
+
+def test_mailbox_quota(storage):
+    box = mailbox(storage, max_messages=2, max_bytes=100)
+    assert box.deposit("bob", "alice", b"alice:\x00\x04m1") == "OK"
+    assert box.deposit("bob", "alice", b"alice:\x00\x04m2") == "OK"
+    assert box.deposit("bob", "alice", b"alice:\x00\x04m3") == "ERROR:QUOTA"
+    assert box.deposit("carol", "alice", b"alice:\x00\x04" + b"x" * 200) == "ERROR:QUOTA"
+    assert box.deposit("carol", "alice", b"x" * (master.MAILBOX_MAX_MESSAGE + 1)) == "ERROR:TOO_LARGE"
+    assert box.pending("bob") == 2
+
+
+def test_mailbox_ttl(storage):
+    old = datetime.now() - timedelta(hours=2)
+    storage.add_mail("bob", "alice", b"alice:\x00\x04old", old)
+    storage.add_mail("bob", "alice", b"alice:\x00\x04new", datetime.now())
+    box = mailbox(storage, ttl=3600)
+    box.purge()
+    assert [payload for _, payload in storage.fetch_mail("bob")] == [b"alice:\x00\x04new"]
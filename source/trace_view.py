@@ -0,0 +1,127 @@
+"""Recoller le trajet des messages tracés à partir des fichiers de trace
+
+    python trace_view.py traces/                 # traces les plus lentes
+    python trace_view.py traces/ other_vm/ -t 3fa2c1...   # chronologie d'une trace
+
+Les fichiers *.jsonl de chaque dossier (un par client / routeur, voir
+tracing.py) sont lus puis regroupés par identifiant de trace.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+# Étapes connues d'un passage, dans l'ordre où elles se produisent
+STEPS = (
+    ("started", "path requested"),
+    ("built", "onion built"),
+    ("sent", "sent to first router"),
+    ("received", "received"),
+    ("decrypted", "layer decrypted"),
+    ("queued", "queued for next hop"),
+    ("forwarded", "forwarded"),
+)
+
+
+def load_traces(paths):
+    """Lire les fichiers de trace : {trace_id: [passage, ...]}"""
+    traces = {}
+    for path in paths:
+        files = glob.glob(os.path.join(path, "*.jsonl")) if os.path.isdir(path) else [path]
+        for name in files:
+            with open(name, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Ligne tronquée (composant arrêté en cours d'écriture)
+                    if "trace" in record:
+                        traces.setdefault(record["trace"], []).append(record)
+    return traces
+
+
+def first_time(record):
+    return min(record[key] for key, _ in STEPS if key in record)
+
+
+def last_time(record):
+    return max(record[key] for key, _ in STEPS if key in record)
+
+
+def timeline(records):
+    """Étapes d'une trace triées par heure : [(t, nœud, étape), ...]"""
+    steps = []
+    for record in records:
+        for key, label in STEPS:
+            if key in record:
+                if key == "forwarded" and record.get("next"):
+                    label = f"{label} to {record['next']}"
+                steps.append((record[key], record["node"], label))
+        if "error" in record:
+            steps.append((last_time(record), record["node"], f"ERROR {record['error']}"))
+    steps.sort(key=lambda step: step[0])
+    return steps
+
+
+def print_timeline(trace_id, records):
+    steps = timeline(records)
+    if not steps:
+        print(f"Trace {trace_id}: no timestamps")
+        return
+    origin = previous = steps[0][0]
+    print(f"Trace {trace_id} ({len(records)} records, {(steps[-1][0] - origin) * 1000:.1f} ms)")
+    print(f"{'+ms':>9} {'delta':>9}  {'node':<28} step")
+    for t, node, label in steps:
+        print(f"{(t - origin) * 1000:9.2f} {(t - previous) * 1000:9.2f}  {node:<28} {label}")
+        previous = t
+
+    # Temps passé dans chaque nœud puis en transit vers le suivant
+    hops = sorted(records, key=first_time)
+    print("\nPer hop:")
+    for i, record in enumerate(hops):
+        inside = (last_time(record) - first_time(record)) * 1000
+        line = f"  {record['node']:<28} {inside:8.2f} ms in node"
+        if "decrypted" in record and "received" in record:
+            line += f" (decrypt {(record['decrypted'] - record['received']) * 1000:.2f} ms)"
+        print(line)
+        if i + 1 < len(hops):
+            transit = (first_time(hops[i + 1]) - last_time(record)) * 1000
+            print(f"  {'-> network':<28} {transit:8.2f} ms")
+
+
+def print_slowest(traces, count):
+    rows = []
+    for trace_id, records in traces.items():
+        steps = timeline(records)
+        if steps:
+            complete = any("received" in r and r["node"].startswith("client") for r in records)
+            rows.append(((steps[-1][0] - steps[0][0]) * 1000, trace_id, len(records), complete))
+    rows.sort(reverse=True)
+    print(f"{len(traces)} traces")
+    print(f"{'ms':>9}  {'trace':<16} {'records':>7}  delivered")
+    for duration, trace_id, size, complete in rows[:count]:
+        print(f"{duration:9.2f}  {trace_id:<16} {size:7d}  {'yes' if complete else 'no'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stitch per-hop traces of onion messages")
+    parser.add_argument("paths", nargs="+", help="trace directories or .jsonl files")
+    parser.add_argument("-t", "--trace", help="show the timeline of this trace id")
+    parser.add_argument("-n", "--slowest", type=int, default=20, help="number of traces listed")
+    args = parser.parse_args()
+
+    traces = load_traces(args.paths)
+    if args.trace:
+        matches = [trace_id for trace_id in traces if trace_id.startswith(args.trace)]
+        if not matches:
+            print(f"X Trace {args.trace} not found")
+            sys.exit(1)
+        for trace_id in matches:
+            print_timeline(trace_id, traces[trace_id])
+    else:
+        print_slowest(traces, args.slowest)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Traçage optionnel du trajet d'un message, saut par saut
+
+Quand la variable d'environnement ONION_TRACE_DIR est définie, le client
+marque ses oignons d'un identifiant de trace (trame FRAME_TRACED) et chaque
+composant ajoute une ligne JSON par passage dans son propre fichier :
+
+    ONION_TRACE_DIR/client-alice.jsonl
+    ONION_TRACE_DIR/router-5001.jsonl
+
+Les routeurs transmettent toujours l'identifiant au saut suivant, même sans
+fichier de trace. trace_view.py recolle ensuite les fichiers par trace.
+Les horodatages viennent de l'horloge de chaque machine (time.time()) : sur
+plusieurs machines, les écarts entre sauts supposent des horloges synchronisées.
+"""
+import json
+import os
+import threading
+
+from protocol import TRACE_ID_SIZE
+
+TRACE_ENV = "ONION_TRACE_DIR"
+
+
+def new_trace_id():
+    """Identifiant aléatoire d'une trace (hexadécimal)"""
+    return os.urandom(TRACE_ID_SIZE).hex()
+
+
+class TraceSink:
+    """Fichier JSONL local recevant les passages d'un composant"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def record(self, trace_id, node, **fields):
+        """Ajouter un passage : {"trace": ..., "node": ..., horodatages...}"""
+        line = json.dumps({"trace": trace_id, "node": node, **fields}, ensure_ascii=False)
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def sink_from_env(name, directory=None):
+    """Ouvrir <directory ou ONION_TRACE_DIR>/<name>.jsonl si le traçage est activé, sinon None"""
+    directory = directory or os.environ.get(TRACE_ENV, "").strip()
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        sink = TraceSink(os.path.join(directory, f"{name}.jsonl"))
+    except OSError as e:
+        print(f"[TRACE] X Cannot open trace sink in {directory}: {e}")
+        return None
+    print(f"[TRACE] Tracing enabled -> {sink.path}")
+    return sink
@@ -0,0 +1,490 @@
+"""Transfert de fichiers sur le réseau en oignon
+
+Un fichier est découpé en morceaux envoyés comme des messages (mêmes couches
+de chiffrement) sur un chemin de routeurs demandé une seule fois au master.
+Le destinataire répond par ses propres oignons, sur son propre chemin :
+
+    OFFER  émetteur -> destinataire : id, taille, taille des morceaux, nom
+    CHUNK  émetteur -> destinataire : id, numéro, données
+    ACK    destinataire -> émetteur : id, nombre de morceaux reçus à la suite, état
+
+Le destinataire répond à OFFER par un ACK qui indique où reprendre. Au plus
+WINDOW morceaux sont en vol sans accusé de réception ; sans progrès pendant
+ACK_TIMEOUT secondes, l'émetteur renvoie tout depuis le dernier morceau
+acquitté. L'identifiant dépend du fichier (chemin, taille, date) et du
+destinataire : relancer le même envoi reprend là où le destinataire s'était
+arrêté (morceaux gardés dans <dossier>/partial).
+
+Une offre est refusée (ACK refusé) si les réceptions en cours dépassaient
+alors INCOMING_QUOTA octets annoncés, ou s'il resterait moins de DISK_MIN_FREE
+octets libres sur le disque. Une réception sans nouveau morceau pendant
+INCOMING_TIMEOUT secondes est fermée (les morceaux reçus restent pour une
+reprise) ; les fichiers partiels laissés plus de PARTIAL_TTL secondes sont
+supprimés.
+
+Ces messages de contrôle sont reconnus à leur premier octet (CONTROL_PREFIX,
+jamais présent au début d'un message texte) après "expéditeur:".
+"""
+import hashlib
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+CONTROL_PREFIX = b"\x00"
+MSG_OFFER = 1
+MSG_CHUNK = 2
+MSG_ACK = 3
+ACK_OK = 0
+ACK_REFUSED = 1
+
+TRANSFER_ID_SIZE = 16
+OFFER_FORMAT = struct.Struct("!QIH")  # taille, taille des morceaux, longueur du nom
+CHUNK_FORMAT = struct.Struct("!I")  # numéro du morceau
+ACK_FORMAT = struct.Struct("!IB")  # morceaux reçus à la suite, état
+
+CHUNK_SIZE = 64 * 1024  # Sous le seuil de relais en flux des routeurs
+MAX_CHUNK_SIZE = 1024 * 1024
+MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024  # 4 Go
+WINDOW = 8  # Morceaux envoyés sans accusé de réception
+ACK_TIMEOUT = 10.0  # Sans progrès pendant ce délai : renvoi depuis le dernier morceau acquitté (s)
+MAX_RETRIES = 5  # Renvois successifs sans progrès avant abandon (l'envoi pourra reprendre)
+ACK_LAYERS = 3  # Couches des oignons de réponse du destinataire
+ACK_WORKERS = 2  # Threads d'envoi des ACK, hors des threads de réception
+INCOMING_QUOTA = 4 * 1024 * 1024 * 1024  # Taille annoncée cumulée max des réceptions en cours
+DISK_MIN_FREE = 512 * 1024 * 1024  # Espace disque laissé libre après une réception acceptée
+INCOMING_TIMEOUT = 120.0  # Réception fermée sans nouveau morceau pendant ce délai (s)
+PARTIAL_TTL = 24 * 3600  # Fichiers partiels supprimés après ce délai sans reprise (s)
+INCOMING_SWEEP = 10.0  # Recherche des réceptions inactives (s)
+
+FILE_BYTES_SENT = metrics.counter("onion_client_file_bytes_sent_total", "Octets de fichiers acquittés par le destinataire")
+FILE_BYTES_RECEIVED = metrics.counter("onion_client_file_bytes_received_total", "Octets de fichiers reçus")
+FILE_RETRANSMITS = metrics.counter("onion_client_file_retransmits_total", "Reprises depuis le dernier morceau acquitté")
+FILE_TRANSFERS = metrics.counter("onion_client_file_transfers_total", "Transferts de fichiers terminés", ("direction", "result"))
+
+
+def pack_message(kind, transfer_id, payload=b""):
+    return CONTROL_PREFIX + bytes([kind]) + transfer_id + payload
+
+
+def format_size(size):
+    for unit in ("o", "Ko", "Mo", "Go"):
+        if size < 1024 or unit == "Go":
+            return f"{size:.0f} {unit}" if unit == "o" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_rate(bytes_per_second):
+    return f"{format_size(bytes_per_second)}/s"
+
+
+def safe_file_name(name):
+    """Nom de fichier proposé par l'émetteur, sans chemin"""
+    name = os.path.basename(name.replace("\\", "/")).strip().lstrip(".")
+    return name or "fichier"
+
+
+def unique_path(directory, name):
+    """directory/name, ou directory/name (1).ext si le fichier existe déjà"""
+    base, ext = os.path.splitext(name)
+    path = os.path.join(directory, name)
+    counter = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{base} ({counter}){ext}")
+        counter += 1
+    return path
+
+
+class OutgoingTransfer:
+    """Envoi en cours : position acquittée par le destinataire"""
+
+    def __init__(self, transfer_id, target, path, size, chunk_size):
+        self.id = transfer_id
+        self.target = target
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = size
+        self.chunk_size = chunk_size
+        self.total = max(1, -(-size // chunk_size))  # Un fichier vide = un morceau vide
+        self.acked = None  # Morceaux reçus à la suite (None tant que l'offre n'a pas de réponse)
+        self.refused = False
+        self.changed = threading.Condition()
+
+    def on_ack(self, count, status):
+        with self.changed:
+            if status != ACK_OK:
+                self.refused = True
+            elif self.acked is None or count > self.acked:
+                self.acked = min(count, self.total)
+            self.changed.notify_all()
+
+    def wait(self, since, timeout):
+        """Attendre que la position acquittée dépasse since (ou un refus) ; la retourne"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.refused or self.acked != since, timeout)
+            return self.acked
+
+
+class IncomingTransfer:
+    """Réception en cours : morceaux écrits dans partial/<id>.part, état dans <id>.json"""
+
+    def __init__(self, directory, sender, transfer_id, name, size, chunk_size):
+        self.sender = sender
+        self.id = transfer_id
+        self.name = name
+        self.size = size
+        self.chunk_size = chunk_size
+        self.total = max(1, -(-size // chunk_size))
+        self.next = 0  # Premier morceau manquant
+        self.extra = set()  # Morceaux reçus au-delà de self.next
+        self.lock = threading.Lock()
+        self.route = None  # Chemin vers l'émetteur pour les ACK, demandé une fois
+        self.updated = time.monotonic()  # Dernier morceau reçu (expiration)
+        base = os.path.join(directory, f"{safe_file_name(sender)}-{transfer_id.hex()}")
+        self.part_path = base + ".part"
+        self.state_path = base + ".json"
+        self._load_state()
+        self.file = open(self.part_path, "r+b" if os.path.exists(self.part_path) else "w+b")
+
+    def _load_state(self):
+        """Reprendre une réception interrompue (même fichier proposé à nouveau)"""
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (state.get("size"), state.get("chunk_size")) == (self.size, self.chunk_size):
+            self.next = state.get("next", 0)
+            self.extra = set(state.get("extra", []))
+
+    def _save_state(self):
+        state = {"sender": self.sender, "name": self.name, "size": self.size,
+                 "chunk_size": self.chunk_size, "next": self.next, "extra": sorted(self.extra)}
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+
+    def write(self, index, data):
+        """Écrire un morceau ; retourne le nombre de morceaux reçus à la suite"""
+        if index >= self.total or len(data) > self.chunk_size:
+            raise ValueError(f"Invalid chunk {index}")
+        with self.lock:
+            self.updated = time.monotonic()
+            if index >= self.next and index not in self.extra:
+                self.file.seek(index * self.chunk_size)
+                self.file.write(data)
+                FILE_BYTES_RECEIVED.inc(len(data))
+                self.extra.add(index)
+                while self.next in self.extra:
+                    self.extra.discard(self.next)
+                    self.next += 1
+                self._save_state()
+            return self.next
+
+    @property
+    def complete(self):
+        return self.next >= self.total
+
+    def finish(self, directory):
+        """Déplacer le fichier complet dans directory ; retourne son chemin"""
+        with self.lock:
+            self.file.truncate(self.size)
+            self.file.close()
+            path = unique_path(directory, self.name)
+            os.replace(self.part_path, path)
+            try:
+                os.remove(self.state_path)
+            except OSError:
+                pass
+            return path
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class TransferManager:
+    """Envois et réceptions de fichiers d'un ChatClient"""
+
+    def __init__(self, client):
+        self.client = client
+        self.directory = None  # Fichiers reçus ; partial/ pour les réceptions en cours
+        self.outgoing = {}  # id -> OutgoingTransfer
+        self.incoming = {}  # (expéditeur, id) -> IncomingTransfer
+        self.completed = {}  # (expéditeur, id) -> nombre de morceaux (renvois tardifs)
+        self.lock = threading.Lock()
+        self.sweeper = None  # Thread qui ferme les réceptions inactives, tant qu'il y en a
+        self.acks = ThreadPoolExecutor(max_workers=ACK_WORKERS, thread_name_prefix="transfer-ack")
+
+    # ---------- ENVOI ----------
+    def send_file(self, target_user, path, nb_layers=1, progress=None, chunk_size=CHUNK_SIZE):
+        """Envoyer un fichier ; progress(octets acquittés, taille, débit) ; retourne (succès, statut)"""
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            return False, f"Fichier illisible: {e}"
+        if stat.st_size > MAX_FILE_SIZE:
+            return False, f"Fichier trop volumineux (max {format_size(MAX_FILE_SIZE)})"
+
+        key = f"{self.client.username}\0{target_user}\0{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        transfer = OutgoingTransfer(hashlib.sha256(key.encode()).digest()[:TRANSFER_ID_SIZE],
+                                    target_user, path, stat.st_size, chunk_size)
+        routers, target_info = self.client.request_path(target_user, nb_layers)
+        if not routers:
+            return False, "Impossible d'obtenir un chemin"
+        route = [routers, target_info]
+
+        with self.lock:
+            self.outgoing[transfer.id] = transfer
+        try:
+            with open(path, "rb") as f:
+                return self._send(transfer, f, route, nb_layers, progress)
+        except OSError as e:
+            FILE_TRANSFERS.inc(direction="sent", result="error")
+            return False, f"Erreur d'envoi: {e}"
+        finally:
+            with self.lock:
+                self.outgoing.pop(transfer.id, None)
+
+    def _send_payload(self, transfer, route, nb_layers, payload):
+        """Envoyer sur le chemin du transfert ; un nouveau chemin si le premier routeur ne répond plus"""
+        try:
+            self.client.send_payload(route[0], route[1], payload)
+        except OSError:
+            routers, target_info = self.client.request_path(transfer.target, nb_layers)
+            if not routers:
+                raise
+            route[:] = [routers, target_info]
+            self.client.send_payload(routers, target_info, payload)
+
+    def _send(self, transfer, f, route, nb_layers, progress):
+        name = transfer.name.encode()[:1024]
+        offer = pack_message(MSG_OFFER, transfer.id,
+                             OFFER_FORMAT.pack(transfer.size, transfer.chunk_size, len(name)) + name)
+        # Offre : le destinataire répond par le premier morceau qu'il lui manque
+        for _ in range(MAX_RETRIES):
+            self._send_payload(transfer, route, nb_layers, offer)
+            if transfer.wait(None, ACK_TIMEOUT) is not None or transfer.refused:
+                break
+        if transfer.refused or transfer.acked is None:
+            FILE_TRANSFERS.inc(direction="sent", result="no_answer")
+            return False, f"{transfer.target} n'a pas répondu à l'offre de fichier"
+
+        resumed_from = transfer.acked
+        started = time.perf_counter()
+        next_index = transfer.acked
+        last_acked = transfer.acked
+        retries = 0
+
+        def advance(acked):
+            """Compter et signaler les morceaux acquittés depuis last_acked"""
+            nonlocal last_acked
+            done = min(acked * transfer.chunk_size, transfer.size)
+            FILE_BYTES_SENT.inc(done - min(last_acked * transfer.chunk_size, transfer.size))
+            last_acked = acked
+            if progress:
+                elapsed = time.perf_counter() - started
+                rate = (done - resumed_from * transfer.chunk_size) / elapsed if elapsed else 0.0
+                progress(done, transfer.size, rate)
+
+        while transfer.acked < transfer.total:
+            # Fenêtre : au plus WINDOW morceaux sans accusé de réception
+            while next_index < transfer.total and next_index - transfer.acked < WINDOW:
+                f.seek(next_index * transfer.chunk_size)
+                data = f.read(transfer.chunk_size)
+                self._send_payload(transfer, route, nb_layers,
+                                   pack_message(MSG_CHUNK, transfer.id, CHUNK_FORMAT.pack(next_index) + data))
+                next_index += 1
+                if transfer.acked > last_acked:
+                    advance(transfer.acked)
+
+            acked = transfer.wait(last_acked, ACK_TIMEOUT)
+            if transfer.refused:
+                FILE_TRANSFERS.inc(direction="sent", result="refused")
+                return False, f"{transfer.target} a refusé le fichier"
+            if acked > last_acked:
+                advance(acked)
+                retries = 0
+            else:
+                # Aucun progrès : reprendre depuis le dernier morceau acquitté
+                retries += 1
+                if retries > MAX_RETRIES:
+                    FILE_TRANSFERS.inc(direction="sent", result="timeout")
+                    return False, (f"Transfert interrompu à {acked}/{transfer.total} morceaux "
+                                   f"(renvoyer le fichier pour reprendre)")
+                FILE_RETRANSMITS.inc()
+                next_index = acked
+
+        elapsed = time.perf_counter() - started
+        sent = transfer.size - min(resumed_from * transfer.chunk_size, transfer.size)
+        FILE_TRANSFERS.inc(direction="sent", result="ok")
+        status = f"Fichier envoyé: {transfer.name} ({format_size(transfer.size)}"
+        if elapsed > 0:
+            status += f", {format_rate(sent / elapsed)}"
+        if resumed_from:
+            status += f", repris au morceau {resumed_from}/{transfer.total}"
+        return True, status + ")"
+
+    # ---------- RÉCEPTION ----------
+    def handle(self, sender, body):
+        """Traiter un message de contrôle reçu ; retourne un texte à afficher ou None"""
+        if len(body) < 2 + TRANSFER_ID_SIZE:
+            return None
+        kind = body[1]
+        transfer_id = bytes(body[2:2 + TRANSFER_ID_SIZE])
+        payload = body[2 + TRANSFER_ID_SIZE:]
+        try:
+            if kind == MSG_ACK:
+                count, status = ACK_FORMAT.unpack_from(payload)
+                with self.lock:
+                    transfer = self.outgoing.get(transfer_id)
+                if transfer and transfer.target == sender:
+                    transfer.on_ack(count, status)
+            elif kind == MSG_OFFER:
+                return self._on_offer(sender, transfer_id, payload)
+            elif kind == MSG_CHUNK:
+                return self._on_chunk(sender, transfer_id, payload)
+        except (ValueError, struct.error, OSError) as e:
+            print(f"\nX File transfer error from {sender}: {type(e).__name__}: {e}")
+        return None
+
+    def _on_offer(self, sender, transfer_id, payload):
+        size, chunk_size, name_length = OFFER_FORMAT.unpack_from(payload)
+        name = safe_file_name(bytes(payload[OFFER_FORMAT.size:OFFER_FORMAT.size + name_length]).decode(errors="replace"))
+        key = (sender, transfer_id)
+        with self.lock:
+            if key in self.completed:
+                done = self.completed[key]
+            else:
+                done = None
+                transfer = self.incoming.get(key)
+        if done is not None:
+            self._ack(sender, transfer_id, done)  # Fichier déjà reçu en entier
+            return None
+        if transfer is None:
+            if size > MAX_FILE_SIZE or not 0 < chunk_size <= MAX_CHUNK_SIZE or not self.directory:
+                self._ack(sender, transfer_id, 0, status=ACK_REFUSED)
+                return None
+            partial = os.path.join(self.directory, "partial")
+            os.makedirs(partial, exist_ok=True)
+            reason = self._over_quota(partial, size)
+            if reason:
+                FILE_TRANSFERS.inc(direction="received", result="refused")
+                self._ack(sender, transfer_id, 0, status=ACK_REFUSED)
+                return f"[Fichier refusé] {name} ({format_size(size)}) de {sender} : {reason}"
+            transfer = IncomingTransfer(partial, sender, transfer_id, name, size, chunk_size)
+            with self.lock:
+                existing = self.incoming.setdefault(key, transfer)
+                if self.sweeper is None:
+                    self.sweeper = threading.Thread(target=self._sweep, daemon=True, name="transfer-sweep")
+                    self.sweeper.start()
+            if existing is not transfer:
+                transfer.close()  # Même offre reçue deux fois en même temps
+            transfer = existing
+        self._ack(sender, transfer_id, transfer.next, route_holder=transfer)
+        return None
+
+    def _over_quota(self, partial, size):
+        """Raison du refus d'une nouvelle réception de size octets, ou None"""
+        with self.lock:
+            pending = sum(transfer.size for transfer in self.incoming.values())
+        if pending + size > INCOMING_QUOTA:
+            return f"réceptions en cours au-delà de {format_size(INCOMING_QUOTA)}"
+        if shutil.disk_usage(partial).free - size < DISK_MIN_FREE:
+            return "espace disque insuffisant"
+        return None
+
+    def _sweep(self):
+        """Fermer les réceptions inactives et supprimer les fichiers partiels abandonnés"""
+        while True:
+            time.sleep(INCOMING_SWEEP)
+            now = time.monotonic()
+            with self.lock:
+                stale = [key for key, transfer in self.incoming.items() if now - transfer.updated > INCOMING_TIMEOUT]
+                expired = [self.incoming.pop(key) for key in stale]
+                active = {transfer.part_path for transfer in self.incoming.values()}
+                if not self.incoming:
+                    self.sweeper = None
+            for transfer in expired:
+                transfer.close()  # Les morceaux reçus restent : un nouvel envoi reprendra
+                FILE_TRANSFERS.inc(direction="received", result="expired")
+                print(f"\n/!\\ File transfer '{transfer.name}' from {transfer.sender} stalled: closed")
+            self._purge_partial(active)
+            if not active:
+                return
+
+    def _purge_partial(self, active):
+        """Supprimer les fichiers partiels non modifiés depuis PARTIAL_TTL (hors réceptions en cours)"""
+        partial = os.path.join(self.directory or "", "partial")
+        try:
+            names = os.listdir(partial)
+        except OSError:
+            return
+        limit = time.time() - PARTIAL_TTL
+        for name in names:
+            path = os.path.join(partial, name)
+            if path.endswith(".json") and path[:-5] + ".part" in active or path in active:
+                continue
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _on_chunk(self, sender, transfer_id, payload):
+        (index,) = CHUNK_FORMAT.unpack_from(payload)
+        key = (sender, transfer_id)
+        with self.lock:
+            transfer = self.incoming.get(key)
+            done = self.completed.get(key)
+        if transfer is None:
+            if done is not None:
+                self._ack(sender, transfer_id, done)  # Renvoi tardif d'un transfert terminé
+            return None
+        count = transfer.write(index, payload[CHUNK_FORMAT.size:])
+        notice = None
+        if transfer.complete:
+            with self.lock:
+                if self.incoming.pop(key, None) is None:
+                    return None  # Terminé par un autre thread
+                self.completed[key] = transfer.total
+            path = transfer.finish(self.directory)
+            FILE_TRANSFERS.inc(direction="received", result="ok")
+            notice = f"[Fichier reçu] {os.path.basename(path)} ({format_size(transfer.size)}) -> {path}"
+        self._ack(sender, transfer_id, count, route_holder=transfer)
+        return notice
+
+    def _ack(self, sender, transfer_id, count, status=ACK_OK, route_holder=None):
+        """Confier l'ACK à self.acks : le thread de réception repart aussitôt"""
+        try:
+            self.acks.submit(self._send_ack, sender, transfer_id, count, status, route_holder)
+        except RuntimeError:
+            pass  # Client arrêté
+
+    def _send_ack(self, sender, transfer_id, count, status, route_holder):
+        """Répondre à l'émetteur par son propre chemin (gardé par transfert)"""
+        payload = pack_message(MSG_ACK, transfer_id, ACK_FORMAT.pack(count, status))
+        route = route_holder.route if route_holder else None
+        try:
+            if route is None:
+                route = self.client.request_path(sender, ACK_LAYERS)
+                if not route[0]:
+                    return
+                if route_holder:
+                    route_holder.route = route
+            self.client.send_payload(route[0], route[1], payload)
+        except OSError as e:
+            if route_holder:
+                route_holder.route = None  # Nouveau chemin au prochain ACK
+            print(f"\nX Cannot acknowledge file chunk to {sender}: {e}")
+
+    def close(self):
+        self.acks.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            transfers = list(self.incoming.values())
+            self.incoming.clear()
+        for transfer in transfers:
+            transfer.close()